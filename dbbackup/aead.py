@@ -0,0 +1,419 @@
+"""
+Chunked authenticated encryption with an envelope of wrapped data keys.
+
+Data is encrypted with a random key per backup, in chunks of a fixed size
+each authenticated on its own with AES-256-GCM or ChaCha20-Poly1305. A
+chunk's nonce is its index and a flag set on the last chunk, so chunks
+cannot be reordered, dropped or truncated unnoticed, and any chunk can be
+decrypted alone. The data key is wrapped for each recipient's public key,
+RSA with OAEP or X25519, in the envelope written after the header.
+
+Layout: header (magic, cipher, chunk size, envelope size), envelope
+(recipients' key ids and wrapped keys), then the encrypted chunks, each
+16 bytes larger than its data.
+
+Recipients are changed without touching the data by rewrapping the data
+key into a sidecar file next to the backup, whose envelope is used
+instead of the one in the backup.
+"""
+
+import hashlib
+import io
+import os
+import struct
+
+from . import seekable, streams
+from .utils import DecryptionError, EncryptionError
+
+MAGIC = b"DBAEAD01"
+# Magic, cipher, chunk size, then the envelope's size
+HEADER_FORMAT = "<8sBII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Part of the header authenticated with every chunk, the envelope can change
+AUTHENTICATED_SIZE = HEADER_SIZE - 4
+CIPHERS = {"aes-256-gcm": 1, "chacha20-poly1305": 2}
+KEY_SIZE = 32
+TAG_SIZE = 16
+KEY_ID_SIZE = 16
+WRAP_INFO = b"dbbackup aead key wrap"
+SIDECAR_MAGIC = b"DBENVL01"
+SIDECAR_EXTENSION = "envelope"
+
+
+def _get_cipher(cipher_id, key):
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+    if cipher_id == CIPHERS["aes-256-gcm"]:
+        return AESGCM(key)
+    if cipher_id == CIPHERS["chacha20-poly1305"]:
+        return ChaCha20Poly1305(key)
+    raise DecryptionError(f"Unknown cipher {cipher_id}")
+
+
+def get_nonce(index, last):
+    """Nonce of the chunk at ``index``, ``last`` if no chunk follows."""
+    return index.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+
+
+def _read_key(value):
+    if isinstance(value, str) and not value.lstrip().startswith("-----BEGIN"):
+        with open(value, "rb") as fd:
+            return fd.read()
+    return value.encode() if isinstance(value, str) else value
+
+
+def load_public_key(value):
+    """
+    Load a recipient's public key, RSA or X25519.
+
+    :param value: PEM content, or path of a PEM file
+    :type value: ``str`` or ``bytes``
+    """
+    from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+    return load_pem_public_key(_read_key(value))
+
+
+def load_private_key(value, passphrase=None):
+    """
+    Load an identity's private key, RSA or X25519.
+
+    :param value: PEM content, or path of a PEM file
+    :type value: ``str`` or ``bytes``
+
+    :param passphrase: Passphrase of an encrypted key
+    :type passphrase: ``str`` or ``None``
+    """
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+    password = passphrase.encode() if passphrase else None
+    try:
+        return load_pem_private_key(_read_key(value), password)
+    except TypeError as err:
+        raise DecryptionError(f"Cannot load private key: {err}") from err
+
+
+def get_key_id(public_key):
+    """Identify a public key by a digest of its DER encoding."""
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+    der = public_key.public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+    return hashlib.sha256(der).digest()[:KEY_ID_SIZE]
+
+
+def _derive_wrapping_key(shared_key, ephemeral_bytes, recipient_bytes):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=KEY_SIZE,
+        salt=ephemeral_bytes + recipient_bytes,
+        info=WRAP_INFO,
+    ).derive(shared_key)
+
+
+def _raw_bytes(public_key):
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+    return public_key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+
+def wrap_key(data_key, public_key):
+    """
+    Encrypt a data key for a recipient.
+
+    :rtype: ``bytes``
+    """
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa, x25519
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    if isinstance(public_key, rsa.RSAPublicKey):
+        return public_key.encrypt(
+            data_key,
+            padding.OAEP(
+                mgf=padding.MGF1(hashes.SHA256()), algorithm=hashes.SHA256(), label=None
+            ),
+        )
+    if isinstance(public_key, x25519.X25519PublicKey):
+        ephemeral = x25519.X25519PrivateKey.generate()
+        ephemeral_bytes = _raw_bytes(ephemeral.public_key())
+        wrapping_key = _derive_wrapping_key(
+            ephemeral.exchange(public_key), ephemeral_bytes, _raw_bytes(public_key)
+        )
+        # The wrapping key is used once, a zero nonce is safe
+        return ephemeral_bytes + AESGCM(wrapping_key).encrypt(bytes(12), data_key, None)
+    raise EncryptionError(f"Unsupported key type: {type(public_key).__name__}")
+
+
+def unwrap_key(wrapped, private_key):
+    """
+    Decrypt a data key with a recipient's private key.
+
+    :rtype: ``bytes``
+    """
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa, x25519
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    try:
+        if isinstance(private_key, rsa.RSAPrivateKey):
+            return private_key.decrypt(
+                wrapped,
+                padding.OAEP(
+                    mgf=padding.MGF1(hashes.SHA256()),
+                    algorithm=hashes.SHA256(),
+                    label=None,
+                ),
+            )
+        if isinstance(private_key, x25519.X25519PrivateKey):
+            ephemeral_bytes, wrapped = wrapped[:32], wrapped[32:]
+            ephemeral = x25519.X25519PublicKey.from_public_bytes(ephemeral_bytes)
+            wrapping_key = _derive_wrapping_key(
+                private_key.exchange(ephemeral),
+                ephemeral_bytes,
+                _raw_bytes(private_key.public_key()),
+            )
+            return AESGCM(wrapping_key).decrypt(bytes(12), wrapped, None)
+    except (InvalidTag, ValueError) as err:
+        raise DecryptionError("Cannot unwrap the data key") from err
+    raise DecryptionError(f"Unsupported key type: {type(private_key).__name__}")
+
+
+def build_envelope(data_key, public_keys):
+    """
+    Wrap a data key for each recipient.
+
+    :rtype: ``bytes``
+    """
+    if not public_keys:
+        raise EncryptionError("No recipient to encrypt for")
+    envelope = struct.pack("<H", len(public_keys))
+    for public_key in public_keys:
+        wrapped = wrap_key(data_key, public_key)
+        envelope += get_key_id(public_key) + struct.pack("<H", len(wrapped)) + wrapped
+    return envelope
+
+
+def parse_envelope(envelope):
+    """
+    :returns: Key id and wrapped key of each recipient
+    :rtype: ``list`` of ``tuple``
+    """
+    try:
+        (count,) = struct.unpack_from("<H", envelope)
+        offset = 2
+        recipients = []
+        for _ in range(count):
+            key_id = envelope[offset : offset + KEY_ID_SIZE]
+            offset += KEY_ID_SIZE
+            (size,) = struct.unpack_from("<H", envelope, offset)
+            offset += 2
+            recipients.append((key_id, envelope[offset : offset + size]))
+            offset += size
+    except struct.error as err:
+        raise DecryptionError("Truncated envelope") from err
+    return recipients
+
+
+def open_envelope(envelope, private_keys):
+    """
+    Get the data key with the first private key it is wrapped for.
+
+    :raises: :class:`dbbackup.utils.DecryptionError` if there's none
+    """
+    recipients = dict(parse_envelope(envelope))
+    for private_key in private_keys:
+        wrapped = recipients.get(get_key_id(private_key.public_key()))
+        if wrapped is not None:
+            return unwrap_key(wrapped, private_key)
+    raise DecryptionError("The backup is not encrypted for any of the identities")
+
+
+def rewrap_envelope(envelope, private_keys, public_keys):
+    """
+    Wrap the data key of an envelope for other recipients.
+
+    :rtype: ``bytes``
+    """
+    return build_envelope(open_envelope(envelope, private_keys), public_keys)
+
+
+def get_sidecar_filename(filename, new=False):
+    """
+    Name of the file holding the rewrapped envelope of a backup, or with
+    ``new`` of the one written before replacing it.
+    """
+    if new:
+        return f"{filename}.new.{SIDECAR_EXTENSION}"
+    return f"{filename}.{SIDECAR_EXTENSION}"
+
+
+def is_sidecar_filename(filename):
+    return filename.endswith(f".{SIDECAR_EXTENSION}")
+
+
+def build_sidecar(envelope):
+    return SIDECAR_MAGIC + envelope
+
+
+def parse_sidecar(data):
+    """
+    :returns: Envelope of a sidecar file
+    :rtype: ``bytes``
+    """
+    if not data.startswith(SIDECAR_MAGIC):
+        raise DecryptionError("Not an envelope file")
+    return data[len(SIDECAR_MAGIC) :]
+
+
+def build_header(cipher_id, chunk_size, envelope):
+    return struct.pack(HEADER_FORMAT, MAGIC, cipher_id, chunk_size, len(envelope))
+
+
+def parse_header(header):
+    """
+    :returns: Cipher, chunk size and envelope's size
+    :rtype: ``tuple``
+    """
+    if len(header) < HEADER_SIZE:
+        raise DecryptionError("Truncated header")
+    magic, cipher_id, chunk_size, envelope_size = struct.unpack_from(
+        HEADER_FORMAT, header
+    )
+    if magic != MAGIC:
+        raise DecryptionError("Not an AEAD encrypted backup")
+    return cipher_id, chunk_size, envelope_size
+
+
+def read_header(fileobj):
+    """
+    Read the header and the envelope at the start of a file.
+
+    :returns: Header and envelope
+    :rtype: ``bytes``, ``bytes``
+    """
+    header = fileobj.read(HEADER_SIZE)
+    _, _, envelope_size = parse_header(header)
+    envelope = fileobj.read(envelope_size)
+    if len(envelope) != envelope_size:
+        raise DecryptionError("Truncated envelope")
+    return header, envelope
+
+
+def _number_blocks(blocks):
+    """Yield each block with its index and whether it is the last one."""
+    index = 0
+    previous = None
+    for block in blocks:
+        if previous is not None:
+            yield index, previous, False
+            index += 1
+        previous = block
+    yield index, b"" if previous is None else previous, True
+
+
+def encrypt_chunks(
+    chunks, public_keys, cipher="aes-256-gcm", chunk_size=None, threads=1
+):
+    """
+    Encrypt chunks for recipients, chunks being encrypted in a pool of
+    ``threads`` threads.
+
+    :param public_keys: Recipients' public keys
+    :type public_keys: ``list``
+
+    :rtype: ``generator``
+    """
+    try:
+        cipher_id = CIPHERS[cipher]
+    except KeyError as err:
+        raise EncryptionError(f"Unknown cipher '{cipher}'") from err
+    chunk_size = chunk_size or 1024 * 1024
+    data_key = os.urandom(KEY_SIZE)
+    envelope = build_envelope(data_key, public_keys)
+    header = build_header(cipher_id, chunk_size, envelope)
+    aead = _get_cipher(cipher_id, data_key)
+    associated_data = header[:AUTHENTICATED_SIZE]
+
+    def encrypt(item):
+        index, block, last = item
+        return aead.encrypt(get_nonce(index, last), block, associated_data)
+
+    yield header + envelope
+    blocks = _number_blocks(streams.split_chunks(chunks, chunk_size))
+    yield from streams.map_ordered(encrypt, blocks, threads)
+
+
+def _get_chunk_decrypter(header, envelope, private_keys):
+    from cryptography.exceptions import InvalidTag
+
+    cipher_id, _, _ = parse_header(header)
+    aead = _get_cipher(cipher_id, open_envelope(envelope, private_keys))
+    associated_data = header[:AUTHENTICATED_SIZE]
+
+    def decrypt(index, block, last):
+        try:
+            return aead.decrypt(get_nonce(index, last), block, associated_data)
+        except InvalidTag as err:
+            raise DecryptionError(f"Chunk {index} is corrupted or truncated") from err
+
+    return decrypt
+
+
+def decrypt_chunks(chunks, private_keys, threads=1, envelope=None):
+    """
+    Decrypt chunks with the first identity the data key is wrapped for,
+    chunks being decrypted in a pool of ``threads`` threads.
+
+    :param private_keys: Identities' private keys
+    :type private_keys: ``list``
+
+    :param envelope: Envelope used instead of the one in the data
+    :type envelope: ``bytes`` or ``None``
+
+    :rtype: ``generator``
+    """
+    header, chunks = streams.peek_chunks(chunks, HEADER_SIZE)
+    _, chunk_size, envelope_size = parse_header(header)
+    data_offset = HEADER_SIZE + envelope_size
+    if envelope is None:
+        head, chunks = streams.peek_chunks(chunks, data_offset)
+        envelope = head[HEADER_SIZE:]
+    decrypt = _get_chunk_decrypter(header, envelope, private_keys)
+    blocks = streams.split_chunks(
+        streams.skip_chunks(chunks, data_offset), chunk_size + TAG_SIZE
+    )
+    yield from streams.map_ordered(
+        lambda item: decrypt(*item), _number_blocks(blocks), threads
+    )
+
+
+class DecryptingReader(seekable.SeekableReader):
+    """
+    Decrypted data of an encrypted file, as a read-only seekable file. Only
+    the chunks holding the data read are read and decrypted.
+    """
+
+    def __init__(self, fileobj, private_keys, envelope=None):
+        fileobj.seek(0)
+        header, file_envelope = read_header(fileobj)
+        _, chunk_size, envelope_size = parse_header(header)
+        self._decrypt = _get_chunk_decrypter(
+            header, envelope or file_envelope, private_keys
+        )
+        data_offset = HEADER_SIZE + envelope_size
+        data_size = fileobj.seek(0, io.SEEK_END) - data_offset
+        block_size = chunk_size + TAG_SIZE
+        entries = []
+        for index, offset in enumerate(range(0, data_size, block_size)):
+            size = min(block_size, data_size - offset)
+            entries.append(
+                (data_offset + offset, index * chunk_size, size, size - TAG_SIZE)
+            )
+        super().__init__(fileobj, entries, None)
+
+    def _decode(self, index, frame, size):
+        return self._decrypt(index, frame, index == len(self.entries) - 1)
@@ -0,0 +1,360 @@
+"""
+Temporary buffers holding dumps and backups between stages.
+"""
+
+import ctypes
+import errno
+import io
+import itertools
+import mmap
+import os
+import tempfile
+import threading
+
+from . import settings
+
+
+class MemoryBudget:
+    """
+    Amount of memory shared by all buffers of the process. Buffers reserve
+    memory as they grow and spill to disk when the budget is exhausted.
+
+    The size of the budget is ``settings.MEMORY_BUDGET``, unlimited if
+    ``None``. Usage is tracked either way, to know the peak.
+    """
+
+    def __init__(self):
+        self.used = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return settings.MEMORY_BUDGET
+
+    def acquire(self, size):
+        """
+        Reserve ``size`` bytes.
+
+        :returns: ``False`` if the budget is exhausted
+        :rtype: ``bool``
+        """
+        with self._lock:
+            if self.size is not None and self.used + size > self.size:
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, size):
+        with self._lock:
+            self.used -= size
+
+    def reset_peak(self):
+        with self._lock:
+            self.peak = self.used
+
+
+memory_budget = MemoryBudget()
+
+# fallocate(2) flag reserving disk space without changing the file's size
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def _fallocate(fd, size):
+    """
+    Reserve ``size`` bytes of disk space for a file without changing its
+    size, so the file is written in contiguous blocks and running out of
+    space fails early. Does nothing if the platform does not support it.
+    """
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        err = ctypes.get_errno()
+        if err == errno.ENOSPC:
+            raise OSError(err, os.strerror(err))
+
+
+def _open_tmpfile(dir):
+    """
+    Open an anonymous file in ``dir``. With ``O_TMPFILE`` the file never
+    has a name, so nothing is left behind if the process is killed.
+    """
+    if hasattr(os, "O_TMPFILE"):
+        try:
+            fd = os.open(dir, os.O_TMPFILE | os.O_RDWR, 0o600)
+        except OSError:
+            # Not supported by the filesystem
+            pass
+        else:
+            return open(fd, "r+b", buffering=0)
+    return tempfile.TemporaryFile(dir=dir, buffering=0)
+
+
+class SpillManager:
+    """
+    Create the temporary files buffers spill to, in the directories of
+    ``settings.TMP_DIRS`` in turn, to spread the I/O over several volumes.
+    Directories without room for the expected size of a file are skipped.
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    @property
+    def dirs(self):
+        return list(settings.TMP_DIRS or [settings.TMP_DIR])
+
+    def get_dir(self, expected_size=None):
+        """
+        Get the directory for the next temporary file.
+
+        :param expected_size: Expected size of the file in bytes
+        :type expected_size: ``int`` or ``None``
+
+        :rtype: ``str``
+        """
+        dirs = self.dirs
+        start = next(self._counter) % len(dirs)
+        dirs = dirs[start:] + dirs[:start]
+        if expected_size:
+            for dir in dirs:
+                stat = os.statvfs(dir)
+                if stat.f_bavail * stat.f_frsize >= expected_size:
+                    return dir
+        return dirs[0]
+
+    def create(self, expected_size=None, dir=None):
+        """
+        Create an anonymous temporary file, with disk space reserved if its
+        size is known.
+
+        :param expected_size: Expected size of the file in bytes
+        :type expected_size: ``int`` or ``None``
+
+        :param dir: Directory of the file, chosen from ``settings.TMP_DIRS``
+                    if ``None``
+        :type dir: ``str`` or ``None``
+
+        :returns: Unbuffered file
+        :rtype: ``io.FileIO``
+        """
+        fileobj = _open_tmpfile(dir or self.get_dir(expected_size))
+        if expected_size:
+            try:
+                _fallocate(fileobj.fileno(), expected_size)
+            except OSError:
+                fileobj.close()
+                raise
+        return fileobj
+
+
+spill_manager = SpillManager()
+
+
+class SpillBuffer(io.RawIOBase):
+    """
+    Seekable temporary file kept in memory until it grows bigger than
+    ``max_size``, then spilled to a temporary file on disk.
+
+    Unlike :class:`tempfile.SpooledTemporaryFile`, the memory part is an
+    anonymous memory map allocated once instead of a growing ``BytesIO``,
+    and both parts can be read without copy with :meth:`read_view`, which
+    returns a ``memoryview`` of the map. Views stay valid after the buffer
+    is closed, until they are released.
+
+    Memory is reserved from :data:`memory_budget` as data is written, the
+    buffer spills when the budget is exhausted even if ``max_size`` is not
+    reached. Files are created by :data:`spill_manager`; if the size of the
+    content is known in advance, give it as ``expected_size`` to reserve
+    disk space, or to write directly on disk when it is bigger than
+    ``max_size``.
+
+    Asking for :meth:`fileno` spills the buffer, so a subprocess can write
+    into it directly.
+    """
+
+    def __init__(self, max_size=None, dir=None, expected_size=None):
+        self.max_size = settings.TMP_FILE_MAX_SIZE if max_size is None else max_size
+        self.dir = dir
+        self.expected_size = expected_size
+        self._position = 0
+        self._length = 0
+        self._file = None
+        self._map = None
+        self._map_size = 0
+        self._reserved = 0
+        if self.max_size > 0 and (expected_size or 0) <= self.max_size:
+            self._map = mmap.mmap(-1, self.max_size)
+            self._map_size = self.max_size
+        else:
+            self.rollover()
+
+    @property
+    def spilled(self):
+        """``True`` once the content is in a file on disk."""
+        return self._file is not None
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        self.rollover()
+        # A subprocess given the descriptor reads or writes from the
+        # buffer's position, not from where the last write left the file
+        self._file.seek(self._position)
+        return self._file.fileno()
+
+    def rollover(self):
+        """Move the content to a temporary file on disk."""
+        if self._file is not None:
+            return
+        self._file = spill_manager.create(
+            max(self.expected_size or 0, self._length), self.dir
+        )
+        if self._map is not None:
+            view = memoryview(self._map)
+            try:
+                self._write_file(view[: self._length], 0)
+            finally:
+                view.release()
+            self._release_map()
+            self._release_memory()
+
+    def _release_memory(self):
+        memory_budget.release(self._reserved)
+        self._reserved = 0
+
+    def _release_map(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # Views are still used, the map is freed with the last one
+            pass
+        self._map = None
+        self._map_size = 0
+
+    def _write_file(self, data, position):
+        self._file.seek(position)
+        while data:
+            written = self._file.write(data)
+            data = data[written:]
+
+    def _size(self):
+        if self._file is None:
+            return self._length
+        # A subprocess may have written to the file
+        return os.fstat(self._file.fileno()).st_size
+
+    def _get_map(self, size):
+        """Get a map of at least the ``size`` first bytes of the content."""
+        if self._file is not None and size > self._map_size:
+            if self._map is not None:
+                self._release_map()
+            self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+            self._map_size = size
+        return self._map
+
+    def read_view(self, size=-1):
+        """
+        Read up to ``size`` bytes, or all remaining ones if negative, without
+        copying them.
+
+        :returns: View of the content, empty at the end of the buffer
+        :rtype: ``memoryview``
+        """
+        self._checkClosed()
+        end = self._size()
+        if size is not None and size >= 0:
+            end = min(end, self._position + size)
+        if end <= self._position:
+            return memoryview(b"")
+        view = memoryview(self._get_map(end))[self._position : end]
+        self._position = end
+        return view
+
+    def readinto(self, buffer):
+        view = self.read_view(len(buffer))
+        size = len(view)
+        buffer[:size] = view
+        view.release()
+        return size
+
+    def write(self, data):
+        self._checkClosed()
+        data = memoryview(data).cast("B")
+        end = self._position + len(data)
+        if self._file is None and (end > self._map_size or not self._reserve(end)):
+            self.rollover()
+        if self._file is None:
+            if self._position > self._length:
+                self._map[self._length : self._position] = bytes(
+                    self._position - self._length
+                )
+            self._map[self._position : end] = data
+            self._length = max(self._length, end)
+        else:
+            self._write_file(data, self._position)
+        self._position = end
+        return len(data)
+
+    def _reserve(self, size):
+        """Reserve memory from the budget to hold ``size`` bytes."""
+        if size <= self._reserved:
+            return True
+        if not memory_budget.acquire(size - self._reserved):
+            return False
+        self._reserved = size
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size()
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return self._position
+
+    def tell(self):
+        self._checkClosed()
+        return self._position
+
+    def truncate(self, size=None):
+        self._checkClosed()
+        size = self._position if size is None else size
+        if self._file is None:
+            if size > self._map_size or not self._reserve(size):
+                self.rollover()
+            else:
+                if size > self._length:
+                    self._map[self._length : size] = bytes(size - self._length)
+                self._length = size
+                return size
+        if size < self._map_size:
+            # Accessing a mapped page past the end of the file would crash
+            self._release_map()
+        self._file.truncate(size)
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        if self._map is not None:
+            self._release_map()
+        self._release_memory()
+        if self._file is not None:
+            self._file.close()
+        super().close()
@@ -0,0 +1,296 @@
+"""
+Catalog of the backups, stored with them.
+
+Finding backups by listing the storage gets slow with many files. The
+catalog records each backup written or deleted, under
+``settings.DBBACKUP_CATALOG_PATH`` in the storage, so queries only read
+this directory. Each change is a new journal file, written in one request,
+so concurrent commands do not overwrite each other's changes. Journals are
+regularly compacted into a snapshot of all entries, which records the
+journals it includes; a reader takes the latest snapshot then every other
+journal, so journals written during a compaction or by a server whose
+clock is late are not lost.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+import uuid
+
+from django.core.files.base import ContentFile
+
+from . import aead, settings, stages, streams, utils
+
+logger = logging.getLogger("dbbackup.storage")
+
+JOURNAL_PREFIX = "journal-"
+SNAPSHOT_PREFIX = "snapshot-"
+# Number of journals triggering a compaction
+COMPACT_SIZE = 50
+# Readers start over if a compaction deletes files they list
+LOAD_ATTEMPTS = 3
+CHECKSUM_ALGORITHM = stages.ChecksumStage.algorithm
+
+
+def is_backup_filename(filename):
+    """Tell if a file of the storage is a backup."""
+    return bool(utils.filename_to_datestring(filename)) and not (
+        aead.is_sidecar_filename(filename)
+    )
+
+
+def get_content_type(filename):
+    return "media" if ".tar" in filename else "db"
+
+
+def get_digest(fileobj):
+    """
+    Get the size and checksum of a seekable file, read from its start.
+
+    :returns: Size and hexadecimal digest
+    :rtype: ``tuple``
+    """
+    digest = hashlib.new(CHECKSUM_ALGORITHM)
+    size = 0
+    fileobj.seek(0)
+    for chunk in streams.iter_file(fileobj):
+        digest.update(chunk)
+        size += len(chunk)
+    fileobj.seek(0)
+    return size, digest.hexdigest()
+
+
+def build_entry(
+    name,
+    size=None,
+    checksum=None,
+    database=None,
+    servername=None,
+    content_type=None,
+):
+    """
+    Build the catalog entry of a backup, its codec, encryption and
+    timestamp being found from its name.
+
+    :rtype: ``dict``
+    """
+    stage_list = stages.stages_from_filename(name)
+    date = utils.filename_to_date(name)
+    return {
+        "name": name,
+        "database": database,
+        "servername": servername,
+        "content_type": content_type or get_content_type(name),
+        "codec": ".".join(
+            s.extension for s in reversed(stage_list) if s.kind == "compression"
+        )
+        or None,
+        "encryption": ".".join(
+            s.extension for s in reversed(stage_list) if s.kind == "encryption"
+        )
+        or None,
+        "size": size,
+        "timestamp": date.isoformat() if date else None,
+        "checksum": checksum,
+    }
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Non-seekable file counting and hashing the data read from it, to
+    catalog streamed backups without reading them twice.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self._digest = hashlib.new(CHECKSUM_ALGORITHM)
+
+    @property
+    def name(self):
+        return getattr(self.fileobj, "name", None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.fileobj.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        self._digest.update(data)
+        self.size += size
+        return size
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+class Catalog:
+    """
+    Catalog of the backups of a storage.
+
+    :param storage: Django storage
+    :type storage: :class:`django.core.files.storage.Storage`
+
+    :param path: Directory of the catalog in the storage
+    :type path: ``str``
+    """
+
+    def __init__(self, storage, path=None):
+        self.storage = storage
+        self.path = path or settings.CATALOG_PATH
+
+    def _new_key(self, after=None):
+        # Ordered by time, unique between processes
+        timestamp = time.time_ns()
+        if after is not None:
+            # Even if the clock is late
+            timestamp = max(timestamp, int(after.split("-")[0]) + 1)
+        return f"{timestamp:020d}-{uuid.uuid4().hex[:8]}"
+
+    def _list(self):
+        """
+        List catalog files.
+
+        :returns: Key and name of the snapshots and of the journals, in
+                  order
+        :rtype: ``tuple``
+        """
+        snapshots = []
+        journals = []
+        try:
+            filenames = self.storage.listdir(self.path)[1]
+        except FileNotFoundError:
+            filenames = []
+        for filename in filenames:
+            key = os.path.splitext(filename)[0]
+            if filename.startswith(SNAPSHOT_PREFIX):
+                snapshots.append((key[len(SNAPSHOT_PREFIX) :], filename))
+            elif filename.startswith(JOURNAL_PREFIX):
+                journals.append((key[len(JOURNAL_PREFIX) :], filename))
+        return sorted(snapshots), sorted(journals)
+
+    def _read(self, filename):
+        with self.storage.open(f"{self.path}/{filename}", "rb") as fd:
+            return json.loads(fd.read())
+
+    def _write(self, filename, value):
+        content = ContentFile(json.dumps(value, sort_keys=True).encode())
+        self.storage.save(f"{self.path}/{filename}", content)
+
+    def _load(self):
+        """
+        Read the latest snapshot and the journals it does not include.
+
+        :returns: Entries, snapshots and journals listed
+        :rtype: ``tuple``
+        """
+        snapshots, journals = self._list()
+        entries = {}
+        included = set()
+        if snapshots:
+            snapshot = self._read(snapshots[-1][1])
+            entries = {e["name"]: e for e in snapshot["entries"]}
+            included = set(snapshot["journals"])
+        for _, filename in journals:
+            if filename in included:
+                # Left by a compaction stopped while deleting
+                continue
+            change = self._read(filename)
+            if change["action"] == "add":
+                entries[change["entry"]["name"]] = change["entry"]
+            else:
+                entries.pop(change["name"], None)
+        return entries, snapshots, journals
+
+    def load(self):
+        """
+        Read all entries, by name.
+
+        :rtype: ``dict``
+        """
+        for attempt in range(LOAD_ATTEMPTS):
+            try:
+                return self._load()[0]
+            except (OSError, ValueError):
+                # A compaction removed files being read
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+
+    def list_entries(self):
+        """
+        List entries, sorted by name.
+
+        :rtype: ``list`` of ``dict``
+        """
+        return [entry for _, entry in sorted(self.load().items())]
+
+    def _add_change(self, change):
+        self._write(f"{JOURNAL_PREFIX}{self._new_key()}.json", change)
+        _, journals = self._list()
+        if len(journals) >= COMPACT_SIZE:
+            self.compact()
+
+    def add(self, entry):
+        """Record a new backup, see :func:`build_entry`."""
+        logger.debug("Cataloging %s", entry["name"])
+        self._add_change({"action": "add", "entry": entry})
+
+    def remove(self, name):
+        """Record a deleted backup."""
+        logger.debug("Removing %s from catalog", name)
+        self._add_change({"action": "remove", "name": name})
+
+    def _write_snapshot(self, entries, snapshots, journals):
+        """
+        Write a snapshot including the ``journals`` and replacing the
+        ``snapshots`` listed, then delete them. If another process wrote a
+        snapshot meanwhile, it may have deleted journals missing from this
+        one, which is deleted instead: one of them always sees the other.
+
+        :returns: ``False`` if the snapshot was deleted
+        :rtype: ``bool``
+        """
+        key = self._new_key(after=snapshots[-1][0] if snapshots else None)
+        filename = f"{SNAPSHOT_PREFIX}{key}.json"
+        self._write(
+            filename,
+            {
+                "entries": [entry for _, entry in sorted(entries.items())],
+                "journals": [name for _, name in journals],
+            },
+        )
+        current, _ = self._list()
+        if set(current) - set(snapshots) - {(key, filename)}:
+            logger.debug("Catalog compacted by another process at the same time")
+            self.storage.delete(f"{self.path}/{filename}")
+            return False
+        for _, obsolete in snapshots + journals:
+            self.storage.delete(f"{self.path}/{obsolete}")
+        return True
+
+    def compact(self):
+        """
+        Write the entries in a snapshot, replacing the journals it includes
+        and the previous snapshots.
+        """
+        entries, snapshots, journals = self._load()
+        if journals:
+            self._write_snapshot(entries, snapshots, journals)
+
+    def rebuild(self, entries):
+        """
+        Replace the whole catalog.
+
+        :param entries: Entries of all backups
+        :type entries: ``list`` of ``dict``
+        """
+        entries = {e["name"]: e for e in entries}
+        for _ in range(LOAD_ATTEMPTS):
+            snapshots, journals = self._list()
+            if self._write_snapshot(entries, snapshots, journals):
+                return
+        raise OSError("Catalog is compacted by other processes, try again later")
@@ -2,16 +2,19 @@
 Base database connectors
 """
 
+import io
 import logging
 import os
 import shlex
+import threading
 from importlib import import_module
-from subprocess import Popen
-from tempfile import SpooledTemporaryFile
+from shutil import copyfileobj
+from subprocess import PIPE, Popen
 
 from django.core.files.base import File
 
-from dbbackup import settings, utils
+from dbbackup import settings, streams, utils
+from dbbackup.buffers import SpillBuffer
 
 from . import exceptions
 
@@ -61,6 +64,123 @@ def get_connector(database_name=None):
     return connector(database_name, **connector_settings)
 
 
+def _has_fileno(fileobj):
+    try:
+        fileobj.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+    return True
+
+
+class StdinFeeder(threading.Thread):
+    """
+    Thread copying a file object without file descriptor, like a stream of
+    chunks, into the standard input of a process.
+
+    If reading the input fails, the process is killed before its standard
+    input is closed, so it never sees a truncated input as a complete one.
+    """
+
+    def __init__(self, process, stdin):
+        super().__init__(daemon=True)
+        self.process = process
+        self.stdin = stdin
+        self.error = None
+
+    def run(self):
+        try:
+            copyfileobj(self.stdin, self.process.stdin, settings.TMP_FILE_READ_SIZE)
+        except BrokenPipeError:
+            pass
+        except Exception as err:
+            self.error = err
+            self.process.kill()
+        finally:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+
+class StderrTail(threading.Thread):
+    """
+    Thread draining the standard error of a process, keeping only its last
+    ``max_size`` bytes so a verbose command never fills memory or disk.
+    """
+
+    def __init__(self, stream, max_size):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+        self._tail = bytearray()
+
+    def run(self):
+        try:
+            while True:
+                data = self.stream.read1(settings.TMP_FILE_READ_SIZE)
+                if not data:
+                    break
+                self.size += len(data)
+                self._tail += data
+                del self._tail[: -self.max_size]
+        finally:
+            self.stream.close()
+
+    def read(self):
+        """Return the kept bytes of standard error, once drained."""
+        self.join()
+        return bytes(self._tail)
+
+
+class CommandStream(io.RawIOBase):
+    """
+    Standard output of a running command, as a non-seekable file.
+
+    The exit status of the command is checked when its output is exhausted,
+    a failure raises :class:`CommandConnectorError` with the end of its
+    standard error. Closing the stream before kills the command.
+    """
+
+    def __init__(self, command, process, stderr, feeder=None):
+        self.command = command
+        self.process = process
+        self.stderr = stderr
+        self.feeder = feeder
+        self.name = command
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.process.stdout.readinto(buffer)
+        if not size:
+            self._check_status()
+        return size
+
+    def _check_status(self):
+        returncode = self.process.wait()
+        if self.feeder is not None:
+            self.feeder.join()
+            if self.feeder.error is not None:
+                raise self.feeder.error
+        if returncode:
+            raise exceptions.CommandConnectorError(
+                "Error running: {}\n{}".format(
+                    self.command, self.stderr.read().decode("utf-8", "replace")
+                )
+            )
+
+    def close(self):
+        if not self.closed:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+            self.stderr.join()
+        super().close()
+
+
 class BaseDBConnector:
     """
     Base class for create database connector. This kind of object creates
@@ -69,6 +189,10 @@ class BaseDBConnector:
 
     extension = "dump"
     exclude = []
+    # Compression done by the dump tool, like "gzip" or "zstd:3"
+    native_compression = None
+    # Name of the backup being restored, set by dbrestore
+    restore_filename = None
 
     def __init__(self, database_name=None, **kwargs):
         from django.db import DEFAULT_DB_ALIAS, connections
@@ -93,6 +217,16 @@ class BaseDBConnector:
     def create_dump(self):
         return self._create_dump()
 
+    def get_native_compression_stage(self):
+        """
+        Get the stage standing for the compression done by the dump tool,
+        which replaces the compression of backups.
+
+        :return: Stage, ``None`` if the tool does not compress the dump
+        :rtype: :class:`dbbackup.stages.NativeCompressionStage` or ``None``
+        """
+        return None
+
     def _create_dump(self):
         """
         Override this method to define dump creation.
@@ -114,6 +248,40 @@ class BaseDBConnector:
         """
         raise NotImplementedError("_restore_dump not implemented")
 
+    def stream_dump(self):
+        """
+        :return: Dump as chunks of bytes
+        :rtype: iterable of bytes
+        """
+        return self._stream_dump()
+
+    def _stream_dump(self):
+        """
+        Override this method to produce the dump without buffering all of it.
+        By default, chunks are read from :meth:`create_dump`.
+        :return: Dump as chunks of bytes
+        :rtype: iterable of bytes
+        """
+        return streams.iter_file(self.create_dump())
+
+    def restore_dump_stream(self, chunks):
+        """
+        :param chunks: Dump as chunks of bytes
+        :type chunks: iterable of bytes
+        """
+        return self._restore_dump_stream(chunks)
+
+    def _restore_dump_stream(self, chunks):
+        """
+        Override this method to restore the dump without buffering all of it.
+        By default, chunks are spooled into a seekable temporary file given to
+        :meth:`restore_dump`, which is what connectors written against the
+        file API expect.
+        :param chunks: Dump as chunks of bytes
+        :type chunks: iterable of bytes
+        """
+        return self.restore_dump(streams.spool_chunks(chunks))
+
 
 class BaseCommandDBConnector(BaseDBConnector):
     """
@@ -129,45 +297,88 @@ class BaseCommandDBConnector(BaseDBConnector):
     env = {}
     dump_env = {}
     restore_env = {}
+    # Bytes of standard error kept for error messages of streamed commands
+    stderr_tail_size = 64 * 1024
+    # Streams dumps through live pipes, connectors whose _create_dump and
+    # _restore_dump handle them opt in, others keep the file API adapters
+    supports_streaming = False
+    _stream_output = False
+
+    def _restore_dump_stream(self, chunks):
+        if not self.supports_streaming:
+            return super()._restore_dump_stream(chunks)
+        # Commands read their standard input sequentially
+        return self.restore_dump(streams.open_chunks(chunks))
+
+    def _stream_dump(self):
+        if not self.supports_streaming:
+            yield from super()._stream_dump()
+            return
+        # Commands started by create_dump() expose their live output
+        self._stream_output = True
+        try:
+            stdout = self.create_dump()
+        finally:
+            self._stream_output = False
+        try:
+            yield from streams.iter_file(stdout)
+        finally:
+            stdout.close()
 
-    def run_command(self, command, stdin=None, env=None):
+    def run_command(self, command, stdin=None, env=None, stream=None):
         """
         Launch a shell command line.
 
         :param command: Command line to launch
         :type command: str
-        :param stdin: Standard input of command
+        :param stdin: Standard input of command, file objects without file
+                      descriptor are fed to the command through a pipe
         :type stdin: file
         :param env: Environment variable used in command
         :type env: dict
-        :return: Standard output of command
-        :rtype: file
+        :param stream: Return while the command runs, with its standard
+                       output as a live pipe and its standard error drained
+                       into a bounded buffer. Enabled while streaming a
+                       dump if ``None``.
+        :type stream: bool or None
+        :return: Standard output and standard error of command
+        :rtype: file, file
         """
         logger.debug(command)
         cmd = shlex.split(command)
-        stdout = SpooledTemporaryFile(
-            max_size=settings.TMP_FILE_MAX_SIZE, dir=settings.TMP_DIR
-        )
-        stderr = SpooledTemporaryFile(
-            max_size=settings.TMP_FILE_MAX_SIZE, dir=settings.TMP_DIR
-        )
+        if stream is None:
+            stream = self._stream_output
+        if stream:
+            stdout = stderr = PIPE
+        else:
+            stdout = SpillBuffer()
+            stderr = SpillBuffer()
         full_env = os.environ.copy() if self.use_parent_env else {}
         full_env.update(self.env)
         full_env.update(env or {})
+        feeder = None
         try:
             if isinstance(stdin, File):
+                stdin = stdin.open("rb")
+            if stdin is not None and not _has_fileno(stdin):
                 process = Popen(
-                    cmd,
-                    stdin=stdin.open("rb"),
-                    stdout=stdout,
-                    stderr=stderr,
-                    env=full_env,
+                    cmd, stdin=PIPE, stdout=stdout, stderr=stderr, env=full_env
                 )
+                feeder = StdinFeeder(process, stdin)
+                feeder.start()
             else:
                 process = Popen(
                     cmd, stdin=stdin, stdout=stdout, stderr=stderr, env=full_env
                 )
+            if stream:
+                stderr = StderrTail(process.stderr, self.stderr_tail_size)
+                stderr.start()
+                return CommandStream(command, process, stderr, feeder), stderr
             process.wait()
+            if feeder is not None:
+                feeder.join()
+                if feeder.error is not None:
+                    raise feeder.error
             if process.poll():
                 stderr.seek(0)
                 raise exceptions.CommandConnectorError(
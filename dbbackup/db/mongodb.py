@@ -1,4 +1,6 @@
-from dbbackup import utils
+import os
+
+from dbbackup import stages, utils
 
 from .base import BaseCommandDBConnector
 
@@ -11,9 +13,33 @@ class MongoDumpConnector(BaseCommandDBConnector):
 
     dump_cmd = "mongodump"
     restore_cmd = "mongorestore"
+    supports_streaming = True
     object_check = True
     drop = True
 
+    # Extension of archives whose collections are compressed by mongodump
+    native_extension = "gz.dump"
+
+    def generate_filename(self, server_name=None):
+        # Restores need to know how the archive was made
+        extension = self.native_extension if self.native_compression else self.extension
+        return utils.filename_generate(extension, self.database_name, server_name)
+
+    def _is_native_compressed(self):
+        """
+        Tell if the archive restored was compressed by ``mongodump``, from
+        its name, or from the settings if it is not known.
+        """
+        if self.restore_filename is None:
+            return bool(self.native_compression)
+        return f".{self.native_extension}" in os.path.basename(self.restore_filename)
+
+    def get_native_compression_stage(self):
+        if not self.native_compression:
+            return None
+        # Collections are compressed inside the archive
+        return stages.NativeCompressionStage()
+
     def _create_dump(self):
         cmd = f"{self.dump_cmd} --db {self.settings['NAME']}"
         host = self.settings.get("HOST") or "localhost"
@@ -29,6 +55,8 @@ class MongoDumpConnector(BaseCommandDBConnector):
         for collection in self.exclude:
             cmd += f" --excludeCollection {collection}"
         cmd += " --archive"
+        if self.native_compression:
+            cmd += " --gzip"
         cmd = f"{self.dump_prefix} {cmd} {self.dump_suffix}"
         stdout, stderr = self.run_command(cmd, env=self.dump_env)
         return stdout
@@ -50,5 +78,7 @@ class MongoDumpConnector(BaseCommandDBConnector):
         if self.drop:
             cmd += " --drop"
         cmd += " --archive"
+        if self._is_native_compressed():
+            cmd += " --gzip"
         cmd = f"{self.restore_prefix} {cmd} {self.restore_suffix}"
         return self.run_command(cmd, stdin=dump, env=self.restore_env)
@@ -11,6 +11,7 @@ class MysqlDumpConnector(BaseCommandDBConnector):
 
     dump_cmd = "mysqldump"
     restore_cmd = "mysql"
+    supports_streaming = True
 
     def _create_dump(self):
         cmd = f"{self.dump_cmd} {self.settings['NAME']} --quick"
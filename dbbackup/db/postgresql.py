@@ -2,6 +2,7 @@ import logging
 from typing import List, Optional
 from urllib.parse import quote
 
+from .. import stages
 from .base import BaseCommandDBConnector
 
 logger = logging.getLogger("dbbackup.command")
@@ -30,10 +31,23 @@ class PgDumpConnector(BaseCommandDBConnector):
     extension = "psql"
     dump_cmd = "pg_dump"
     restore_cmd = "psql"
+    supports_streaming = True
     single_transaction = True
     drop = True
     schemas: Optional[List[str]] = []
 
+    def get_native_compression_stage(self):
+        if not self.native_compression:
+            return None
+        # pg_dump's methods are named like the stages: gzip, lz4 or zstd
+        method = str(self.native_compression).split(":")[0]
+        if method.isdigit():
+            # A bare level is gzip's, 0 disabling compression
+            if int(method) == 0:
+                return None
+            method = "gzip"
+        return stages.NativeCompressionStage(format=method)
+
     def _create_dump(self):
         cmd = f"{self.dump_cmd} "
         dbname, pg_env = create_postgres_dbname_and_env(self)
@@ -50,6 +64,9 @@ class PgDumpConnector(BaseCommandDBConnector):
             # when using join function so add it manually.
             cmd += " -n " + " -n ".join(self.schemas)
 
+        if self.native_compression:
+            cmd += f" --compress={self.native_compression}"
+
         cmd = f"{self.dump_prefix} {cmd} {self.dump_suffix}"
         stdout, stderr = self.run_command(cmd, env={**self.dump_env, **pg_env})
         return stdout
@@ -117,12 +134,20 @@ class PgDumpBinaryConnector(PgDumpConnector):
     if_exists = False
     pg_options = None
 
+    def get_native_compression_stage(self):
+        if not self.native_compression:
+            return None
+        # Compression is internal to the custom format
+        return stages.NativeCompressionStage()
+
     def _create_dump(self):
         cmd = f"{self.dump_cmd} "
         dbname, pg_env = create_postgres_dbname_and_env(self)
         cmd = cmd + dbname
 
         cmd += " --format=custom"
+        if self.native_compression:
+            cmd += f" --compress={self.native_compression}"
         for table in self.exclude:
             cmd += f" --exclude-table-data={table}"
 
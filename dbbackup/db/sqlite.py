@@ -1,10 +1,13 @@
+import contextlib
+import os
 import warnings
-from io import BytesIO
-from shutil import copyfileobj
-from tempfile import SpooledTemporaryFile
+from shutil import copyfileobj, copymode
 
 from django.db import IntegrityError, OperationalError
 
+from dbbackup import pagecache, streams
+from dbbackup.buffers import SpillBuffer
+
 from .base import BaseDBConnector
 
 DUMP_TABLES = """
@@ -27,6 +30,10 @@ class SqliteConnector(BaseDBConnector):
     """
 
     def _write_dump(self, fileobj):
+        for line in self._iter_dump():
+            fileobj.write(line)
+
+    def _iter_dump(self):
         cursor = self.connection.cursor()
         cursor.execute(DUMP_TABLES)
         for table_name, _, sql in cursor.fetchall():
@@ -37,7 +44,7 @@ class SqliteConnector(BaseDBConnector):
                 # Make SQL commands in 1 line
                 sql = sql.replace("\n    ", "")
                 sql = sql.replace("\n)", ")")
-            fileobj.write(f"{sql};\n".encode())
+            yield f"{sql};\n".encode()
 
             table_name_ident = table_name.replace('"', '""')
             res = cursor.execute(f'PRAGMA table_info("{table_name_ident}")')
@@ -51,29 +58,37 @@ class SqliteConnector(BaseDBConnector):
             )
             query_res = cursor.execute(q)
             for row in query_res:
-                fileobj.write(f"{row[0]};\n".encode())
+                yield f"{row[0]};\n".encode()
             schema_res = cursor.execute(DUMP_ETC)
             for name, _, sql in schema_res.fetchall():
                 if sql.startswith("CREATE INDEX"):
                     sql = sql.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS")
-                fileobj.write(f"{sql};\n".encode())
+                yield f"{sql};\n".encode()
         cursor.close()
 
     def create_dump(self):
         if not self.connection.is_usable():
             self.connection.connect()
-        dump_file = SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+        dump_file = SpillBuffer()
         self._write_dump(dump_file)
         dump_file.seek(0)
         return dump_file
 
+    def stream_dump(self):
+        if not self.connection.is_usable():
+            self.connection.connect()
+        return streams.join_chunks(self._iter_dump())
+
+    def restore_dump_stream(self, chunks):
+        return self.restore_dump(streams.open_chunks(chunks))
+
     def restore_dump(self, dump):
         if not self.connection.is_usable():
             self.connection.connect()
         cursor = self.connection.cursor()
         sql_command = b""
         sql_is_complete = True
-        for line in dump.readlines():
+        for line in dump:
             sql_command = sql_command + line
             line_str = line.decode("UTF-8")
             if line_str.startswith("INSERT") and not line_str.endswith(");\n"):
@@ -98,9 +113,10 @@ class SqliteCPConnector(BaseDBConnector):
 
     def create_dump(self):
         path = self.connection.settings_dict["NAME"]
-        dump = BytesIO()
+        dump = SpillBuffer(expected_size=os.path.getsize(path))
         with open(path, "rb") as db_file:
-            copyfileobj(db_file, dump)
+            for chunk in pagecache.iter_file(db_file):
+                dump.write(chunk)
         dump.seek(0)
         return dump
 
@@ -108,3 +124,25 @@ class SqliteCPConnector(BaseDBConnector):
         path = self.connection.settings_dict["NAME"]
         with open(path, "wb") as db_file:
             copyfileobj(dump, db_file)
+
+    def stream_dump(self):
+        path = self.connection.settings_dict["NAME"]
+        with open(path, "rb") as db_file:
+            yield from pagecache.iter_file(db_file)
+
+    def restore_dump_stream(self, chunks):
+        path = self.connection.settings_dict["NAME"]
+        # The database is only replaced once the whole dump is read, a
+        # failing download or decryption leaves it untouched
+        temp_path = f"{path}.tmp"
+        try:
+            with open(temp_path, "wb") as db_file:
+                for chunk in chunks:
+                    db_file.write(chunk)
+            if os.path.exists(path):
+                copymode(path, temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
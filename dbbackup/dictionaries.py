@@ -0,0 +1,183 @@
+"""
+Zstandard dictionaries trained from backups and kept in the storage.
+
+Small dumps sharing most of their content, like the databases of many
+tenants with the same schema, compress poorly one by one. A dictionary
+trained from recent backups holds their common content, so each backup
+only stores what differs. Dictionaries are saved in their own directory of
+the storage with a version and their id; the id is written in every
+compressed frame, so restores find the dictionary a backup needs by
+themselves.
+"""
+
+import posixpath
+import re
+import threading
+from io import BytesIO
+
+# Directory of the dictionaries in the storage, listed instead of the backups
+DIRECTORY = "zstd-dictionaries"
+FILENAME_TEMPLATE = "zstd-dictionary-{name}-{version}-{dict_id}.zdict"
+FILENAME_REGEX = re.compile(
+    r"^zstd-dictionary-(?P<name>.+)-(?P<version>\d+)-(?P<dict_id>\d+)\.zdict$"
+)
+# Default size of trained dictionaries, as the zstd command line tool
+DEFAULT_SIZE = 112640
+
+# Dictionaries never change once saved, they are kept by id
+_cache = {}
+_cache_lock = threading.Lock()
+_default_storage = None
+
+
+class DictionaryNotFound(Exception):
+    pass
+
+
+def _get_storage(storage):
+    global _default_storage
+    if storage is None:
+        if _default_storage is None:
+            from .storage import get_storage
+
+            _default_storage = get_storage()
+        storage = _default_storage
+    return storage
+
+
+def _list(storage, refresh=False):
+    # The listing is kept on the storage for the life of the process
+    with _cache_lock:
+        if refresh or not hasattr(storage, "_dictionaries"):
+            try:
+                filenames = storage.list_directory(DIRECTORY)
+            except FileNotFoundError:
+                filenames = []
+            dictionaries = []
+            for filename in filenames:
+                filename = posixpath.basename(filename)
+                match = FILENAME_REGEX.match(filename)
+                if match is None:
+                    continue
+                dictionaries.append(
+                    (
+                        match["name"],
+                        int(match["version"]),
+                        int(match["dict_id"]),
+                        f"{DIRECTORY}/{filename}",
+                    )
+                )
+            storage._dictionaries = sorted(
+                dictionaries, key=lambda dictionary: dictionary[1]
+            )
+        return storage._dictionaries
+
+
+def list_dictionaries(storage=None, name=None, refresh=False):
+    """
+    List dictionaries saved in the storage.
+
+    :param name: Filter by dictionary's name
+    :type name: ``str`` or ``None``
+
+    :param refresh: List the storage again instead of using the listing
+                    kept from a previous call
+    :type refresh: ``bool``
+
+    :returns: Name, version, id and file's name of dictionaries, by version
+    :rtype: ``list`` of ``tuple``
+    """
+    storage = _get_storage(storage)
+    return [
+        dictionary
+        for dictionary in _list(storage, refresh)
+        if name is None or dictionary[0] == name
+    ]
+
+
+def train_dictionary(samples, size=DEFAULT_SIZE):
+    """
+    Train a dictionary from samples of backups, requires ``zstandard``.
+
+    :param samples: Uncompressed samples
+    :type samples: ``list`` of ``bytes``
+
+    :param size: Maximum size of the dictionary in bytes
+    :type size: ``int``
+
+    :returns: Dictionary's content
+    :rtype: ``bytes``
+    """
+    import zstandard
+
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+def save_dictionary(data, name, storage=None):
+    """
+    Save a dictionary in the storage, as the next version of ``name``.
+
+    :returns: File's name of the dictionary
+    :rtype: ``str``
+    """
+    import zstandard
+
+    storage = _get_storage(storage)
+    dict_id = zstandard.ZstdCompressionDict(data).dict_id()
+    versions = [
+        version for _, version, _, _ in list_dictionaries(storage, name, refresh=True)
+    ]
+    filename = FILENAME_TEMPLATE.format(
+        name=name, version=max(versions, default=0) + 1, dict_id=dict_id
+    )
+    filename = f"{DIRECTORY}/{filename}"
+    storage.write_file(BytesIO(data), filename)
+    _list(storage, refresh=True)
+    return filename
+
+
+def _load(storage, filename, dict_id):
+    import zstandard
+
+    with _cache_lock:
+        if dict_id not in _cache:
+            with storage.read_file(filename) as dictionary_file:
+                data = dictionary_file.read()
+            _cache[dict_id] = zstandard.ZstdCompressionDict(data)
+        return _cache[dict_id]
+
+
+def get_latest_dictionary(name, storage=None):
+    """
+    Get the last version of a dictionary.
+
+    :rtype: :class:`zstandard.ZstdCompressionDict`
+
+    :raises: :class:`DictionaryNotFound` if there is no such dictionary
+    """
+    storage = _get_storage(storage)
+    dictionaries = list_dictionaries(storage, name)
+    if not dictionaries:
+        raise DictionaryNotFound(f"There's no dictionary named '{name}'")
+    _, _, dict_id, filename = dictionaries[-1]
+    return _load(storage, filename, dict_id)
+
+
+def get_dictionary_by_id(dict_id, storage=None):
+    """
+    Get the dictionary used to compress a frame, from the id in its header.
+
+    :rtype: :class:`zstandard.ZstdCompressionDict`
+
+    :raises: :class:`DictionaryNotFound` if there is no such dictionary
+    """
+    with _cache_lock:
+        if dict_id in _cache:
+            return _cache[dict_id]
+    storage = _get_storage(storage)
+    # Trained by another process since the storage was listed
+    for refresh in (False, True):
+        for _, _, other_id, filename in list_dictionaries(storage, refresh=refresh):
+            if other_id == dict_id:
+                return _load(storage, filename, dict_id)
+    raise DictionaryNotFound(f"There's no dictionary with id {dict_id}")
@@ -5,11 +5,12 @@ Abstract Command.
 import logging
 import sys
 from optparse import make_option as optparse_make_option
-from shutil import copyfileobj
 
 import django
 from django.core.management.base import BaseCommand, CommandError
 
+from ... import pagecache, settings, stages, streams, utils
+from ...buffers import memory_budget
 from ...storage import StorageError
 
 USELESS_ARGS = ("callback", "callback_args", "callback_kwargs", "metavar")
@@ -58,6 +59,9 @@ class BaseDbBackupCommand(BaseCommand):
 
     verbosity = 1
     quiet = False
+    passphrase = None
+    compress_format = None
+    extra_stages = ()
     logger = logging.getLogger("dbbackup.command")
 
     def __init__(self, *args, **kwargs):
@@ -95,7 +99,25 @@ class BaseDbBackupCommand(BaseCommand):
 
     def write_to_storage(self, file, path):
         self.logger.info("Writing file to %s", path)
-        self.storage.write_file(file, path)
+        self.storage.write_file(file, path, **self._get_catalog_details())
+
+    def _get_catalog_details(self):
+        """Get what the catalog records about a new backup."""
+        return {}
+
+    def _resume_uploads(self, database=None):
+        """
+        Resume the interrupted uploads of this command's backups.
+
+        :returns: Number of uploads resumed
+        :rtype: ``int``
+        """
+        checkpoints = self.storage.list_interrupted_uploads(
+            content_type=self.content_type, database=database
+        )
+        for checkpoint in checkpoints:
+            self.storage.resume_upload(checkpoint)
+        return len(checkpoints)
 
     def read_local_file(self, path):
         """Open file in read mode on local filesystem."""
@@ -104,9 +126,9 @@ class BaseDbBackupCommand(BaseCommand):
     def write_local_file(self, outputfile, path):
         """Write file to the desired path."""
         self.logger.info("Writing file to %s", path)
-        outputfile.seek(0)
-        with open(path, "wb") as fd:
-            copyfileobj(outputfile, fd)
+        if outputfile.seekable():
+            outputfile.seek(0)
+        pagecache.copy_to_path(outputfile, path)
 
     def _get_backup_file(self, database=None, servername=None):
         if self.path:
@@ -131,6 +153,173 @@ class BaseDbBackupCommand(BaseCommand):
             input_file = self.read_from_storage(input_filename)
         return input_filename, input_file
 
+    def _get_backup_stages(self, sample=None, total_size=None):
+        """
+        Get the stages to apply on a new backup: compression, encryption and
+        the ones given with ``--stage``, in this order.
+
+        With the ``auto`` compression format, the compression is chosen by
+        compressing ``sample``, the first bytes of the backup.
+        """
+        stage_list = []
+        native_stage = self._get_native_compression_stage()
+        if native_stage is not None:
+            stage_list.append(native_stage)
+        elif self.compress:
+            name = self._get_compression_stage_name()
+            if name == "auto":
+                stage = stages.choose_compression_stage(sample, total_size)
+                if stage is not None:
+                    stage_list.append(stage)
+            else:
+                stage_list.append(self._get_compression_stage(name))
+        if self.encrypt:
+            stage_list.append(stages.get_stage(settings.ENCRYPTION_FORMAT))
+        stage_list.extend(stages.get_stage(name) for name in self.extra_stages)
+        if any(isinstance(s, stages.DeltaStage) for s in stage_list) and any(
+            s.kind == "encryption" for s in stage_list
+        ):
+            raise CommandError("'delta' compression cannot be used with encryption")
+        return stage_list
+
+    def _get_compression_stage(self, name):
+        if issubclass(stages.get_stage_class(name), stages.DeltaStage):
+            return stages.get_stage(name, base=self._get_delta_base())
+        return stages.get_stage(name)
+
+    def _get_delta_base(self):
+        """
+        Get the latest backup, used as reference by delta compression.
+
+        :returns: Backup's name, ``None`` if there is none
+        :rtype: ``str`` or ``None``
+        """
+        try:
+            return self.storage.get_latest_backup(
+                content_type=self.content_type, servername=self.servername
+            )
+        except StorageError:
+            return None
+
+    def _get_native_compression_stage(self):
+        """
+        Get the stage standing for the compression done while creating the
+        backup, if any, used instead of the compression stage.
+        """
+        return None
+
+    def _is_compression_auto(self):
+        return (
+            self.compress
+            and self._get_compression_stage_name() == "auto"
+            and self._get_native_compression_stage() is None
+        )
+
+    def _sample_file(self, fileobj):
+        """
+        Get the sample of a file used to choose the compression
+        automatically, and the file's size.
+
+        :returns: Sample and size, ``None`` if not needed
+        :rtype: ``bytes``, ``int``
+        """
+        if not self._is_compression_auto():
+            return None, None
+        fileobj.seek(0)
+        sample = fileobj.read(settings.COMPRESSION_SAMPLE_SIZE)
+        total_size = fileobj.seek(0, 2)
+        fileobj.seek(0)
+        return bytes(sample), total_size
+
+    def _sample_chunks(self, chunks):
+        """
+        Get the sample of chunks used to choose the compression
+        automatically, without consuming them.
+
+        :returns: Sample, ``None`` if not needed, and all chunks
+        :rtype: ``bytes``, ``generator``
+        """
+        if not self._is_compression_auto():
+            return None, chunks
+        return streams.peek_chunks(chunks, settings.COMPRESSION_SAMPLE_SIZE)
+
+    def _get_restore_stages(self, filename):
+        """
+        Get the stages to revert on a backup, from the suffix chain of its
+        name. ``--decrypt`` and ``--uncompress`` add encryption and
+        compression stages if the name does not tell about them, given by
+        ``settings.DBBACKUP_ENCRYPTION_FORMAT`` and ``--compress-format``.
+        """
+        stage_list = stages.stages_from_filename(filename, passphrase=self.passphrase)
+        kinds = [stage.kind for stage in stage_list]
+        if self.decrypt and "encryption" not in kinds:
+            stage = stages.get_stage(
+                settings.ENCRYPTION_FORMAT, passphrase=self.passphrase
+            )
+            stage_list.insert(0, stage)
+        if self.uncompress and "compression" not in kinds:
+            name = self._get_compression_stage_name()
+            # Automatically chosen compression is always in the name
+            if name != "auto":
+                stage_list.append(stages.get_stage(name))
+        return stage_list
+
+    def _get_compression_stage_name(self):
+        """
+        Get the compression stage from ``--compress-format`` or
+        ``settings.DBBACKUP_COMPRESSION_FORMAT``.
+        """
+        name = self.compress_format or settings.COMPRESSION_FORMAT
+        if name == "auto":
+            return name
+        try:
+            kind = stages.get_stage_class(name).kind
+        except stages.StageError as err:
+            raise CommandError(err.args[0]) from err
+        if kind != "compression":
+            raise CommandError(f"'{name}' is not a compression format")
+        return name
+
+    def _log_pipeline_stats(self, stats):
+        """
+        Log how long each queue of a streamed backup was full or empty: a
+        stage waiting for room is faster than the next one, a stage waiting
+        for data is faster than the previous one.
+        """
+        for queue_stats in stats:
+            self.logger.debug(
+                "Pipeline %s queue: peak %s in %d chunks, "
+                "producer stalled %.2fs, consumer stalled %.2fs",
+                queue_stats["name"],
+                utils.bytes_to_str(queue_stats["peak_size"]),
+                queue_stats["peak_depth"],
+                queue_stats["put_stall"],
+                queue_stats["get_stall"],
+            )
+
+    def _reset_run_stats(self):
+        memory_budget.reset_peak()
+        pagecache.stats.reset()
+
+    def _log_run_stats(self):
+        """
+        Log the peak memory used by temporary files since the command
+        started, to size the memory budget, and how the page cache was
+        spared.
+        """
+        budget = memory_budget.size
+        self.logger.info(
+            "Peak memory usage of temporary files: %s of %s",
+            utils.bytes_to_str(memory_budget.peak),
+            "unlimited" if budget is None else utils.bytes_to_str(budget),
+        )
+        if pagecache.is_enabled():
+            self.logger.info(
+                "Page cache: %s already cached kept, %s read or written dropped",
+                utils.bytes_to_str(pagecache.stats.kept),
+                utils.bytes_to_str(pagecache.stats.dropped),
+            )
+
     def _cleanup_old_backups(self, database=None, servername=None):
         """
         Cleanup old backups, keeping the number of backups specified by
@@ -4,7 +4,7 @@ Command for backup database.
 
 from django.core.management.base import CommandError
 
-from ... import settings, utils
+from ... import settings, stages, streams, utils
 from ...db.base import get_connector
 from ...storage import StorageError, get_storage
 from ._base import BaseDbBackupCommand, make_option
@@ -13,6 +13,7 @@ from ._base import BaseDbBackupCommand, make_option
 class Command(BaseDbBackupCommand):
     help = "Backup a database, encrypt and/or compress."
     content_type = "db"
+    stream = False
 
     option_list = BaseDbBackupCommand.option_list + (
         make_option(
@@ -41,6 +42,12 @@ class Command(BaseDbBackupCommand):
             default=False,
             help="Compress the backup files",
         ),
+        make_option(
+            "--compress-format",
+            default=None,
+            help="Compression format: gzip, zstd, lz4, xz, delta or auto. "
+            "Implies --compress.",
+        ),
         make_option(
             "-e",
             "--encrypt",
@@ -67,27 +74,56 @@ class Command(BaseDbBackupCommand):
             default=[],
             help="Specify schema(s) to backup. Can be used multiple times.",
         ),
+        make_option(
+            "--stream",
+            action="store_true",
+            default=False,
+            help="Stream the dump through compression and encryption into "
+            "storage without intermediate temporary files",
+        ),
+        make_option(
+            "--stage",
+            action="append",
+            default=[],
+            dest="extra_stages",
+            help="Name of a transform stage to apply after compression and "
+            "encryption. Can be used multiple times.",
+        ),
+        make_option(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="Resume interrupted uploads of backups instead of making new "
+            "ones, if there are any",
+        ),
     )
 
+    resume = False
+
     @utils.email_uncaught_exception
     def handle(self, **options):
         self.verbosity = options.get("verbosity")
         self.quiet = options.get("quiet")
         self._set_logger_level()
+        self._reset_run_stats()
 
         self.clean = options.get("clean")
 
         self.servername = options.get("servername")
-        self.compress = options.get("compress")
+        self.compress_format = options.get("compress_format")
+        self.compress = options.get("compress") or bool(self.compress_format)
         self.encrypt = options.get("encrypt")
+        self.extra_stages = options.get("extra_stages") or []
 
         self.filename = options.get("output_filename")
         self.path = options.get("output_path")
         self.exclude_tables = options.get("exclude_tables")
         self.storage = get_storage()
         self.schemas = options.get("schema")
+        self.stream = options.get("stream") or settings.STREAMING
 
         self.database = options.get("database") or ""
+        self.resume = options.get("resume")
 
         for database_key in self._get_database_keys():
             self.connector = get_connector(database_key)
@@ -97,15 +133,40 @@ class Command(BaseDbBackupCommand):
                 )
             database = self.connector.settings
             try:
+                if self.resume and self._resume_uploads(
+                    database=self.connector.database_name
+                ):
+                    continue
                 self._save_new_backup(database)
                 if self.clean:
                     self._cleanup_old_backups(database=database_key)
             except StorageError as err:
                 raise CommandError(err) from err
+        self._log_run_stats()
+
+    def _get_catalog_details(self):
+        return {
+            "database": self.connector.database_name,
+            "servername": self.servername or settings.HOSTNAME,
+            "content_type": self.content_type,
+        }
 
     def _get_database_keys(self):
         return self.database.split(",") if self.database else settings.DATABASES
 
+    def _get_delta_base(self):
+        try:
+            return self.storage.get_latest_backup(
+                content_type=self.content_type,
+                database=self.connector.database_name,
+                servername=self.servername,
+            )
+        except StorageError:
+            return None
+
+    def _get_native_compression_stage(self):
+        return self.connector.get_native_compression_stage()
+
     def _save_new_backup(self, database):
         """
         Save a new backup file.
@@ -117,16 +178,24 @@ class Command(BaseDbBackupCommand):
         if self.schemas:
             self.connector.schemas = self.schemas
 
+        if self.stream:
+            self._save_new_backup_stream(filename)
+            return
+
         outputfile = self.connector.create_dump()
 
         # Apply trans
-        if self.compress:
-            compressed_file, filename = utils.compress_file(outputfile, filename)
-            outputfile = compressed_file
-
-        if self.encrypt:
-            encrypted_file, filename = utils.encrypt_file(outputfile, filename)
-            outputfile = encrypted_file
+        stage_list = self._get_backup_stages(*self._sample_file(outputfile))
+        # Compression done by the dump tool keeps data as is
+        if any(
+            not isinstance(stage, stages.NativeCompressionStage) for stage in stage_list
+        ):
+            chunks, filename = stages.apply_stages(
+                streams.iter_file(outputfile), filename, stage_list
+            )
+            outputfile = streams.spool_chunks(chunks)
+        else:
+            filename = stages.get_applied_filename(filename, stage_list)
 
         # Set file name
         filename = self.filename or filename
@@ -140,3 +209,32 @@ class Command(BaseDbBackupCommand):
 
         else:
             self.write_local_file(outputfile, self.path)
+
+    def _save_new_backup_stream(self, filename):
+        """
+        Save a new backup file, streaming the dump into the storage. The
+        dump, the stages and the storage run in their own threads.
+        """
+        sample, chunks = self._sample_chunks(self.connector.stream_dump())
+        stage_list = self._get_backup_stages(sample)
+
+        # Set file name
+        output_filename = self.filename or stages.get_applied_filename(
+            filename, stage_list
+        )
+
+        def transform(chunks):
+            chunks, _ = stages.apply_stages(chunks, filename, stage_list)
+            return chunks
+
+        def store(outputfile):
+            outputfile.name = output_filename
+            if self.path is None:
+                self.write_to_storage(outputfile, output_filename)
+            else:
+                self.write_local_file(outputfile, self.path)
+            self.logger.debug("Backup size: %s", utils.bytes_to_str(outputfile.tell()))
+
+        # Store backup
+        stats = streams.run_pipeline(chunks, transform, store)
+        self._log_pipeline_stats(stats)
@@ -6,7 +6,8 @@ from django.conf import settings
 from django.core.management.base import CommandError
 from django.db import connection
 
-from ... import utils
+from ... import settings as dbbackup_settings
+from ... import stages, streams, utils
 from ...db.base import get_connector
 from ...storage import StorageError, get_storage
 from ._base import BaseDbBackupCommand, make_option
@@ -17,6 +18,7 @@ class Command(BaseDbBackupCommand):
     content_type = "db"
     no_drop = False
     pg_options = ""
+    stream = False
 
     option_list = BaseDbBackupCommand.option_list + (
         make_option("-d", "--database", help="Database to restore"),
@@ -45,7 +47,13 @@ class Command(BaseDbBackupCommand):
             "--uncompress",
             action="store_true",
             default=False,
-            help="Uncompress gzip data before restoring",
+            help="Uncompress data before restoring",
+        ),
+        make_option(
+            "--compress-format",
+            default=None,
+            help="Compression format used by --uncompress if the backup's name "
+            "does not tell it: gzip, zstd, lz4 or xz.",
         ),
         make_option(
             "-n",
@@ -67,6 +75,13 @@ class Command(BaseDbBackupCommand):
             default="",
             help="Additional pg_restore options, e.g. '--if-exists --no-owner'. Use quotes.",
         ),
+        make_option(
+            "--stream",
+            action="store_true",
+            default=False,
+            help="Stream the backup from storage through decryption and "
+            "decompression into the restore command",
+        ),
     )
 
     def handle(self, *args, **options):
@@ -74,6 +89,7 @@ class Command(BaseDbBackupCommand):
         self.verbosity = int(options.get("verbosity"))
         self.quiet = options.get("quiet")
         self._set_logger_level()
+        self._reset_run_stats()
 
         try:
             connection.close()
@@ -82,6 +98,7 @@ class Command(BaseDbBackupCommand):
             self.servername = options.get("servername")
             self.decrypt = options.get("decrypt")
             self.uncompress = options.get("uncompress")
+            self.compress_format = options.get("compress_format")
             self.passphrase = options.get("passphrase")
             self.interactive = options.get("interactive")
             self.input_database_name = options.get("database")
@@ -92,7 +109,9 @@ class Command(BaseDbBackupCommand):
             self.no_drop = options.get("no_drop")
             self.pg_options = options.get("pg_options", "")
             self.schemas = options.get("schema")
+            self.stream = options.get("stream") or dbbackup_settings.STREAMING
             self._restore_backup()
+            self._log_run_stats()
         except StorageError as err:
             raise CommandError(err) from err
 
@@ -127,27 +146,52 @@ class Command(BaseDbBackupCommand):
 
         self.logger.info(f"Restoring: {input_filename}")
 
-        if self.decrypt:
-            unencrypted_file, input_filename = utils.unencrypt_file(
-                input_file, input_filename, self.passphrase
-            )
-            input_file.close()
-            input_file = unencrypted_file
-        if self.uncompress:
-            uncompressed_file, input_filename = utils.uncompress_file(
-                input_file, input_filename
+        if self.stream:
+            chunks = self._get_backup_stream(input_filename, input_file)
+        else:
+            input_file = self._get_backup_tempfile(input_filename, input_file)
+
+        self.connector = get_connector(self.database_name)
+        if self.schemas:
+            self.connector.schemas = self.schemas
+        self.connector.drop = not self.no_drop
+        self.connector.pg_options = self.pg_options
+        self.connector.restore_filename = input_filename
+        if self.stream:
+            self.connector.restore_dump_stream(chunks)
+        else:
+            self.connector.restore_dump(input_file)
+
+    def _get_backup_tempfile(self, input_filename, input_file):
+        """Revert the stages of the backup into a temporary file."""
+        stage_list = self._get_restore_stages(input_filename)
+        if stage_list:
+            chunks, input_filename = stages.revert_stages(
+                streams.iter_file(input_file), input_filename, stage_list
             )
+            restored_file = streams.spool_chunks(chunks)
             input_file.close()
-            input_file = uncompressed_file
+            input_file = restored_file
 
         self.logger.info("Restore tempfile created: %s", utils.handle_size(input_file))
         if self.interactive:
             self._ask_confirmation()
 
         input_file.seek(0)
-        self.connector = get_connector(self.database_name)
-        if self.schemas:
-            self.connector.schemas = self.schemas
-        self.connector.drop = not self.no_drop
-        self.connector.pg_options = self.pg_options
-        self.connector.restore_dump(input_file)
+        return input_file
+
+    def _get_backup_stream(self, input_filename, input_file):
+        """
+        Get the backup as chunks, with its stages reverted while the
+        connector consumes them.
+        """
+        chunks, input_filename = stages.revert_stages(
+            streams.iter_file(input_file),
+            input_filename,
+            self._get_restore_stages(input_filename),
+        )
+
+        if self.interactive:
+            self._ask_confirmation()
+
+        return chunks
@@ -7,15 +7,22 @@ import tarfile
 
 from django.core.management.base import CommandError
 
-from ... import utils
+from ... import pagecache, settings, stages, streams, utils
 from ...storage import StorageError, get_storage, get_storage_class
 from ._base import BaseDbBackupCommand, make_option
 
+# PAX headers of media files compressed with --compress-members
+MEMBER_COMPRESSION_HEADER = "DBBACKUP.compression"
+MEMBER_SIZE_HEADER = "DBBACKUP.size"
+# Bytes of media files compressed to tell if they are worth compressing
+MEMBER_SAMPLE_SIZE = 64 * 1024
+
 
 class Command(BaseDbBackupCommand):
     help = """Backup media files, gather all in a tarball and encrypt or
     compress."""
     content_type = "media"
+    stream = False
 
     option_list = BaseDbBackupCommand.option_list + (
         make_option(
@@ -37,6 +44,12 @@ class Command(BaseDbBackupCommand):
             action="store_true",
             default=False,
         ),
+        make_option(
+            "--compress-format",
+            default=None,
+            help="Compression format: gzip, zstd, lz4, xz, delta or auto. "
+            "Implies --compress.",
+        ),
         make_option(
             "-e",
             "--encrypt",
@@ -53,30 +66,79 @@ class Command(BaseDbBackupCommand):
             default=None,
             help="Specify where to store on local filesystem",
         ),
+        make_option(
+            "--stage",
+            action="append",
+            default=[],
+            dest="extra_stages",
+            help="Name of a transform stage to apply after compression and "
+            "encryption. Can be used multiple times.",
+        ),
+        make_option(
+            "--stream",
+            action="store_true",
+            default=False,
+            help="Stream the archive through compression and encryption into "
+            "storage without intermediate temporary files",
+        ),
+        make_option(
+            "--compress-members",
+            action="store_true",
+            default=False,
+            help="Compress each media file on its own instead of the archive, "
+            "storing already compressed files as is",
+        ),
+        make_option(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="Resume interrupted uploads of backups instead of making new "
+            "ones, if there are any",
+        ),
     )
 
+    compress_members = False
+    resume = False
+
     @utils.email_uncaught_exception
     def handle(self, **options):
         self.verbosity = options.get("verbosity")
         self.quiet = options.get("quiet")
         self._set_logger_level()
+        self._reset_run_stats()
 
         self.encrypt = options.get("encrypt", False)
-        self.compress = options.get("compress", False)
+        self.compress_format = options.get("compress_format")
+        self.compress = options.get("compress", False) or bool(self.compress_format)
+        self.extra_stages = options.get("extra_stages") or []
         self.servername = options.get("servername")
 
         self.filename = options.get("output_filename")
         self.path = options.get("output_path")
+        self.stream = options.get("stream") or settings.STREAMING
+        self.compress_members = options.get("compress_members")
+        self.resume = options.get("resume")
+        if self.compress_members:
+            # Media files are compressed in the archive
+            self.compress = False
         try:
             self.media_storage = get_storage_class()()
             self.storage = get_storage()
-            self.backup_mediafiles()
+            if not (self.resume and self._resume_uploads()):
+                self.backup_mediafiles()
             if options.get("clean"):
                 self._cleanup_old_backups(servername=self.servername)
+            self._log_run_stats()
 
         except StorageError as err:
             raise CommandError(err) from err
 
+    def _get_catalog_details(self):
+        return {
+            "servername": self.servername or settings.HOSTNAME,
+            "content_type": self.content_type,
+        }
+
     def _explore_storage(self):
         """Generator of all files contained in media storage."""
         path = ""
@@ -88,38 +150,108 @@ class Command(BaseDbBackupCommand):
                 yield os.path.join(path, media_filename)
             dirs.extend([os.path.join(path, subdir) for subdir in subdirs])
 
-    def _create_tar(self, name):
-        """Create TAR file."""
-        fileobj = utils.create_spooled_temporary_file()
-        mode = "w:gz" if self.compress else "w"
-        tar_file = tarfile.open(name=name, fileobj=fileobj, mode=mode)
+    def _iter_tar(self):
+        """
+        Generate a TAR archive of all media files by chunks, reading one
+        file at a time.
+        """
+        offset = 0
         for media_filename in self._explore_storage():
             tarinfo = tarfile.TarInfo(media_filename)
-            media_file = self.media_storage.open(media_filename)
-            tarinfo.size = len(media_file)
-            tar_file.addfile(tarinfo, media_file)
-        # Close the TAR for writing
-        tar_file.close()
-        return fileobj
+            with self.media_storage.open(media_filename) as media_file:
+                tarinfo.size = len(media_file)
+                compressed = None
+                if self.compress_members:
+                    compressed = self._compress_member(tarinfo, media_file)
+                header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT)
+                yield header
+                offset += len(header)
+                if compressed is None:
+                    data = pagecache.iter_file(media_file)
+                else:
+                    data = streams.iter_file(compressed)
+                # A file changed since its size was read would misalign the
+                # archive, only this size is copied
+                for chunk in streams.limit_chunks(data, tarinfo.size):
+                    yield chunk
+                    offset += len(chunk)
+                if compressed is not None:
+                    compressed.close()
+            remainder = tarinfo.size % tarfile.BLOCKSIZE
+            if remainder:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+                offset += tarfile.BLOCKSIZE - remainder
+        # End of archive, padded to a full record as tarfile does
+        end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        offset += len(end)
+        remainder = offset % tarfile.RECORDSIZE
+        if remainder:
+            end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+        yield end
+
+    def _get_member_stage_name(self):
+        name = self._get_compression_stage_name()
+        if name == "auto" or issubclass(
+            stages.get_stage_class(name), stages.DeltaStage
+        ):
+            raise CommandError(f"'{name}' cannot compress media files one by one")
+        return name
+
+    def _compress_member(self, tarinfo, media_file):
+        """
+        Compress a media file in the archive, unless it is not worth it. The
+        compression stage and the original size are written in the member's
+        PAX headers for ``mediarestore``.
+
+        :returns: Compressed file, ``None`` if stored as is
+        :rtype: :class:`dbbackup.buffers.SpillBuffer` or ``None``
+        """
+        sample = media_file.read(MEMBER_SAMPLE_SIZE)
+        media_file.seek(0)
+        if not stages.is_compressible(tarinfo.name, sample):
+            self.logger.debug("%s stored as is", tarinfo.name)
+            return None
+        stage_name = self._get_member_stage_name()
+        chunks, _ = stages.get_stage(stage_name).apply(
+            pagecache.iter_file(media_file), tarinfo.name
+        )
+        compressed = streams.spool_chunks(chunks)
+        tarinfo.pax_headers = {
+            MEMBER_COMPRESSION_HEADER: stage_name,
+            MEMBER_SIZE_HEADER: str(tarinfo.size),
+        }
+        tarinfo.size = compressed.seek(0, os.SEEK_END)
+        compressed.seek(0)
+        return compressed
+
+    def _create_tar(self, name):
+        """Create TAR file."""
+        return streams.spool_chunks(self._iter_tar())
 
     def backup_mediafiles(self):
         """
         Create backup file and write it to storage.
         """
-        # Check for filename option
-        if self.filename:
-            filename = self.filename
-        else:
-            extension = f"tar{'.gz' if self.compress else ''}"
-            filename = utils.filename_generate(
-                extension, servername=self.servername, content_type=self.content_type
-            )
+        filename = utils.filename_generate(
+            "tar", servername=self.servername, content_type=self.content_type
+        )
+
+        if self.stream:
+            self._backup_mediafiles_stream(filename)
+            return
 
         tarball = self._create_tar(filename)
         # Apply trans
-        if self.encrypt:
-            encrypted_file = utils.encrypt_file(tarball, filename)
-            tarball, filename = encrypted_file
+        stage_list = self._get_backup_stages(*self._sample_file(tarball))
+        if stage_list:
+            tarball.seek(0)
+            chunks, filename = stages.apply_stages(
+                streams.iter_file(tarball), filename, stage_list
+            )
+            tarball = streams.spool_chunks(chunks)
+
+        # Check for filename option
+        filename = self.filename or filename
 
         self.logger.debug("Backup size: %s", utils.handle_size(tarball))
         # Store backup
@@ -128,3 +260,32 @@ class Command(BaseDbBackupCommand):
             self.write_to_storage(tarball, filename)
         else:
             self.write_local_file(tarball, self.path)
+
+    def _backup_mediafiles_stream(self, filename):
+        """
+        Stream the archive into the storage. Reading media files, the
+        stages and the storage run in their own threads.
+        """
+        sample, chunks = self._sample_chunks(self._iter_tar())
+        stage_list = self._get_backup_stages(sample)
+
+        # Check for filename option
+        output_filename = self.filename or stages.get_applied_filename(
+            filename, stage_list
+        )
+
+        def transform(chunks):
+            chunks, _ = stages.apply_stages(chunks, filename, stage_list)
+            return chunks
+
+        def store(tarball):
+            tarball.name = output_filename
+            if self.path is None:
+                self.write_to_storage(tarball, output_filename)
+            else:
+                self.write_local_file(tarball, self.path)
+            self.logger.debug("Backup size: %s", utils.bytes_to_str(tarball.tell()))
+
+        # Store backup
+        stats = streams.run_pipeline(chunks, transform, store)
+        self._log_pipeline_stats(stats)
@@ -4,9 +4,10 @@ Restore media files.
 
 import tarfile
 
-from ... import utils
+from ... import stages, streams, utils
 from ...storage import get_storage, get_storage_class
 from ._base import BaseDbBackupCommand, make_option
+from .mediabackup import MEMBER_COMPRESSION_HEADER
 
 
 class Command(BaseDbBackupCommand):
@@ -44,33 +45,52 @@ class Command(BaseDbBackupCommand):
             "-z",
             "--uncompress",
             action="store_true",
-            help="Uncompress gzip data before restoring",
+            help="Uncompress data before restoring",
+        ),
+        make_option(
+            "--compress-format",
+            default=None,
+            help="Compression format used by --uncompress if the backup's name "
+            "does not tell it: gzip, zstd, lz4 or xz.",
         ),
         make_option(
             "-r", "--replace", help="Replace existing files", action="store_true"
         ),
+        make_option(
+            "--path",
+            action="append",
+            dest="paths",
+            help="Restore only the media files under this path, can be given "
+            "several times",
+        ),
     )
 
+    paths = None
+
     def handle(self, *args, **options):
         """Django command handler."""
         self.verbosity = int(options.get("verbosity"))
         self.quiet = options.get("quiet")
         self._set_logger_level()
+        self._reset_run_stats()
 
         self.servername = options.get("servername")
         self.decrypt = options.get("decrypt")
         self.uncompress = options.get("uncompress")
+        self.compress_format = options.get("compress_format")
 
         self.filename = options.get("input_filename")
         self.path = options.get("input_path")
 
         self.replace = options.get("replace")
+        self.paths = options.get("paths")
         self.passphrase = options.get("passphrase")
         self.interactive = options.get("interactive")
 
         self.storage = get_storage()
         self.media_storage = get_storage_class()()
         self._restore_backup()
+        self._log_run_stats()
 
     def _upload_file(self, name, media_file):
         if self.media_storage.exists(name):
@@ -81,28 +101,61 @@ class Command(BaseDbBackupCommand):
         self.media_storage.save(name, media_file)
         self.logger.info("%s uploaded", name)
 
+    def _open_seekable(self, input_file, stage_list):
+        """
+        Open a backup only encrypted or compressed in seekable formats, so
+        only the parts holding the selected files are read, decrypted and
+        uncompressed.
+
+        :returns: Seekable restored file, ``None`` if not possible
+        """
+        seekable_file = input_file
+        for stage in stage_list:
+            if not hasattr(stage, "open_seekable"):
+                return None
+            seekable_file = stage.open_seekable(seekable_file)
+            if seekable_file is None:
+                return None
+            self.logger.debug(
+                "Reading %d %s frames on demand", len(seekable_file.entries), stage.kind
+            )
+        return seekable_file if stage_list else None
+
+    def _is_selected(self, name):
+        if not self.paths:
+            return True
+        return any(
+            name == path.strip("/") or name.startswith(path.strip("/") + "/")
+            for path in self.paths
+        )
+
     def _restore_backup(self):
         self.logger.info("Restoring backup for media files")
         input_filename, input_file = self._get_backup_file(servername=self.servername)
         self.logger.info("Restoring: %s", input_filename)
 
-        if self.decrypt:
-            unencrypted_file, input_filename = utils.unencrypt_file(
-                input_file, input_filename, self.passphrase
+        stage_list = self._get_restore_stages(input_filename)
+        seekable_file = None
+        if self.paths:
+            seekable_file = self._open_seekable(input_file, stage_list)
+        if seekable_file is not None:
+            input_file = seekable_file
+        elif stage_list:
+            # Trying to open it for random access may have read some of it
+            input_file.seek(0)
+            chunks, input_filename = stages.revert_stages(
+                streams.iter_file(input_file), input_filename, stage_list
             )
+            restored_file = streams.spool_chunks(chunks)
             input_file.close()
-            input_file = unencrypted_file
+            input_file = restored_file
 
         self.logger.debug("Backup size: %s", utils.handle_size(input_file))
         if self.interactive:
             self._ask_confirmation()
 
         input_file.seek(0)
-        tar_file = (
-            tarfile.open(fileobj=input_file, mode="r:gz")
-            if self.uncompress
-            else tarfile.open(fileobj=input_file, mode="r:")
-        )
+        tar_file = tarfile.open(fileobj=input_file, mode="r:")
         # Restore file 1 by 1
         for media_file_info in tar_file:
             if media_file_info.path == "media":
@@ -111,4 +164,12 @@ class Command(BaseDbBackupCommand):
             if media_file is None:
                 continue  # Skip directories
             name = media_file_info.path.replace("media/", "")
+            if not self._is_selected(name):
+                continue
+            stage_name = media_file_info.pax_headers.get(MEMBER_COMPRESSION_HEADER)
+            if stage_name:
+                chunks, _ = stages.get_stage(stage_name).revert(
+                    streams.iter_file(media_file), name
+                )
+                media_file = streams.spool_chunks(chunks)
             self._upload_file(name, media_file)
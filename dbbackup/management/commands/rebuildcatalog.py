@@ -0,0 +1,64 @@
+"""
+Rebuild the catalog of backups from the storage's listing.
+"""
+
+from django.core.management.base import CommandError
+
+from ... import catalog, settings, streams, utils
+from ...storage import get_storage
+from ._base import BaseDbBackupCommand, make_option
+
+
+class Command(BaseDbBackupCommand):
+    help = """Rebuild the catalog of backups from a listing of the storage,
+    for backups made before the catalog or by other tools. Database and
+    server names of backups are not known from their names and are left
+    empty."""
+
+    option_list = (
+        make_option(
+            "--checksum",
+            action="store_true",
+            default=False,
+            help="Read every backup to record its checksum",
+        ),
+        make_option(
+            "--threads",
+            type=int,
+            default=8,
+            help="Number of backups read at the same time",
+        ),
+    )
+
+    checksum = False
+
+    @utils.email_uncaught_exception
+    def handle(self, **options):
+        self.verbosity = options.get("verbosity")
+        self.quiet = options.get("quiet")
+        self._set_logger_level()
+
+        self.checksum = options.get("checksum")
+        self.threads = options.get("threads")
+        if not settings.CATALOG_PATH:
+            raise CommandError("There's no catalog, set 'DBBACKUP_CATALOG_PATH'.")
+        self.storage = get_storage()
+
+        filenames = sorted(
+            f for f in self.storage.list_directory() if catalog.is_backup_filename(f)
+        )
+        self.logger.info("Cataloging %d backups", len(filenames))
+        entries = list(
+            streams.map_ordered(self._build_entry, filenames, max(self.threads, 1))
+        )
+        self.storage.get_catalog().rebuild(entries)
+        self.logger.info("Catalog rebuilt")
+
+    def _build_entry(self, filename):
+        size = checksum = None
+        if self.checksum:
+            with self.storage.read_file(filename) as input_file:
+                size, checksum = catalog.get_digest(input_file)
+        else:
+            size = self.storage.storage.size(filename)
+        return catalog.build_entry(filename, size, checksum)
@@ -0,0 +1,137 @@
+"""
+Rewrap the data keys of encrypted backups for new recipients.
+"""
+
+from io import BytesIO
+
+from django.core.management.base import CommandError
+
+from ... import aead, stages, streams, utils
+from ...storage import get_storage
+from ._base import BaseDbBackupCommand, make_option
+
+
+class Command(BaseDbBackupCommand):
+    help = """Rewrap the data key of backups encrypted by the 'aead' stage for
+    its current 'RECIPIENTS', unwrapping it with its 'IDENTITIES'. Only small
+    envelope files are written next to the backups, which are not changed."""
+
+    option_list = (
+        make_option("-d", "--database", help="Only rewrap this database's backups"),
+        make_option("-s", "--servername", help="Only rewrap this server's backups"),
+        make_option(
+            "-c",
+            "--content-type",
+            choices=("db", "media"),
+            help="Only rewrap database or media backups",
+        ),
+        make_option(
+            "-p", "--passphrase", help="Passphrase of the identities' private keys"
+        ),
+        make_option(
+            "--threads",
+            type=int,
+            default=8,
+            help="Number of backups rewrapped at the same time",
+        ),
+        make_option(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="List the backups to rewrap without writing anything",
+        ),
+    )
+
+    database = None
+    servername = None
+    content_type = None
+    dry_run = False
+
+    @utils.email_uncaught_exception
+    def handle(self, **options):
+        self.verbosity = options.get("verbosity")
+        self.quiet = options.get("quiet")
+        self._set_logger_level()
+
+        self.database = options.get("database")
+        self.servername = options.get("servername")
+        self.content_type = options.get("content_type")
+        self.passphrase = options.get("passphrase")
+        self.threads = options.get("threads")
+        self.dry_run = options.get("dry_run")
+        self.storage = get_storage()
+
+        stage = stages.get_stage("aead", passphrase=self.passphrase)
+        try:
+            self.public_keys = stage.get_public_keys()
+            self.private_keys = stage.get_private_keys()
+        except (stages.StageError, utils.DecryptionError, ValueError) as err:
+            raise CommandError(f"Cannot load keys: {err}") from err
+        if not self.public_keys:
+            raise CommandError("There's no recipient, set 'RECIPIENTS'.")
+
+        filenames = self._get_filenames()
+        self.logger.info("Rewrapping %d backups", len(filenames))
+        errors = 0
+        rewrapped = streams.map_ordered(
+            self._rewrap_safely, filenames, max(self.threads, 1)
+        )
+        for filename, error in zip(filenames, rewrapped):
+            if error is not None:
+                errors += 1
+                self.logger.error("%s: %s", filename, error)
+        if errors:
+            raise CommandError(f"{errors} backups could not be rewrapped.")
+
+    def _get_filenames(self):
+        """List backups whose outermost stage is ``aead``."""
+        filenames = self.storage.list_backups(
+            encrypted=True,
+            content_type=self.content_type,
+            database=self.database,
+            servername=self.servername,
+        )
+        extension = f".{stages.AeadStage.extension}"
+        return sorted(f for f in filenames if f.endswith(extension))
+
+    def _rewrap_safely(self, filename):
+        try:
+            self._rewrap(filename)
+        except Exception as err:
+            return err
+        return None
+
+    def _rewrap(self, filename):
+        """
+        Write the sidecar envelope of a backup, from its current sidecar or
+        the envelope in the backup's header.
+
+        Storages do not overwrite nor rename files, so a current sidecar is
+        replaced by writing the new one under another name, then deleting
+        and writing it again. A sidecar is always there if one was.
+        """
+        sidecar_filename = aead.get_sidecar_filename(filename)
+        new_filename = aead.get_sidecar_filename(filename, new=True)
+        exists = self.storage.storage.exists
+        # Left by a rewrap stopped after deleting the current sidecar
+        source = next((f for f in (sidecar_filename, new_filename) if exists(f)), None)
+        if source is not None:
+            with self.storage.read_file(source) as sidecar_file:
+                envelope = aead.parse_sidecar(sidecar_file.read())
+        else:
+            with self.storage.read_file(filename) as input_file:
+                _, envelope = aead.read_header(input_file)
+        envelope = aead.rewrap_envelope(envelope, self.private_keys, self.public_keys)
+        if self.dry_run:
+            self.logger.info("Would write %s", sidecar_filename)
+            return
+        data = aead.build_sidecar(envelope)
+        if source == sidecar_filename:
+            if exists(new_filename):
+                self.storage.delete_file(new_filename)
+            self.storage.write_file(BytesIO(data), new_filename)
+            self.storage.delete_file(sidecar_filename)
+        self.storage.write_file(BytesIO(data), sidecar_filename)
+        if exists(new_filename):
+            self.storage.delete_file(new_filename)
+        self.logger.info("Rewrapped %s", filename)
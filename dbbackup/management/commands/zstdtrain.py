@@ -0,0 +1,100 @@
+"""
+Train a Zstandard dictionary from recent database backups.
+"""
+
+from django.core.management.base import CommandError
+
+from ... import dictionaries, stages, streams, utils
+from ...storage import get_storage
+from ._base import BaseDbBackupCommand, make_option
+
+
+class Command(BaseDbBackupCommand):
+    help = """Train a Zstandard dictionary from recent database backups and
+    save it in the storage, for the 'DICTIONARY' option of the zstd stage."""
+    content_type = "db"
+
+    option_list = (
+        make_option(
+            "-n",
+            "--name",
+            default="default",
+            help="Name of the dictionary, a new version is saved",
+        ),
+        make_option("-d", "--database", help="Train from this database's backups"),
+        make_option("-s", "--servername", help="Train from this server's backups"),
+        make_option(
+            "--count",
+            type=int,
+            default=100,
+            help="Number of recent backups used",
+        ),
+        make_option(
+            "--size",
+            type=int,
+            default=dictionaries.DEFAULT_SIZE,
+            help="Maximum size of the dictionary in bytes",
+        ),
+        make_option(
+            "--sample-size",
+            type=int,
+            default=1024 * 1024,
+            help="Bytes read from the start of each backup",
+        ),
+    )
+
+    database = None
+    servername = None
+
+    @utils.email_uncaught_exception
+    def handle(self, **options):
+        self.verbosity = options.get("verbosity")
+        self.quiet = options.get("quiet")
+        self._set_logger_level()
+
+        self.name = options.get("name")
+        self.database = options.get("database")
+        self.servername = options.get("servername")
+        self.count = options.get("count")
+        self.size = options.get("size")
+        self.sample_size = options.get("sample_size")
+        self.storage = get_storage()
+
+        samples = self._get_samples()
+        if not samples:
+            raise CommandError("There's no backup to train from.")
+        self.logger.info("Training from %d backups", len(samples))
+        try:
+            data = dictionaries.train_dictionary(samples, self.size)
+        except Exception as err:
+            raise CommandError(f"Training failed: {err}") from err
+        filename = dictionaries.save_dictionary(data, self.name, self.storage)
+        self.logger.info("Dictionary saved: %s", filename)
+
+    def _get_samples(self):
+        """
+        Read the start of the most recent backups, uncompressed. Encrypted
+        backups are not used.
+        """
+        filenames = self.storage.list_backups(
+            encrypted=False,
+            content_type=self.content_type,
+            database=self.database,
+            servername=self.servername,
+        )
+        filenames = sorted(filenames, key=utils.filename_to_date, reverse=True)
+        samples = []
+        for filename in filenames[: self.count]:
+            self.logger.debug("Reading %s", filename)
+            input_file = self.storage.read_file(filename)
+            try:
+                chunks, _ = stages.revert_stages(
+                    streams.iter_file(input_file),
+                    filename,
+                    stages.stages_from_filename(filename),
+                )
+                sample, _ = streams.peek_chunks(chunks, self.sample_size)
+            finally:
+                input_file.close()
+            samples.append(sample)
+        return samples
@@ -0,0 +1,756 @@
+"""
+Multipart transfers, sending or fetching parts of a backup in parallel.
+
+Storages uploading a file sequentially are limited to one connection,
+which caps the throughput over high-latency links. Backends with a
+multipart API get an uploader, found from their class in
+:data:`UPLOADER_MAPPING`, which uploads parts concurrently and assembles
+them into the final file. Other storages keep using ``save()``.
+
+Failed parts are retried with an exponential backoff. With
+``settings.DBBACKUP_UPLOAD_CHECKPOINT_DIR``, the backup is kept in a
+checkpoint before the upload starts, and uploaded parts are recorded in
+it, so if the upload fails or the process is killed, a later run resumes
+the upload from the parts missing.
+
+Backends able to read byte ranges get a downloader, from
+:data:`DOWNLOADER_MAPPING`, whose :class:`RangedReader` fetches the next
+ranges of a backup while the previous ones are read.
+"""
+
+import functools
+import glob
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+from . import pagecache, settings, streams
+
+logger = logging.getLogger("dbbackup.storage")
+
+# Longest wait between two attempts, in seconds
+MAX_RETRY_DELAY = 60
+# Times the parts of a stream of unknown size double, spread over the
+# number of parts a storage allows
+PART_SIZE_STEPS = 10
+
+UPLOADER_MAPPING = {
+    "storages.backends.s3.S3Storage": "dbbackup.multipart.S3MultipartUploader",
+    "storages.backends.s3boto3.S3Boto3Storage": (
+        "dbbackup.multipart.S3MultipartUploader"
+    ),
+}
+
+DOWNLOADER_MAPPING = {
+    "storages.backends.s3.S3Storage": "dbbackup.multipart.S3RangedDownloader",
+    "storages.backends.s3boto3.S3Boto3Storage": (
+        "dbbackup.multipart.S3RangedDownloader"
+    ),
+}
+
+if settings.CUSTOM_UPLOADER_MAPPING:
+    UPLOADER_MAPPING.update(settings.CUSTOM_UPLOADER_MAPPING)
+if settings.CUSTOM_DOWNLOADER_MAPPING:
+    DOWNLOADER_MAPPING.update(settings.CUSTOM_DOWNLOADER_MAPPING)
+
+
+def _get_from_mapping(storage, mapping):
+    for cls in type(storage).__mro__:
+        path = mapping.get(f"{cls.__module__}.{cls.__qualname__}")
+        if path is None:
+            continue
+        module_path, class_name = path.rsplit(".", 1)
+        return getattr(import_module(module_path), class_name)(storage)
+    return None
+
+
+def get_uploader(storage):
+    """
+    Get the multipart uploader of a Django storage, from the first of its
+    classes found in :data:`UPLOADER_MAPPING`.
+
+    :param storage: Django storage
+    :type storage: :class:`django.core.files.storage.Storage`
+
+    :returns: Uploader, ``None`` if the storage has none
+    :rtype: :class:`BaseMultipartUploader` or ``None``
+    """
+    return _get_from_mapping(storage, UPLOADER_MAPPING)
+
+
+def get_downloader(storage):
+    """
+    Get the ranged downloader of a Django storage, from the first of its
+    classes found in :data:`DOWNLOADER_MAPPING`.
+
+    :param storage: Django storage
+    :type storage: :class:`django.core.files.storage.Storage`
+
+    :returns: Downloader, ``None`` if the storage has none
+    :rtype: :class:`BaseRangedDownloader` or ``None``
+    """
+    return _get_from_mapping(storage, DOWNLOADER_MAPPING)
+
+
+def call_with_retries(func, *args, retries=None):
+    """
+    Call ``func``, again after a growing delay while it fails, up to
+    ``settings.DBBACKUP_UPLOAD_RETRIES`` times.
+    """
+    retries = settings.UPLOAD_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            return func(*args)
+        except Exception as err:
+            if attempt == retries:
+                raise
+            delay = min(settings.UPLOAD_RETRY_DELAY * 2**attempt, MAX_RETRY_DELAY)
+            # Jitter, so parallel parts do not retry all at once
+            delay *= random.uniform(0.5, 1)
+            logger.warning(
+                "%s, retrying in %.1fs", str(err) or type(err).__name__, delay
+            )
+            time.sleep(delay)
+
+
+def read_parts(fileobj, part_size, skip=()):
+    """
+    Read a file in parts of ``part_size`` bytes, the last one possibly
+    smaller. An empty file gives one empty part.
+
+    :param part_size: Size of the parts, or function giving the size of a
+                      part from its number
+    :type part_size: ``int`` or ``callable``
+
+    :param skip: Numbers of parts not to read, seeked over if possible
+    :type skip: ``set`` of ``int``
+
+    :returns: Number, from ``1``, and content of each part
+    :rtype: ``generator`` of ``tuple``
+    """
+    number = 1
+    while True:
+        size = part_size(number) if callable(part_size) else part_size
+        if number in skip and fileobj.seekable():
+            position = fileobj.tell()
+            if fileobj.seek(size, os.SEEK_CUR) - position == size:
+                number += 1
+                continue
+            fileobj.seek(position)
+        part = bytearray()
+        while len(part) < size:
+            data = fileobj.read(size - len(part))
+            if not data:
+                break
+            part += data
+        if (part or number == 1) and number not in skip:
+            yield number, bytes(part)
+        if len(part) < size:
+            return
+        number += 1
+
+
+class BaseMultipartUploader:
+    """
+    Upload a file in parts to a storage. Children define the storage's
+    multipart API: :meth:`start`, :meth:`upload_part`, :meth:`complete`
+    and :meth:`abort`.
+
+    :param storage: Django storage
+    :type storage: :class:`django.core.files.storage.Storage`
+    """
+
+    #: Most parts in an upload, ``None`` if unlimited
+    max_parts = None
+    #: Largest size of a part in bytes, ``None`` if unlimited
+    max_part_size = None
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get_part_layout(self, part_size, size=None):
+        """
+        Get the size of the parts of a file so it fits in :attr:`max_parts`
+        parts: large enough for the whole file if its ``size`` is known,
+        else doubling every ``max_parts / PART_SIZE_STEPS`` parts.
+
+        :param size: Size of the file, ``None`` if unknown
+        :type size: ``int`` or ``None``
+
+        :returns: Size of the first parts, and number of parts after which
+                  it doubles, ``None`` if it does not
+        :rtype: ``tuple``
+        """
+        if self.max_parts is None:
+            return part_size, None
+        if size is not None:
+            return max(part_size, (size + self.max_parts - 1) // self.max_parts), None
+        return part_size, self.max_parts // PART_SIZE_STEPS
+
+    def get_part_size(self, part_size, grow_every, number):
+        """Get the size of a part from its number, see :meth:`get_part_layout`."""
+        if grow_every:
+            part_size *= 2 ** ((number - 1) // grow_every)
+        if self.max_part_size is not None:
+            part_size = min(part_size, self.max_part_size)
+        return part_size
+
+    def start(self, name):
+        """
+        Start an upload.
+
+        :returns: Upload's id
+        :rtype: ``str``
+        """
+        raise NotImplementedError("start not implemented")
+
+    def upload_part(self, upload_id, name, number, data):
+        """
+        Upload a part, from any thread.
+
+        :returns: What :meth:`complete` needs to know about the part
+        """
+        raise NotImplementedError("upload_part not implemented")
+
+    def complete(self, upload_id, name, parts):
+        """Assemble the parts, in order, into the file ``name``."""
+        raise NotImplementedError("complete not implemented")
+
+    def abort(self, upload_id, name):
+        """Drop the uploaded parts."""
+        raise NotImplementedError("abort not implemented")
+
+    def upload(self, fileobj, name, part_size=None, concurrency=None, checkpoint=None):
+        """
+        Upload a file, ``concurrency`` parts at a time. At most twice as
+        many parts are held in memory.
+
+        Without ``checkpoint``, the upload is aborted if a part fails. With
+        it, the upload continues from the parts it records, and the parts
+        uploaded are added to it. A new upload first keeps the file in the
+        checkpoint, to resume it if the upload fails; if the file cannot be
+        kept, the upload goes on without checkpoint.
+
+        :param checkpoint: Checkpoint of the upload
+        :type checkpoint: :class:`UploadCheckpoint` or ``None``
+        """
+        concurrency = concurrency or settings.MULTIPART_CONCURRENCY
+        if checkpoint is not None and checkpoint.upload_id is not None:
+            upload_id, part_size = checkpoint.upload_id, checkpoint.part_size
+            grow_every = checkpoint.grow_every
+            logger.info("Resuming upload of %s, %d parts done", name, len(checkpoint))
+        else:
+            size = None
+            if fileobj.seekable():
+                position = fileobj.tell()
+                size = fileobj.seek(0, os.SEEK_END) - position
+                fileobj.seek(position)
+            part_size, grow_every = self.get_part_layout(
+                part_size or settings.MULTIPART_PART_SIZE, size
+            )
+            # Kept first, so every checkpoint recorded has its data
+            if checkpoint is not None and not checkpoint.keep_data(fileobj):
+                checkpoint = None
+            try:
+                upload_id = call_with_retries(self.start, name)
+            except BaseException:
+                if checkpoint is not None:
+                    checkpoint.remove()
+                raise
+            if checkpoint is not None:
+                checkpoint.start(upload_id, part_size, grow_every)
+        done = checkpoint.parts if checkpoint is not None else {}
+
+        def upload_part(part):
+            number, data = part
+            info = call_with_retries(self.upload_part, upload_id, name, number, data)
+            if checkpoint is not None:
+                checkpoint.add_part(number, info)
+            return number, info
+
+        try:
+            parts = dict(done)
+            parts.update(
+                streams.map_ordered(
+                    upload_part,
+                    read_parts(
+                        fileobj,
+                        functools.partial(self.get_part_size, part_size, grow_every),
+                        set(done),
+                    ),
+                    concurrency,
+                )
+            )
+            call_with_retries(
+                self.complete, upload_id, name, [parts[n] for n in sorted(parts)]
+            )
+        except BaseException:
+            if checkpoint is None:
+                self.abort(upload_id, name)
+            raise
+        if checkpoint is not None:
+            checkpoint.remove()
+
+
+class FileSystemMultipartUploader(BaseMultipartUploader):
+    """
+    Multipart uploads to a :class:`django.core.files.storage.FileSystemStorage`,
+    parts being written in a hidden directory of the storage then
+    concatenated. It stands in for object storages' multipart APIs, to
+    test uploads without them.
+    """
+
+    def _get_parts_dir(self, upload_id):
+        return os.path.join(self.storage.location, ".multipart", upload_id)
+
+    def start(self, name):
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._get_parts_dir(upload_id))
+        return upload_id
+
+    def upload_part(self, upload_id, name, number, data):
+        path = os.path.join(self._get_parts_dir(upload_id), f"{number:05d}")
+        with open(path, "wb") as fd:
+            fd.write(data)
+        return path
+
+    def complete(self, upload_id, name, parts):
+        path = self.storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = os.path.join(self._get_parts_dir(upload_id), "complete")
+        with open(temp_path, "wb") as output:
+            for part_path in parts:
+                with open(part_path, "rb") as part:
+                    shutil.copyfileobj(part, output)
+        os.replace(temp_path, path)
+        self.abort(upload_id, name)
+
+    def abort(self, upload_id, name):
+        shutil.rmtree(self._get_parts_dir(upload_id), ignore_errors=True)
+
+
+def _get_s3_key(storage, name):
+    from storages.utils import clean_name
+
+    return storage._normalize_name(clean_name(name))
+
+
+class S3MultipartUploader(BaseMultipartUploader):
+    """
+    Multipart uploads to the S3 storage of ``django-storages``, with the
+    storage's bucket, credentials and object parameters.
+    """
+
+    max_parts = 10000
+    max_part_size = 5 * 1024**3
+
+    def __init__(self, storage):
+        super().__init__(storage)
+        self.client = storage.connection.meta.client
+
+    def _get_key(self, name):
+        return _get_s3_key(self.storage, name)
+
+    def start(self, name):
+        params = self.storage.get_object_parameters(name)
+        response = self.client.create_multipart_upload(
+            Bucket=self.storage.bucket_name, Key=self._get_key(name), **params
+        )
+        return response["UploadId"]
+
+    def upload_part(self, upload_id, name, number, data):
+        response = self.client.upload_part(
+            Bucket=self.storage.bucket_name,
+            Key=self._get_key(name),
+            UploadId=upload_id,
+            PartNumber=number,
+            Body=data,
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def complete(self, upload_id, name, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.storage.bucket_name,
+            Key=self._get_key(name),
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+
+    def abort(self, upload_id, name):
+        self.client.abort_multipart_upload(
+            Bucket=self.storage.bucket_name,
+            Key=self._get_key(name),
+            UploadId=upload_id,
+        )
+
+
+class BaseRangedDownloader:
+    """
+    Read byte ranges of files in a storage. Children define
+    :meth:`get_size` and :meth:`read_range`.
+
+    :param storage: Django storage
+    :type storage: :class:`django.core.files.storage.Storage`
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def get_size(self, name):
+        """
+        Get the size of a file.
+
+        :rtype: ``int``
+        """
+        raise NotImplementedError("get_size not implemented")
+
+    def read_range(self, name, start, end):
+        """
+        Read the bytes of a file from ``start`` to ``end``, excluded, from
+        any thread.
+
+        :rtype: ``bytes``
+        """
+        raise NotImplementedError("read_range not implemented")
+
+
+class FileSystemRangedDownloader(BaseRangedDownloader):
+    """
+    Ranged reads from a :class:`django.core.files.storage.FileSystemStorage`,
+    standing in for object storages to test downloads without them.
+    """
+
+    def get_size(self, name):
+        return self.storage.size(name)
+
+    def read_range(self, name, start, end):
+        with open(self.storage.path(name), "rb") as fd:
+            fd.seek(start)
+            return fd.read(end - start)
+
+
+class S3RangedDownloader(BaseRangedDownloader):
+    """
+    Ranged reads from the S3 storage of ``django-storages``, with
+    ``Range`` requests.
+    """
+
+    def __init__(self, storage):
+        super().__init__(storage)
+        self.client = storage.connection.meta.client
+
+    def get_size(self, name):
+        response = self.client.head_object(
+            Bucket=self.storage.bucket_name, Key=_get_s3_key(self.storage, name)
+        )
+        return response["ContentLength"]
+
+    def read_range(self, name, start, end):
+        response = self.client.get_object(
+            Bucket=self.storage.bucket_name,
+            Key=_get_s3_key(self.storage, name),
+            Range=f"bytes={start}-{end - 1}",
+        )
+        return response["Body"].read()
+
+
+class RangedReader(io.RawIOBase):
+    """
+    File of a storage as a read-only seekable file, fetched by ranges of
+    ``range_size`` bytes. The ``concurrency`` ranges following the one read
+    are fetched in a pool of threads, so the storage's latency is hidden
+    while the data is consumed. Up to ``concurrency + 1`` ranges are held
+    in memory.
+
+    :param downloader: Downloader of the storage
+    :type downloader: :class:`BaseRangedDownloader`
+
+    :param name: Name of the file in the storage
+    :type name: ``str``
+
+    :param size: Size of the file
+    :type size: ``int``
+    """
+
+    def __init__(self, downloader, name, size, range_size=None, concurrency=None):
+        self.downloader = downloader
+        self.name = name
+        self.size = size
+        self.range_size = range_size or settings.DOWNLOAD_RANGE_SIZE
+        self.concurrency = concurrency or settings.DOWNLOAD_CONCURRENCY
+        self.ranges_read = 0
+        self._position = 0
+        # Index and future of ranges being fetched, in order
+        self._pending = deque()
+        self._index = None
+        self._data = b""
+        self._executor = ThreadPoolExecutor(self.concurrency)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._position = offset
+        return offset
+
+    def _fetch(self, index):
+        start = index * self.range_size
+        end = min(start + self.range_size, self.size)
+
+        def read_range():
+            data = self.downloader.read_range(self.name, start, end)
+            if len(data) != end - start:
+                raise OSError(
+                    f"Read {len(data)} bytes of {self.name}, not {end - start}"
+                )
+            return data
+
+        return call_with_retries(read_range)
+
+    def _cancel(self):
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+
+    def _fill(self, index):
+        """Fetch the ranges following ``index`` not fetched yet."""
+        if self._pending:
+            index = self._pending[-1][0] + 1
+        while (
+            len(self._pending) < self.concurrency
+            and index * self.range_size < self.size
+        ):
+            self._pending.append((index, self._executor.submit(self._fetch, index)))
+            index += 1
+
+    def _get_range(self, index):
+        if index != self._index:
+            # Drop ranges skipped by a seek forward, or all on a seek back
+            while self._pending and self._pending[0][0] < index:
+                self._pending.popleft()[1].cancel()
+            if self._pending and self._pending[0][0] != index:
+                self._cancel()
+            self._fill(index)
+            _, future = self._pending.popleft()
+            self._fill(index + 1)
+            self._data = future.result()
+            self._index = index
+            self.ranges_read += 1
+        return self._data
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast("B")
+        read = 0
+        while read < len(buffer) and self._position < self.size:
+            index = self._position // self.range_size
+            data = self._get_range(index)
+            start = self._position - index * self.range_size
+            size = min(len(buffer) - read, len(data) - start)
+            buffer[read : read + size] = data[start : start + size]
+            self._position += size
+            read += size
+        return read
+
+    def close(self):
+        if not self.closed:
+            self._cancel()
+            self._executor.shutdown(wait=False)
+            self._data = b""
+        super().close()
+
+
+class UploadCheckpoint:
+    """
+    Record of a multipart upload in
+    ``settings.DBBACKUP_UPLOAD_CHECKPOINT_DIR``, to resume it. The record is
+    a journal: the upload, then a line per uploaded part, appended as parts
+    are done. The file uploaded is kept next to it before the upload
+    starts, hard linked if possible.
+
+    :param name: Name of the file uploaded in the storage
+    :type name: ``str``
+
+    :param details: What the catalog records about the backup uploaded,
+                    like its ``database``
+    :type details: ``dict`` or ``None``
+    """
+
+    def __init__(self, name, directory=None, details=None):
+        self.name = name
+        self.details = details or {}
+        self.directory = directory or settings.UPLOAD_CHECKPOINT_DIR
+        digest = hashlib.sha256(name.encode()).hexdigest()[:16]
+        self.path = os.path.join(self.directory, f"{digest}.checkpoint")
+        self.data_path = os.path.join(self.directory, f"{digest}.data")
+        self.upload_id = None
+        self.part_size = None
+        self.grow_every = None
+        self.parts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.parts)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a checkpoint from its journal, a line cut by a crash being
+        ignored.
+
+        :rtype: :class:`UploadCheckpoint`
+        """
+        with open(path) as fd:
+            lines = fd.read().splitlines()
+        header = json.loads(lines[0])
+        checkpoint = cls(header["name"], os.path.dirname(path), header.get("details"))
+        checkpoint.upload_id = header["upload_id"]
+        checkpoint.part_size = header["part_size"]
+        checkpoint.grow_every = header.get("grow_every")
+        for line in lines[1:]:
+            try:
+                number, info = json.loads(line)
+            except ValueError:
+                continue
+            checkpoint.parts[number] = info
+        return checkpoint
+
+    def _write_line(self, value, mode="a", path=None):
+        with open(path or self.path, mode) as fd:
+            fd.write(json.dumps(value) + "\n")
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def start(self, upload_id, part_size, grow_every=None):
+        os.makedirs(self.directory, exist_ok=True)
+        self.upload_id = upload_id
+        self.part_size = part_size
+        self.grow_every = grow_every
+        self.parts = {}
+        # Renamed once written, a crash never leaves a journal without header
+        temp_path = f"{self.path}.tmp"
+        self._write_line(
+            {
+                "name": self.name,
+                "upload_id": upload_id,
+                "part_size": part_size,
+                "grow_every": grow_every,
+                "details": self.details,
+            },
+            "w",
+            temp_path,
+        )
+        os.replace(temp_path, self.path)
+
+    def add_part(self, number, info):
+        with self._lock:
+            self.parts[number] = info
+            self._write_line([number, info])
+
+    def has_data(self):
+        return os.path.exists(self.data_path)
+
+    def keep_data(self, fileobj):
+        """
+        Keep the file uploaded, from its current position, unless it is
+        already the kept one. A file of the same filesystem, even an
+        anonymous temporary file, is hard linked, others are copied.
+
+        :returns: ``False`` if the file cannot be kept
+        :rtype: ``bool``
+        """
+        name = getattr(fileobj, "name", None)
+        if isinstance(name, str) and (
+            os.path.abspath(name) == os.path.abspath(self.data_path)
+        ):
+            return True
+        if not fileobj.seekable():
+            logger.warning("Upload of %s cannot be resumed, data not kept", self.name)
+            return False
+        os.makedirs(self.directory, exist_ok=True)
+        self.remove()
+        position = fileobj.tell()
+        try:
+            if position == 0 and self._link_data(fileobj):
+                return True
+            logger.debug("Copying %s to resume its upload", self.name)
+            temp_path = f"{self.data_path}.tmp"
+            try:
+                pagecache.copy_to_path(fileobj, temp_path)
+                os.replace(temp_path, self.data_path)
+            except OSError as err:
+                logger.warning("Upload of %s cannot be resumed: %s", self.name, err)
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return False
+        finally:
+            fileobj.seek(position)
+        return True
+
+    def _link_data(self, fileobj):
+        try:
+            fd = fileobj.fileno()
+        except (AttributeError, OSError):
+            return False
+        try:
+            # Follows the link to the open file, named or not (Linux only)
+            os.link(f"/proc/self/fd/{fd}", self.data_path)
+        except OSError:
+            return False
+        return True
+
+    def open_data(self):
+        return open(self.data_path, "rb")
+
+    def remove(self):
+        for path in (self.path, self.data_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def list_checkpoints(directory=None):
+    """
+    List the checkpoints of interrupted uploads, those without data cannot
+    be resumed. Data left without checkpoint, by a process killed before
+    starting its upload, and unreadable checkpoints are removed.
+
+    :rtype: ``list`` of :class:`UploadCheckpoint`
+    """
+    directory = directory or settings.UPLOAD_CHECKPOINT_DIR
+    if not directory:
+        return []
+    checkpoints = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.checkpoint"))):
+        try:
+            checkpoints.append(UploadCheckpoint.load(path))
+        except (ValueError, IndexError, KeyError) as err:
+            logger.warning("Removing unreadable checkpoint %s: %r", path, err)
+            os.remove(path)
+    data_paths = {checkpoint.data_path for checkpoint in checkpoints}
+    for pattern in ("*.data", "*.data.tmp"):
+        for path in glob.glob(os.path.join(directory, pattern)):
+            if path.removesuffix(".tmp") not in data_paths:
+                logger.warning("Removing %s, left by an interrupted upload", path)
+                os.remove(path)
+    return checkpoints
@@ -0,0 +1,259 @@
+"""
+Page-cache-friendly I/O for backups.
+
+Reading a database or media files for a backup, or writing a local backup,
+fills the page cache with data used once and evicts the working set of the
+applications running on the host. With ``settings.CACHE_FRIENDLY_IO``, pages
+brought in by the backup are dropped once used, while pages which were
+already cached are left alone. With ``settings.DIRECT_IO``, local backups are
+also written with ``O_DIRECT``, bypassing the cache.
+
+This relies on ``posix_fadvise`` and ``mincore``, without them files are
+read and written as usual.
+"""
+
+import ctypes
+import mmap
+import os
+import threading
+from shutil import copyfileobj
+
+from . import settings, streams
+
+PAGE_SIZE = mmap.PAGESIZE
+# Written data is flushed and dropped from the cache by this amount
+WRITE_BEHIND_SIZE = 8 * 1024 * 1024
+# Size of blocks written with O_DIRECT, a multiple of the page size
+DIRECT_IO_BLOCK_SIZE = 1024 * 1024
+
+
+class PageCacheStats:
+    """
+    Bytes of files handled by backups: ``kept`` were cached before and left
+    in the cache, ``dropped`` were read or written by the backup and not
+    kept in the cache.
+    """
+
+    def __init__(self):
+        self.kept = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add(self, kept=0, dropped=0):
+        with self._lock:
+            self.kept += kept
+            self.dropped += dropped
+
+    def reset(self):
+        with self._lock:
+            self.kept = 0
+            self.dropped = 0
+
+
+stats = PageCacheStats()
+
+
+def is_enabled():
+    return settings.CACHE_FRIENDLY_IO and hasattr(os, "posix_fadvise")
+
+
+def _get_libc_function(name):
+    try:
+        return getattr(ctypes.CDLL(None, use_errno=True), name)
+    except (OSError, AttributeError):
+        return None
+
+
+def resident_pages(fd, size):
+    """
+    Get which pages of a file are in the page cache.
+
+    :returns: One byte per page, with lowest bit set for cached pages, or
+              ``None`` if it cannot be known
+    :rtype: ``bytes`` or ``None``
+    """
+    if size == 0:
+        return b""
+    libc_mmap = _get_libc_function("mmap")
+    munmap = _get_libc_function("munmap")
+    mincore = _get_libc_function("mincore")
+    if None in (libc_mmap, munmap, mincore):
+        return None
+    libc_mmap.restype = ctypes.c_void_p
+    libc_mmap.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_size_t,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int,
+        ctypes.c_int64,
+    ]
+    munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+    # The map is not read, mapping a file does not bring it in the cache
+    address = libc_mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+    if address is None or address == ctypes.c_void_p(-1).value:
+        return None
+    try:
+        vector = ctypes.create_string_buffer((size + PAGE_SIZE - 1) // PAGE_SIZE)
+        if mincore(address, size, vector) != 0:
+            return None
+        return vector.raw
+    finally:
+        munmap(address, size)
+
+
+def _drop_pages(fd, start, end, resident):
+    """
+    Drop pages from ``start`` to ``end`` from the cache, except the ones
+    cached before the backup.
+    """
+    first_page = start // PAGE_SIZE
+    last_page = (end + PAGE_SIZE - 1) // PAGE_SIZE
+    kept = 0
+    run_start = None
+    for page in range(first_page, last_page + 1):
+        cached = (
+            page < last_page
+            and resident is not None
+            and page < len(resident)
+            and resident[page] & 1
+        )
+        if cached:
+            kept += 1
+        if page < last_page and not cached:
+            if run_start is None:
+                run_start = page
+        elif run_start is not None:
+            os.posix_fadvise(
+                fd,
+                run_start * PAGE_SIZE,
+                (page - run_start) * PAGE_SIZE,
+                os.POSIX_FADV_DONTNEED,
+            )
+            run_start = None
+    dropped = (last_page - first_page - kept) * PAGE_SIZE
+    stats.add(kept=kept * PAGE_SIZE, dropped=dropped)
+
+
+def iter_file(fileobj, chunk_size=None):
+    """
+    Iterate over the content of a file by chunks like
+    :func:`dbbackup.streams.iter_file`, dropping pages brought in the cache
+    once read, if ``settings.CACHE_FRIENDLY_IO`` is enabled and the file
+    has a descriptor.
+    """
+    try:
+        fd = fileobj.fileno()
+    except (AttributeError, OSError):
+        fd = None
+    if fd is None or not is_enabled():
+        yield from streams.iter_file(fileobj, chunk_size)
+        return
+    resident = resident_pages(fd, os.fstat(fd).st_size)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+    position = fileobj.tell()
+    # Pages are dropped once fully read, the last one at the end of file
+    dropped_until = position - position % PAGE_SIZE
+    for chunk in streams.iter_file(fileobj, chunk_size):
+        yield chunk
+        position += len(chunk)
+        end = position - position % PAGE_SIZE
+        if end > dropped_until:
+            _drop_pages(fd, dropped_until, end, resident)
+            dropped_until = end
+    if position > dropped_until:
+        _drop_pages(fd, dropped_until, position, resident)
+
+
+def _write_all(fd, data):
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data) :]
+
+
+def _write_direct(fd, fileobj):
+    """
+    Write the content of ``fileobj`` with ``O_DIRECT``, through an aligned
+    buffer. The last partial block is written with ``O_DIRECT`` disabled.
+    """
+    import fcntl
+
+    block = mmap.mmap(-1, DIRECT_IO_BLOCK_SIZE)
+    view = memoryview(block)
+    filled = 0
+    try:
+        for chunk in streams.iter_file(fileobj, DIRECT_IO_BLOCK_SIZE):
+            chunk = memoryview(chunk).cast("B")
+            while chunk:
+                size = min(len(chunk), DIRECT_IO_BLOCK_SIZE - filled)
+                view[filled : filled + size] = chunk[:size]
+                chunk = chunk[size:]
+                filled += size
+                if filled == DIRECT_IO_BLOCK_SIZE:
+                    _write_all(fd, view)
+                    stats.add(dropped=filled)
+                    filled = 0
+        aligned = filled - filled % PAGE_SIZE
+        if aligned:
+            _write_all(fd, view[:aligned])
+        if filled > aligned:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+            _write_all(fd, view[aligned:filled])
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        stats.add(dropped=filled)
+    finally:
+        view.release()
+        block.close()
+
+
+def _write_behind(fd, fileobj):
+    """
+    Write the content of ``fileobj``, regularly flushing written data and
+    dropping it from the cache.
+    """
+    position = synced = 0
+    for chunk in streams.iter_file(fileobj):
+        _write_all(fd, chunk)
+        position += len(chunk)
+        if position - synced >= WRITE_BEHIND_SIZE:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, synced, position - synced, os.POSIX_FADV_DONTNEED)
+            stats.add(dropped=position - synced)
+            synced = position
+    if position > synced:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, synced, position - synced, os.POSIX_FADV_DONTNEED)
+        stats.add(dropped=position - synced)
+
+
+def copy_to_path(fileobj, path):
+    """
+    Write the content of a file object to ``path``, without keeping it in
+    the cache if ``settings.CACHE_FRIENDLY_IO`` is enabled.
+    """
+    if not is_enabled():
+        with open(path, "wb") as fd:
+            copyfileobj(fileobj, fd)
+        return
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if settings.DIRECT_IO and hasattr(os, "O_DIRECT"):
+        try:
+            fd = os.open(path, flags | os.O_DIRECT, 0o666)
+        except OSError:
+            # Not supported by the filesystem
+            pass
+        else:
+            try:
+                _write_direct(fd, fileobj)
+            finally:
+                os.close(fd)
+            return
+    fd = os.open(path, flags, 0o666)
+    try:
+        _write_behind(fd, fileobj)
+    finally:
+        os.close(fd)
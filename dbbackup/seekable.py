@@ -0,0 +1,204 @@
+"""
+Seekable Zstandard format.
+
+Data is compressed as independent Zstandard frames of a fixed uncompressed
+size, followed by a seek table in a skippable frame, as described by
+Zstandard's seekable format. Any Zstandard decoder reads the whole data,
+while :class:`SeekableReader` only uncompresses the frames holding the
+bytes read, fetched from a seekable file like a backup opened from the
+storage.
+"""
+
+import bisect
+import io
+import struct
+
+from . import streams
+
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+# Number of frames, descriptor and magic number
+FOOTER_FORMAT = "<IBI"
+FOOTER_SIZE = struct.calcsize(FOOTER_FORMAT)
+# Descriptor flag of entries having a checksum
+CHECKSUM_FLAG = 0x80
+# Sizes are stored on 4 bytes
+MAX_FRAME_SIZE = 2**32 - 1
+
+
+class SeekTableError(Exception):
+    pass
+
+
+def build_seek_table(entries):
+    """
+    Build the skippable frame holding the seek table.
+
+    :param entries: Compressed and uncompressed size of each frame
+    :type entries: ``list`` of ``tuple``
+
+    :rtype: ``bytes``
+    """
+    table = b"".join(struct.pack("<II", *entry) for entry in entries)
+    table += struct.pack(FOOTER_FORMAT, len(entries), 0, SEEKABLE_MAGIC)
+    return struct.pack("<II", SKIPPABLE_MAGIC, len(table)) + table
+
+
+def compress_chunks(chunks, compress, frame_size):
+    """
+    Compress chunks in the seekable format.
+
+    :param compress: Callable compressing bytes into one Zstandard frame
+    :type compress: ``callable``
+
+    :param frame_size: Uncompressed size of frames
+    :type frame_size: ``int``
+
+    :returns: Compressed chunks, one per frame then the seek table
+    :rtype: ``generator``
+    """
+    if not 0 < frame_size <= MAX_FRAME_SIZE:
+        raise ValueError(f"Frame size must be between 1 and {MAX_FRAME_SIZE}")
+    entries = []
+    for block in streams.split_chunks(chunks, frame_size):
+        frame = compress(block)
+        entries.append((len(frame), len(block)))
+        yield frame
+    yield build_seek_table(entries)
+
+
+def _read_exactly(fileobj, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            raise SeekTableError("Unexpected end of file")
+        data += chunk
+    return bytes(data)
+
+
+def read_seek_table(fileobj):
+    """
+    Read the seek table at the end of a file.
+
+    :param fileobj: Seekable compressed file
+    :type fileobj: ``file``
+
+    :returns: Compressed offset, uncompressed offset, compressed size and
+              uncompressed size of each frame, or ``None`` if the file has
+              no seek table
+    :rtype: ``list`` of ``tuple`` or ``None``
+    """
+    position = fileobj.tell()
+    try:
+        return _read_seek_table(fileobj)
+    finally:
+        # Callers falling back to reading the whole file find it unmoved
+        fileobj.seek(position)
+
+
+def _read_seek_table(fileobj):
+    size = fileobj.seek(0, io.SEEK_END)
+    if size < FOOTER_SIZE + 8:
+        return None
+    fileobj.seek(size - FOOTER_SIZE)
+    count, descriptor, magic = struct.unpack(
+        FOOTER_FORMAT, _read_exactly(fileobj, FOOTER_SIZE)
+    )
+    if magic != SEEKABLE_MAGIC:
+        return None
+    entry_size = 12 if descriptor & CHECKSUM_FLAG else 8
+    table_size = count * entry_size
+    if size < table_size + FOOTER_SIZE + 8:
+        raise SeekTableError("Seek table larger than file")
+    fileobj.seek(size - FOOTER_SIZE - table_size - 8)
+    frame_magic, frame_size = struct.unpack("<II", _read_exactly(fileobj, 8))
+    if frame_magic != SKIPPABLE_MAGIC or frame_size != table_size + FOOTER_SIZE:
+        raise SeekTableError("Invalid seek table frame")
+    table = _read_exactly(fileobj, table_size)
+    entries = []
+    compressed_offset = uncompressed_offset = 0
+    for index in range(count):
+        compressed_size, uncompressed_size = struct.unpack_from(
+            "<II", table, index * entry_size
+        )
+        entries.append(
+            (compressed_offset, uncompressed_offset, compressed_size, uncompressed_size)
+        )
+        compressed_offset += compressed_size
+        uncompressed_offset += uncompressed_size
+    return entries
+
+
+class SeekableReader(io.RawIOBase):
+    """
+    Uncompressed data of a seekable file, as a read-only seekable file.
+    Frames are read and uncompressed when data they hold is read, the last
+    one is kept in memory.
+
+    :param fileobj: Seekable compressed file
+    :type fileobj: ``file``
+
+    :param entries: Frames, as returned by :func:`read_seek_table`
+    :type entries: ``list`` of ``tuple``
+
+    :param decompress: Callable uncompressing one frame, given the frame
+                       and its uncompressed size
+    :type decompress: ``callable``
+    """
+
+    def __init__(self, fileobj, entries, decompress):
+        self.fileobj = fileobj
+        self.entries = entries
+        self.decompress = decompress
+        self.size = entries[-1][1] + entries[-1][3] if entries else 0
+        self.frames_read = 0
+        self._offsets = [entry[1] for entry in entries]
+        self._position = 0
+        self._frame_index = None
+        self._frame = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._position = offset
+        return offset
+
+    def _get_frame(self, index):
+        if index != self._frame_index:
+            compressed_offset, _, compressed_size, size = self.entries[index]
+            self.fileobj.seek(compressed_offset)
+            frame = _read_exactly(self.fileobj, compressed_size)
+            self._frame = self._decode(index, frame, size)
+            self._frame_index = index
+            self.frames_read += 1
+        return self._frame
+
+    def _decode(self, index, frame, size):
+        return self.decompress(frame, size)
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast("B")
+        read = 0
+        while read < len(buffer) and self._position < self.size:
+            index = bisect.bisect_right(self._offsets, self._position) - 1
+            frame = self._get_frame(index)
+            start = self._position - self.entries[index][1]
+            size = min(len(buffer) - read, len(frame) - start)
+            buffer[read : read + size] = frame[start : start + size]
+            self._position += size
+            read += size
+        return read
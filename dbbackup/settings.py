@@ -12,8 +12,22 @@ HOSTNAME = getattr(settings, "DBBACKUP_HOSTNAME", socket.gethostname())
 
 # Directory to use for temporary files
 TMP_DIR = getattr(settings, "DBBACKUP_TMP_DIR", tempfile.gettempdir())
+# Temporary files are spread over these directories
+TMP_DIRS = getattr(settings, "DBBACKUP_TMP_DIRS", [TMP_DIR])
 TMP_FILE_MAX_SIZE = getattr(settings, "DBBACKUP_TMP_FILE_MAX_SIZE", 10 * 1024 * 1024)
 TMP_FILE_READ_SIZE = getattr(settings, "DBBACKUP_TMP_FILE_READ_SIZE", 1024 * 1000)
+# Drop pages read or written by backups from the page cache
+CACHE_FRIENDLY_IO = getattr(settings, "DBBACKUP_CACHE_FRIENDLY_IO", False)
+DIRECT_IO = getattr(settings, "DBBACKUP_DIRECT_IO", False)
+# Memory shared by all temporary files before spilling to disk, None for unlimited
+MEMORY_BUDGET = getattr(settings, "DBBACKUP_MEMORY_BUDGET", None)
+
+# Stream backups and restores instead of spooling each stage
+STREAMING = getattr(settings, "DBBACKUP_STREAMING", False)
+# Maximum bytes held between the threads of a streamed backup
+PIPELINE_MAX_MEMORY = getattr(
+    settings, "DBBACKUP_PIPELINE_MAX_MEMORY", 32 * 1024 * 1024
+)
 
 # Number of old backup files to keep
 CLEANUP_KEEP = getattr(settings, "DBBACKUP_CLEANUP_KEEP", 10)
@@ -41,9 +55,67 @@ storage: dict = DJANGO_STORAGES.get(STORAGES_DBBACKUP_ALIAS, {})
 STORAGE = storage.get("BACKEND", "django.core.files.storage.FileSystemStorage")
 STORAGE_OPTIONS = storage.get("OPTIONS", {})
 
+# Multipart uploads, for storages with an uploader
+MULTIPART_THRESHOLD = getattr(
+    settings, "DBBACKUP_MULTIPART_THRESHOLD", 64 * 1024 * 1024
+)
+MULTIPART_PART_SIZE = getattr(
+    settings, "DBBACKUP_MULTIPART_PART_SIZE", 16 * 1024 * 1024
+)
+MULTIPART_CONCURRENCY = getattr(settings, "DBBACKUP_MULTIPART_CONCURRENCY", 4)
+CUSTOM_UPLOADER_MAPPING = getattr(settings, "DBBACKUP_UPLOADER_MAPPING", {})
+# Failed uploads are retried, and resumed from a checkpoint if it is set
+UPLOAD_RETRIES = getattr(settings, "DBBACKUP_UPLOAD_RETRIES", 5)
+UPLOAD_RETRY_DELAY = getattr(settings, "DBBACKUP_UPLOAD_RETRY_DELAY", 1)
+UPLOAD_CHECKPOINT_DIR = getattr(settings, "DBBACKUP_UPLOAD_CHECKPOINT_DIR", None)
+# Ranged downloads, for storages with a downloader
+DOWNLOAD_RANGE_SIZE = getattr(settings, "DBBACKUP_DOWNLOAD_RANGE_SIZE", 8 * 1024 * 1024)
+DOWNLOAD_CONCURRENCY = getattr(settings, "DBBACKUP_DOWNLOAD_CONCURRENCY", 4)
+CUSTOM_DOWNLOADER_MAPPING = getattr(settings, "DBBACKUP_DOWNLOADER_MAPPING", {})
+# Directory of the backups' catalog in the storage, disabled if None
+CATALOG_PATH = getattr(settings, "DBBACKUP_CATALOG_PATH", None)
+
 CONNECTORS = getattr(settings, "DBBACKUP_CONNECTORS", {})
 CUSTOM_CONNECTOR_MAPPING = getattr(settings, "DBBACKUP_CONNECTOR_MAPPING", {})
 
+STAGES = getattr(settings, "DBBACKUP_STAGES", {})
+# Stage used by --encrypt
+ENCRYPTION_FORMAT = getattr(settings, "DBBACKUP_ENCRYPTION_FORMAT", "gpg")
+# Stage used by --compress
+COMPRESSION_FORMAT = getattr(settings, "DBBACKUP_COMPRESSION_FORMAT", "gzip")
+# Automatic compression format choice
+COMPRESSION_CANDIDATES = getattr(
+    settings,
+    "DBBACKUP_COMPRESSION_CANDIDATES",
+    [
+        ("lz4", {}),
+        ("gzip", {"LEVEL": 6}),
+        ("zstd", {"LEVEL": 3}),
+        ("zstd", {"LEVEL": 19}),
+        ("xz", {"PRESET": 6}),
+    ],
+)
+COMPRESSION_SAMPLE_SIZE = getattr(
+    settings, "DBBACKUP_COMPRESSION_SAMPLE_SIZE", 8 * 1024 * 1024
+)
+COMPRESSION_MIN_THROUGHPUT = getattr(
+    settings, "DBBACKUP_COMPRESSION_MIN_THROUGHPUT", 20 * 1024 * 1024
+)
+COMPRESSION_WINDOW = getattr(settings, "DBBACKUP_COMPRESSION_WINDOW", None)
+COMPRESSION_MIN_RATIO = getattr(settings, "DBBACKUP_COMPRESSION_MIN_RATIO", 1.1)
+# Media files stored as is by mediabackup --compress-members
+INCOMPRESSIBLE_EXTENSIONS = getattr(
+    settings,
+    "DBBACKUP_INCOMPRESSIBLE_EXTENSIONS",
+    [
+        "7z", "aac", "avi", "avif", "br", "bz2", "docx", "epub", "flac", "gif",
+        "gz", "heic", "jar", "jpeg", "jpg", "lz4", "m4a", "m4v", "mkv", "mov",
+        "mp3", "mp4", "odt", "ogg", "opus", "png", "pptx", "rar", "webm", "webp",
+        "woff", "woff2", "xlsx", "xz", "zip", "zst",
+    ],
+)  # fmt: skip
+CUSTOM_STAGE_MAPPING = getattr(settings, "DBBACKUP_STAGE_MAPPING", {})
+
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
 # Mail
@@ -0,0 +1,997 @@
+"""
+Transform stages applied to backups, like compression or encryption.
+
+A stage filters chunks of bytes and knows its inverse. Stages changing the
+data add an extension to the backup's name, so the stages to revert on
+restore are found from the file name's suffix chain.
+"""
+
+import hashlib
+import logging
+import lzma
+import os
+import shlex
+import shutil
+import struct
+import time
+import zlib
+from importlib import import_module
+from subprocess import PIPE, Popen
+
+from . import aead, dictionaries, seekable, settings, streams, utils
+from .db.base import StderrTail, StdinFeeder
+
+logger = logging.getLogger("dbbackup.command")
+
+STAGE_MAPPING = {
+    "gzip": "dbbackup.stages.GzipStage",
+    "zstd": "dbbackup.stages.ZstdStage",
+    "lz4": "dbbackup.stages.Lz4Stage",
+    "xz": "dbbackup.stages.XzStage",
+    "delta": "dbbackup.stages.DeltaStage",
+    "gpg": "dbbackup.stages.GPGStage",
+    "aead": "dbbackup.stages.AeadStage",
+    "checksum": "dbbackup.stages.ChecksumStage",
+    "ratelimit": "dbbackup.stages.RateLimitStage",
+}
+
+if settings.CUSTOM_STAGE_MAPPING:
+    STAGE_MAPPING.update(settings.CUSTOM_STAGE_MAPPING)
+
+
+# Bytes of standard error of stage commands kept for error messages
+STDERR_TAIL_SIZE = 64 * 1024
+# Maximum size of a Zstandard frame header
+FRAME_HEADER_MAX_SIZE = 18
+# Magic number starting Zstandard frames
+ZSTD_FRAME_MAGIC = b"\x28\xb5\x2f\xfd"
+# Start of compressed formats: JPEG, PNG, GIF, ZIP, gzip, Zstandard, xz,
+# bzip2, 7z, RAR, Matroska, Ogg, MP3 and FLAC. MP4 and other ISO media
+# files have "ftyp" at offset 4.
+COMPRESSED_MAGICS = (
+    b"\xff\xd8\xff",
+    b"\x89PNG",
+    b"GIF8",
+    b"PK\x03\x04",
+    b"\x1f\x8b",
+    b"\x28\xb5\x2f\xfd",
+    b"\xfd7zXZ\x00",
+    b"BZh",
+    b"7z\xbc\xaf\x27\x1c",
+    b"Rar!",
+    b"\x1a\x45\xdf\xa3",
+    b"OggS",
+    b"ID3",
+    b"fLaC",
+)
+# Bytes of data encrypted by GPG to tell if they are worth compressing
+GPG_SAMPLE_SIZE = 64 * 1024
+# Delta backups start with this magic, their depth and their base's name
+DELTA_MAGIC = b"DBDELTA1"
+DELTA_HEADER_FORMAT = "<8sHH"
+DELTA_HEADER_SIZE = struct.calcsize(DELTA_HEADER_FORMAT)
+# Zstandard's largest window, a bigger base cannot be fully referenced
+DELTA_MAX_BASE_SIZE = 2**31
+
+
+class StageError(Exception):
+    pass
+
+
+def get_stage_class(name):
+    """
+    Get a stage class from its name in ``STAGE_MAPPING``.
+    """
+    try:
+        stage_path = STAGE_MAPPING[name]
+    except KeyError:
+        raise StageError(f"Unknown stage '{name}'")
+    stage_module_path = ".".join(stage_path.split(".")[:-1])
+    module = import_module(stage_module_path)
+    stage_name = stage_path.split(".")[-1]
+    return getattr(module, stage_name)
+
+
+def get_stage(name, **options):
+    """
+    Get a stage from its name, configured with ``settings.DBBACKUP_STAGES``
+    and the given options.
+    """
+    stage_options = settings.STAGES.get(name, {}).copy()
+    stage_options.update(options)
+    return get_stage_class(name)(**stage_options)
+
+
+def get_stage_name_for_extension(extension):
+    """
+    Get the name of the stage adding the given extension.
+
+    :returns: Stage name or ``None`` if no stage use this extension
+    :rtype: ``str`` or ``None``
+    """
+    for name in STAGE_MAPPING:
+        if get_stage_class(name).extension == extension:
+            return name
+    return None
+
+
+def stages_from_filename(filename, **options):
+    """
+    Get the stages applied to create a backup from its name's suffix chain.
+    ``'foo.psql.gz.gpg'`` gives a GPG stage then a gzip stage, the order in
+    which they must be reverted.
+
+    :param filename: Backup's name
+    :type filename: ``str``
+
+    :param options: Options given to every stage
+    :type options: ``dict``
+
+    :returns: Stages, outermost first
+    :rtype: ``list`` of :class:`BaseStage`
+    """
+    stages = []
+    parts = os.path.basename(filename).split(".")
+    while len(parts) > 1:
+        name = get_stage_name_for_extension(parts[-1])
+        if name is None:
+            break
+        stages.append(get_stage(name, **options))
+        parts.pop()
+    return stages
+
+
+def get_stage_kinds(filename):
+    """
+    Get the kinds of stages applied to create a backup, like
+    ``'compression'`` or ``'encryption'``, from its name.
+
+    :rtype: ``set`` of ``str``
+    """
+    return {stage.kind for stage in stages_from_filename(filename)}
+
+
+def is_compressible(filename, sample):
+    """
+    Tell if a file is worth compressing, from its extension, the magic
+    bytes of compressed formats, then the ratio of a fast compression of
+    its first bytes.
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :param sample: First bytes of the file
+    :type sample: ``bytes``
+
+    :rtype: ``bool``
+    """
+    extension = os.path.splitext(filename)[1][1:].lower()
+    if extension in settings.INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    if sample.startswith(COMPRESSED_MAGICS) or sample[4:8] == b"ftyp":
+        return False
+    if not sample:
+        return False
+    ratio = len(sample) / len(zlib.compress(sample, 1))
+    return ratio >= settings.COMPRESSION_MIN_RATIO
+
+
+def choose_compression_stage(sample, total_size=None):
+    """
+    Choose a compression stage by compressing a sample of the data with each
+    of ``settings.COMPRESSION_CANDIDATES``. The candidate giving the
+    smallest output among the ones compressing faster than the target
+    throughput is chosen, or the fastest if none does.
+
+    The target is ``settings.COMPRESSION_MIN_THROUGHPUT``, raised to finish
+    within ``settings.COMPRESSION_WINDOW`` seconds if ``total_size`` is
+    known. Candidates whose package is not installed are skipped.
+
+    :param sample: First bytes of the data
+    :type sample: ``bytes``
+
+    :param total_size: Size of the whole data, if known
+    :type total_size: ``int`` or ``None``
+
+    :returns: Stage, or ``None`` if the data is not worth compressing
+    :rtype: :class:`BaseStage` or ``None``
+    """
+    if not sample:
+        return None
+    target = settings.COMPRESSION_MIN_THROUGHPUT or 0
+    if total_size and settings.COMPRESSION_WINDOW:
+        target = max(target, total_size / settings.COMPRESSION_WINDOW)
+    results = []
+    for name, options in settings.COMPRESSION_CANDIDATES:
+        stage = get_stage(name, **options)
+        start = time.monotonic()
+        try:
+            chunks, _ = stage.apply([sample], "sample")
+            size = sum(len(chunk) for chunk in chunks)
+        except ImportError:
+            continue
+        throughput = len(sample) / max(time.monotonic() - start, 1e-6)
+        logger.debug(
+            "Compression sample with %s %s: ratio %.2f, %.1f MiB/s",
+            name,
+            options,
+            len(sample) / size,
+            throughput / 1024 / 1024,
+        )
+        results.append((size, throughput, name, options, stage))
+    if not results:
+        return None
+    fast_enough = [result for result in results if result[1] >= target]
+    if fast_enough:
+        size, throughput, name, options, stage = min(
+            fast_enough, key=lambda r: (r[0], -r[1])
+        )
+    else:
+        size, throughput, name, options, stage = max(results, key=lambda r: r[1])
+    ratio = len(sample) / size
+    if ratio < settings.COMPRESSION_MIN_RATIO:
+        logger.info("Compression skipped: ratio of %.2f on sample", ratio)
+        return None
+    logger.info(
+        "Compression chosen: %s %s, ratio %.2f, %.1f MiB/s on sample",
+        name,
+        options,
+        ratio,
+        throughput / 1024 / 1024,
+    )
+    return stage
+
+
+def run_command(chunks, command, pass_fds=()):
+    """
+    Filter chunks through a shell command, written to its standard input
+    by a thread while its standard output is read.
+
+    :param chunks: Input data
+    :type chunks: iterable of bytes
+
+    :param command: Command line, or its arguments
+    :type command: ``str`` or ``list``
+
+    :param pass_fds: File descriptors inherited by the command
+    :type pass_fds: ``tuple`` of ``int``
+
+    :returns: Standard output of the command
+    :rtype: ``generator``
+
+    :raises: :class:`StageError` if the command fails
+    """
+    logger.debug(command)
+    if isinstance(command, str):
+        command = shlex.split(command)
+    process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE, pass_fds=pass_fds)
+    feeder = StdinFeeder(process, streams.open_chunks(chunks))
+    stderr = StderrTail(process.stderr, STDERR_TAIL_SIZE)
+    feeder.start()
+    stderr.start()
+    try:
+        yield from streams.iter_file(process.stdout)
+        returncode = process.wait()
+        feeder.join()
+        if feeder.error is not None:
+            raise feeder.error
+        if returncode:
+            raise StageError(
+                "Error running: {}\n{}".format(
+                    shlex.join(command), stderr.read().decode("utf-8", "replace")
+                )
+            )
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+        stderr.join()
+
+
+def apply_stages(chunks, filename, stages):
+    """
+    Apply stages in order.
+
+    :returns: Tuple with transformed chunks and new file's name
+    :rtype: ``generator``, ``str``
+    """
+    for stage in stages:
+        chunks, filename = stage.apply(chunks, filename)
+    return chunks, filename
+
+
+def get_applied_filename(filename, stages):
+    """
+    Get the name of a file once stages are applied, without applying them.
+    """
+    for stage in stages:
+        filename = stage.get_applied_filename(filename)
+    return filename
+
+
+def revert_stages(chunks, filename, stages):
+    """
+    Revert stages in order, outermost first as given by
+    :func:`stages_from_filename`.
+
+    :returns: Tuple with restored chunks and new file's name
+    :rtype: ``generator``, ``str``
+    """
+    for stage in stages:
+        chunks, filename = stage.revert(chunks, filename)
+    return chunks, filename
+
+
+class BaseStage:
+    """
+    Base class for transform stages. Children define ``_apply`` and
+    ``_revert``, both taking and returning an iterable of bytes.
+    """
+
+    #: Extension added to file names, ``None`` for stages keeping data as is
+    extension = None
+    #: ``'compression'``, ``'encryption'`` or ``None``
+    kind = None
+    #: Shell command applying the stage instead of Python, like ``'pigz -6'``
+    command = None
+    #: Shell command reverting the stage instead of Python, like ``'pigz -d'``
+    revert_command = None
+
+    def __init__(self, **options):
+        for attr, value in options.items():
+            setattr(self, attr.lower(), value)
+
+    def _get_command(self, command):
+        """
+        Get the command to run instead of the Python implementation, if
+        configured and its program is installed.
+        """
+        if not command:
+            return None
+        if shutil.which(shlex.split(command)[0]) is None:
+            logger.debug("'%s' not found, using Python implementation", command)
+            return None
+        return command
+
+    def apply(self, chunks, filename):
+        """
+        :returns: Tuple with transformed chunks and new file's name
+        :rtype: ``generator``, ``str``
+        """
+        command = self._get_command(self.command)
+        if command:
+            chunks = run_command(chunks, command)
+        else:
+            chunks = self._apply(chunks, filename)
+        return chunks, self.get_applied_filename(filename)
+
+    def get_applied_filename(self, filename):
+        if self.extension:
+            filename = f"{filename}.{self.extension}"
+        return filename
+
+    def revert(self, chunks, filename):
+        """
+        :returns: Tuple with restored chunks and new file's name
+        :rtype: ``generator``, ``str``
+        """
+        command = self._get_command(self.revert_command)
+        if command:
+            chunks = run_command(chunks, command)
+        else:
+            chunks = self._revert(chunks, filename)
+        filename = os.path.basename(filename)
+        if self.extension and filename.endswith(f".{self.extension}"):
+            filename = filename[: -len(self.extension) - 1]
+        return chunks, filename
+
+    def _apply(self, chunks, filename):
+        raise NotImplementedError("_apply not implemented")
+
+    def _revert(self, chunks, filename):
+        raise NotImplementedError("_revert not implemented")
+
+
+class NativeCompressionStage(BaseStage):
+    """
+    Compression already done by the dump tool. Data is kept as is, and the
+    name gets the extension of the stage named ``format``, so the backup
+    is restored like one compressed by this stage. Without ``format``, the
+    compression is internal to the dump's own format and the name is kept.
+    """
+
+    kind = "compression"
+    format = None
+
+    @property
+    def extension(self):
+        if self.format is None:
+            return None
+        return get_stage_class(self.format).extension
+
+    def _apply(self, chunks, filename):
+        return chunks
+
+    def _revert(self, chunks, filename):
+        return chunks
+
+
+class GzipStage(BaseStage):
+    """
+    Compress with gzip. With ``threads`` greater than ``1``, or ``-1`` for
+    one per CPU, blocks of ``block_size`` bytes are compressed in parallel as
+    independent gzip members, which are also uncompressed in parallel.
+    """
+
+    extension = "gz"
+    kind = "compression"
+    level = 9
+    threads = 1
+    block_size = 1024 * 1024
+
+    def _apply(self, chunks, filename):
+        if self.threads != 1:
+            return streams.parallel_gzip_chunks(
+                chunks, self.threads, self.block_size, self.level
+            )
+        chunks, _ = streams.compress_chunks(chunks, filename, self.level)
+        return chunks
+
+    def _revert(self, chunks, filename):
+        if self.threads != 1:
+            return streams.parallel_gunzip_chunks(chunks, self.threads)
+        chunks, _ = streams.uncompress_chunks(chunks, filename)
+        return chunks
+
+
+class ZstdStage(BaseStage):
+    """
+    Compress with Zstandard, requires ``zstandard`` package. Options are
+    ``level`` and ``long``, to find matches in a window of ``2**long`` bytes
+    (``27`` if ``True``), which helps with big dumps but needs as much
+    memory to restore.
+
+    With ``frame_size``, data is cut in independent frames of this many bytes
+    followed by a seek table, so backups can be read from any offset with
+    :meth:`open_seekable`.
+
+    With ``dictionary``, data is compressed with the last version of this
+    trained dictionary from the storage. Restores find the dictionary from
+    the id written in the backup.
+    """
+
+    extension = "zst"
+    kind = "compression"
+    level = 3
+    long = None
+    #: Number of threads compressing, ``-1`` for one per CPU, ``0`` for none
+    threads = 0
+    frame_size = None
+    dictionary = None
+
+    def get_compressor(self):
+        import zstandard
+
+        window_log = 27 if self.long is True else self.long
+        params = zstandard.ZstdCompressionParameters.from_level(
+            self.level,
+            threads=self.threads,
+            write_checksum=True,
+            write_dict_id=True,
+            enable_ldm=bool(window_log),
+            window_log=window_log or 0,
+        )
+        dict_data = None
+        if self.dictionary:
+            dict_data = dictionaries.get_latest_dictionary(self.dictionary)
+        return zstandard.ZstdCompressor(compression_params=params, dict_data=dict_data)
+
+    def get_decompressor(self, header=b""):
+        """
+        :param header: Start of the compressed data, telling the dictionary
+                       used if any
+        :type header: ``bytes``
+        """
+        import zstandard
+
+        dict_id = 0
+        # Skippable frames, like the seek table of an empty backup, have no
+        # dictionary id
+        if header.startswith(ZSTD_FRAME_MAGIC):
+            try:
+                dict_id = zstandard.get_frame_parameters(header).dict_id
+            except zstandard.ZstdError:
+                pass
+        dict_data = None
+        if dict_id:
+            dict_data = dictionaries.get_dictionary_by_id(dict_id)
+        return zstandard.ZstdDecompressor(dict_data=dict_data, max_window_size=2**31)
+
+    def open_seekable(self, fileobj):
+        """
+        Open a backup compressed with ``frame_size`` for random access.
+
+        :param fileobj: Seekable compressed file
+        :type fileobj: ``file``
+
+        :returns: Seekable file of uncompressed data, ``None`` if the backup
+                  has no seek table
+        :rtype: :class:`dbbackup.seekable.SeekableReader` or ``None``
+        """
+        entries = seekable.read_seek_table(fileobj)
+        if entries is None:
+            return None
+        fileobj.seek(0)
+        decompressor = self.get_decompressor(fileobj.read(FRAME_HEADER_MAX_SIZE))
+
+        def decompress(frame, size):
+            return decompressor.decompress(frame, max_output_size=size)
+
+        return seekable.SeekableReader(fileobj, entries, decompress)
+
+    def _apply(self, chunks, filename):
+        if self.frame_size:
+            compressor = self.get_compressor()
+            return seekable.compress_chunks(
+                chunks, compressor.compress, self.frame_size
+            )
+        return streams.compress_with(chunks, self.get_compressor().compressobj())
+
+    def _revert(self, chunks, filename):
+        header, chunks = streams.peek_chunks(chunks, FRAME_HEADER_MAX_SIZE)
+        decompressor = self.get_decompressor(header)
+        return streams.decompress_with(chunks, decompressor.decompressobj)
+
+
+class _Lz4Compressor:
+    """Give LZ4 frame compressor the interface of the standard library's."""
+
+    def __init__(self, level):
+        import lz4.frame
+
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        data = self._header + self._compressor.compress(data)
+        self._header = b""
+        return data
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+
+class Lz4Stage(BaseStage):
+    """
+    Compress with LZ4, the fastest codec, requires ``lz4`` package. Option
+    is ``level``, from ``0`` to ``16``.
+    """
+
+    extension = "lz4"
+    kind = "compression"
+    level = 0
+
+    def _apply(self, chunks, filename):
+        return streams.compress_with(chunks, _Lz4Compressor(self.level))
+
+    def _revert(self, chunks, filename):
+        import lz4.frame
+
+        return streams.decompress_with(chunks, lz4.frame.LZ4FrameDecompressor)
+
+
+class DeltaStage(BaseStage):
+    """
+    Compress with Zstandard against a previous backup, ``base``, used as
+    reference like ``zstd --patch-from``: data already in the base costs
+    almost nothing, so backups of a mostly unchanged database are tiny.
+    Requires ``zstandard`` package.
+
+    Backups start with a header naming their base, read on restore to
+    rebuild the chain of deltas down to a full backup. After ``max_deltas``
+    deltas in a row, or without ``base``, a full backup is made. The base is
+    read from the storage and held in memory while compressing or
+    restoring. It must fit in Zstandard's largest window, 2 GiB, and not be
+    encrypted, or a full backup is made instead.
+    """
+
+    extension = "zdelta"
+    kind = "compression"
+    level = 3
+    #: File name of the reference backup in storage
+    base = None
+    max_deltas = 6
+    passphrase = None
+    #: Number of deltas down to a full backup, known once applied or reverted
+    depth = None
+
+    def _load_base(self, filename, max_size=None):
+        """
+        Read a backup from the storage and revert its stages.
+
+        :param max_size: Largest size of the content in bytes
+        :type max_size: ``int`` or ``None``
+
+        :returns: Content of the backup and its depth, ``None`` if bigger
+                  than ``max_size``
+        :rtype: ``bytes`` or ``None``, ``int``
+        """
+        from .storage import get_storage
+
+        logger.info("Reading delta base %s", filename)
+        input_file = get_storage().read_file(filename)
+        try:
+            stage_list = stages_from_filename(filename, passphrase=self.passphrase)
+            chunks, _ = revert_stages(
+                streams.iter_file(input_file), filename, stage_list
+            )
+            data = []
+            size = 0
+            for chunk in chunks:
+                data.append(chunk)
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    logger.error(
+                        "Delta base %s is bigger than %d bytes, Zstandard's "
+                        "largest window, making a full backup",
+                        filename,
+                        max_size,
+                    )
+                    return None, 0
+            data = b"".join(data)
+        finally:
+            input_file.close()
+        depth = max(
+            [stage.depth for stage in stage_list if isinstance(stage, DeltaStage)],
+            default=0,
+        )
+        return data, depth
+
+    def _is_encrypted(self, filename):
+        if any(stage.kind == "encryption" for stage in stages_from_filename(filename)):
+            # Reading it would need the private key or a passphrase prompt
+            logger.error(
+                "Delta base %s is encrypted, delta compression cannot be used "
+                "with encryption, making a full backup",
+                filename,
+            )
+            return True
+        return False
+
+    def _get_params(self, reference_size):
+        import zstandard
+
+        # The window must hold the reference
+        window_log = max(reference_size.bit_length(), 27)
+        return zstandard.ZstdCompressionParameters.from_level(
+            self.level,
+            write_checksum=True,
+            enable_ldm=True,
+            window_log=min(window_log, 31),
+        )
+
+    def _apply(self, chunks, filename):
+        import zstandard
+
+        base = reference = None
+        self.depth = 0
+        if self.base and not self._is_encrypted(self.base):
+            reference, base_depth = self._load_base(
+                self.base, max_size=DELTA_MAX_BASE_SIZE
+            )
+            if reference is not None and base_depth >= self.max_deltas:
+                logger.info("%d deltas in a row, making a full backup", base_depth)
+                reference = None
+            elif reference is not None:
+                base = self.base
+                self.depth = base_depth + 1
+        name = (base or "").encode("utf-8")
+        yield struct.pack(DELTA_HEADER_FORMAT, DELTA_MAGIC, self.depth, len(name))
+        yield name
+        dict_data = None
+        if reference is not None:
+            dict_data = zstandard.ZstdCompressionDict(
+                reference, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+            )
+        compressor = zstandard.ZstdCompressor(
+            compression_params=self._get_params(len(reference or b"")),
+            dict_data=dict_data,
+        )
+        yield from streams.compress_with(chunks, compressor.compressobj())
+
+    def read_header(self, chunks, filename):
+        """
+        Read the header of a delta backup, setting ``depth``.
+
+        :returns: Name of the base, empty if none, and the chunks following
+                  the header
+        :rtype: ``str``, ``generator``
+        """
+        chunks = iter(chunks)
+        header, chunks = streams.peek_chunks(chunks, DELTA_HEADER_SIZE)
+        if len(header) < DELTA_HEADER_SIZE:
+            raise StageError(f"Truncated delta header in {filename}")
+        magic, self.depth, name_size = struct.unpack(DELTA_HEADER_FORMAT, header)
+        if magic != DELTA_MAGIC:
+            raise StageError(f"{filename} is not a delta backup")
+        head, chunks = streams.peek_chunks(chunks, DELTA_HEADER_SIZE + name_size)
+        base = head[DELTA_HEADER_SIZE:].decode("utf-8")
+        return base, streams.skip_chunks(chunks, DELTA_HEADER_SIZE + name_size)
+
+    def _revert(self, chunks, filename):
+        import zstandard
+
+        base, chunks = self.read_header(chunks, filename)
+        dict_data = None
+        if base:
+            reference, _ = self._load_base(base)
+            dict_data = zstandard.ZstdCompressionDict(
+                reference, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+            )
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=dict_data, max_window_size=2**31
+        )
+        yield from streams.decompress_with(chunks, decompressor.decompressobj)
+
+
+def get_delta_base(fileobj, filename):
+    """
+    Get the backup a delta backup was made against, needed to restore it.
+
+    :param fileobj: Backup's content
+    :type fileobj: ``file``
+
+    :returns: Base's name, ``None`` for a full or non-delta backup
+    :rtype: ``str`` or ``None``
+    """
+    stage_list = stages_from_filename(filename)
+    for index, stage in enumerate(stage_list):
+        if isinstance(stage, DeltaStage):
+            break
+    else:
+        return None
+    chunks, name = revert_stages(
+        streams.iter_file(fileobj), filename, stage_list[:index]
+    )
+    base, _ = stage.read_header(chunks, name)
+    return base or None
+
+
+class XzStage(BaseStage):
+    """
+    Compress with XZ, slow but giving the smallest backups. Option is
+    ``preset``, from ``0`` to ``9``.
+    """
+
+    extension = "xz"
+    kind = "compression"
+    preset = 6
+
+    def _apply(self, chunks, filename):
+        return streams.compress_with(chunks, lzma.LZMACompressor(preset=self.preset))
+
+    def _revert(self, chunks, filename):
+        return streams.decompress_with(chunks, lzma.LZMADecompressor)
+
+
+class GPGStage(BaseStage):
+    """
+    Encrypt with GPG for ``settings.DBBACKUP_GPG_RECIPIENT``, through a
+    ``gpg`` process fed and read by pipes. Unless ``compress_algo`` is set,
+    GPG's own compression is disabled for data which does not compress,
+    like data compressed by a previous stage. The passphrase is given to
+    ``gpg`` by a pipe, never on its command line. Set ``armor`` to
+    ``False`` for binary output, a quarter smaller than ASCII armor.
+
+    As with ``python-gnupg``, a failing ``gpg`` raises
+    :class:`dbbackup.utils.EncryptionError` or
+    :class:`dbbackup.utils.DecryptionError`.
+    """
+
+    extension = "gpg"
+    kind = "encryption"
+    passphrase = None
+    binary = "gpg"
+    compress_algo = None
+    armor = True
+
+    def _get_gpg_command(self):
+        return [self.binary, "--batch", "--yes", "--no-tty", "--quiet"]
+
+    def _apply(self, chunks, filename):
+        compress_algo = self.compress_algo
+        if compress_algo is None:
+            sample, chunks = streams.peek_chunks(chunks, GPG_SAMPLE_SIZE)
+            if not is_compressible(filename, sample):
+                compress_algo = "none"
+        command = self._get_gpg_command() + ["--encrypt"]
+        recipients = settings.GPG_RECIPIENT
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        for recipient in recipients:
+            command += ["--recipient", recipient]
+        if settings.GPG_ALWAYS_TRUST:
+            command += ["--trust-model", "always"]
+        if self.armor:
+            command += ["--armor"]
+        if compress_algo is not None:
+            command += ["--compress-algo", str(compress_algo)]
+        return self._run(chunks, command, utils.EncryptionError)
+
+    def _revert(self, chunks, filename):
+        passphrase = self.passphrase or utils.getpass("Input Passphrase: ") or None
+        command = self._get_gpg_command() + ["--decrypt"]
+        if passphrase is None:
+            return self._run(chunks, command, utils.DecryptionError)
+        return self._run_with_passphrase(chunks, command, passphrase)
+
+    def _run(self, chunks, command, error_class, pass_fds=()):
+        try:
+            yield from run_command(chunks, command, pass_fds=pass_fds)
+        except StageError as err:
+            action = (
+                "Encryption" if error_class is utils.EncryptionError else "Decryption"
+            )
+            raise error_class(f"{action} failed; status: {err}") from err
+
+    def _run_with_passphrase(self, chunks, command, passphrase):
+        read_fd, write_fd = os.pipe()
+        try:
+            with os.fdopen(write_fd, "wb") as pipe:
+                pipe.write(passphrase.encode() + b"\n")
+            command += ["--pinentry-mode", "loopback", "--passphrase-fd", str(read_fd)]
+            yield from self._run(
+                chunks, command, utils.DecryptionError, pass_fds=(read_fd,)
+            )
+        finally:
+            os.close(read_fd)
+
+
+class AeadStage(BaseStage):
+    """
+    Encrypt in chunks of ``chunk_size`` bytes with AES-256-GCM, or
+    ChaCha20-Poly1305 with ``cipher``, on a pool of ``threads`` threads
+    (``-1`` for one per CPU). The key of each backup is wrapped for every
+    public key of ``recipients``, and unwrapped with the first private key
+    of ``identities`` it is wrapped for, ``passphrase`` unlocking it.
+    Requires ``cryptography``.
+
+    Backups are readable at random with :meth:`open_seekable`. If the
+    storage has a sidecar envelope for a backup, written by the
+    ``rewrapkeys`` command, its envelope is used instead of the backup's,
+    unless ``sidecar`` is ``False``.
+    """
+
+    extension = "aead"
+    kind = "encryption"
+    cipher = "aes-256-gcm"
+    chunk_size = 1024 * 1024
+    threads = -1
+    recipients = ()
+    identities = ()
+    passphrase = None
+    sidecar = True
+
+    def get_public_keys(self):
+        return [aead.load_public_key(value) for value in self.recipients]
+
+    def get_private_keys(self):
+        if not self.identities:
+            raise StageError("No identity to decrypt with, set 'IDENTITIES'")
+        return [
+            aead.load_private_key(value, self.passphrase) for value in self.identities
+        ]
+
+    def open_seekable(self, fileobj):
+        """
+        Open an encrypted backup for random access.
+
+        :param fileobj: Seekable encrypted file
+        :type fileobj: ``file``
+
+        :rtype: :class:`dbbackup.aead.DecryptingReader`
+        """
+        return aead.DecryptingReader(
+            fileobj,
+            self.get_private_keys(),
+            self.get_sidecar_envelope(getattr(fileobj, "name", None)),
+        )
+
+    def get_sidecar_envelope(self, filename):
+        """
+        Get the envelope of a backup's sidecar in the storage.
+
+        :returns: Envelope, ``None`` if the backup has no sidecar
+        :rtype: ``bytes`` or ``None``
+        """
+        if not self.sidecar or not filename:
+            return None
+        from .storage import get_storage
+
+        storage = get_storage()
+        # The new sidecar is left alone if rewrapping stopped while replacing
+        for new in (False, True):
+            sidecar_filename = aead.get_sidecar_filename(
+                os.path.basename(filename), new
+            )
+            if storage.storage.exists(sidecar_filename):
+                break
+        else:
+            return None
+        logger.debug("Using envelope of %s", sidecar_filename)
+        sidecar_file = storage.read_file(sidecar_filename)
+        try:
+            return aead.parse_sidecar(sidecar_file.read())
+        finally:
+            sidecar_file.close()
+
+    def _apply(self, chunks, filename):
+        return aead.encrypt_chunks(
+            chunks,
+            self.get_public_keys(),
+            self.cipher,
+            self.chunk_size,
+            streams.get_thread_count(self.threads),
+        )
+
+    def _revert(self, chunks, filename):
+        return aead.decrypt_chunks(
+            chunks,
+            self.get_private_keys(),
+            streams.get_thread_count(self.threads),
+            self.get_sidecar_envelope(filename),
+        )
+
+
+class ChecksumStage(BaseStage):
+    """
+    Compute a digest of the data passing through, without changing it. The
+    digest is logged and available as :attr:`hexdigest` once the data is
+    consumed. If ``expected`` is set, a mismatch raises :class:`StageError`.
+    """
+
+    algorithm = "sha256"
+    expected = None
+    hexdigest = None
+
+    def _checksum(self, chunks):
+        digest = hashlib.new(self.algorithm)
+        for chunk in chunks:
+            digest.update(chunk)
+            yield chunk
+        self.hexdigest = digest.hexdigest()
+        logger.info("Checksum (%s): %s", self.algorithm, self.hexdigest)
+        if self.expected and self.expected != self.hexdigest:
+            raise StageError(
+                f"Checksum mismatch: expected {self.expected}, got {self.hexdigest}"
+            )
+
+    def _apply(self, chunks, filename):
+        return self._checksum(chunks)
+
+    _revert = _apply
+
+
+class RateLimitStage(BaseStage):
+    """
+    Limit the throughput of data passing through to ``rate`` bytes per
+    second, to spare the disk or the network of a production host.
+    """
+
+    rate = 10 * 1024 * 1024
+
+    def _limit(self, chunks):
+        start = time.monotonic()
+        size = 0
+        for chunk in chunks:
+            yield chunk
+            size += len(chunk)
+            delay = size / self.rate - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    def _apply(self, chunks, filename):
+        return self._limit(chunks)
+
+    _revert = _apply
@@ -2,11 +2,13 @@
 Utils for handle files.
 """
 
+import io
 import logging
+import os
 
 from django.core.exceptions import ImproperlyConfigured
 
-from . import settings, utils
+from . import aead, catalog, multipart, settings, stages, utils
 
 
 def get_storage(path=None, options=None):
@@ -74,19 +76,195 @@ class Storage:
     def __str__(self):
         return f"dbbackup-{self.storage.__str__()}"
 
+    def get_catalog(self):
+        """
+        Get the catalog of the backups, ``None`` if
+        ``settings.DBBACKUP_CATALOG_PATH`` is not set.
+
+        :rtype: :class:`dbbackup.catalog.Catalog` or ``None``
+        """
+        if not hasattr(self, "_catalog"):
+            self._catalog = None
+            if settings.CATALOG_PATH:
+                self._catalog = catalog.Catalog(self.storage)
+        return self._catalog
+
     def delete_file(self, filepath):
         self.logger.debug("Deleting file %s", filepath)
         self.storage.delete(name=filepath)
+        backup_catalog = self.get_catalog()
+        if backup_catalog is not None and catalog.is_backup_filename(filepath):
+            backup_catalog.remove(filepath)
 
     def list_directory(self, path=""):
         return self.storage.listdir(path)[1]
 
-    def write_file(self, filehandle, filename):
+    def get_uploader(self):
+        """
+        Get the multipart uploader of the storage, see
+        :func:`dbbackup.multipart.get_uploader`.
+        """
+        if not hasattr(self, "_uploader"):
+            self._uploader = multipart.get_uploader(self.storage)
+        return self._uploader
+
+    def _use_multipart(self, filehandle):
+        """
+        Tell if a file is uploaded in parts: the storage must have an
+        uploader, and the file be larger than
+        ``settings.DBBACKUP_MULTIPART_THRESHOLD`` or of unknown size.
+        """
+        if self.get_uploader() is None:
+            return False
+        if not filehandle.seekable():
+            return True
+        size = filehandle.seek(0, os.SEEK_END)
+        filehandle.seek(0)
+        return size >= settings.MULTIPART_THRESHOLD
+
+    def _write_file(self, filehandle, filename, details=None):
+        """
+        Upload a file, in parts or with ``save()``. ``details`` of a backup
+        are recorded in its upload's checkpoint.
+
+        :returns: Name of the file in the storage
+        :rtype: ``str``
+        """
+        if self._use_multipart(filehandle):
+            name = self.storage.get_available_name(filename)
+            self.logger.debug("Uploading %s in parts", name)
+            checkpoint = None
+            if settings.UPLOAD_CHECKPOINT_DIR and filehandle.seekable():
+                checkpoint = multipart.UploadCheckpoint(name, details=details)
+            self.get_uploader().upload(filehandle, name, checkpoint=checkpoint)
+            return name
+        if not filehandle.seekable():
+            # A partly read stream cannot be sent again
+            return self.storage.save(name=filename, content=filehandle)
+
+        def save():
+            filehandle.seek(0)
+            return self.storage.save(name=filename, content=filehandle)
+
+        return multipart.call_with_retries(save)
+
+    def write_file(self, filehandle, filename, **details):
+        """
+        Write a file in the storage. Backups are added to the catalog, with
+        ``details`` like their ``database`` and ``servername``, see
+        :func:`dbbackup.catalog.build_entry`.
+        """
         self.logger.debug("Writing file %s", filename)
-        self.storage.save(name=filename, content=filehandle)
+        backup_catalog = self.get_catalog()
+        if backup_catalog is None or not catalog.is_backup_filename(filename):
+            self._write_file(filehandle, filename, details)
+            return
+        if filehandle.seekable():
+            size, checksum = catalog.get_digest(filehandle)
+            name = self._write_file(filehandle, filename, details)
+        else:
+            filehandle = catalog.HashingReader(filehandle)
+            name = self._write_file(filehandle, filename, details)
+            size, checksum = filehandle.size, filehandle.hexdigest()
+        backup_catalog.add(catalog.build_entry(name, size, checksum, **details))
+
+    def list_interrupted_uploads(self, content_type=None, database=None):
+        """
+        List the multipart uploads which failed and can be resumed, from
+        ``settings.DBBACKUP_UPLOAD_CHECKPOINT_DIR``. Uploads whose data was
+        not kept are aborted and their checkpoint removed.
+
+        :param content_type: Filter by media or database backup, must be
+                             ``'db'`` or ``'media'``
+        :type content_type: ``str`` or ``None``
+
+        :param database: Filter by source database's name, as recorded when
+                         the upload started
+        :type: ``str`` or ``None``
+
+        :rtype: ``list`` of :class:`dbbackup.multipart.UploadCheckpoint`
+        """
+        checkpoints = []
+        for checkpoint in multipart.list_checkpoints():
+            if checkpoint.has_data():
+                checkpoints.append(checkpoint)
+            else:
+                self._abort_upload(checkpoint)
+        if content_type:
+            checkpoints = [
+                c
+                for c in checkpoints
+                if (c.details.get("content_type") or catalog.get_content_type(c.name))
+                == content_type
+            ]
+        if database:
+            checkpoints = [
+                c for c in checkpoints if c.details.get("database") == database
+            ]
+        return checkpoints
+
+    def _abort_upload(self, checkpoint):
+        self.logger.warning(
+            "Upload of %s cannot be resumed, its data was not kept", checkpoint.name
+        )
+        uploader = self.get_uploader()
+        if uploader is not None:
+            try:
+                multipart.call_with_retries(
+                    uploader.abort, checkpoint.upload_id, checkpoint.name
+                )
+            except Exception as err:
+                # Tried again next time
+                self.logger.error("Cannot abort upload of %s: %s", checkpoint.name, err)
+                return
+        checkpoint.remove()
+
+    def resume_upload(self, checkpoint):
+        """
+        Upload the parts missing of an interrupted upload.
+
+        :param checkpoint: Checkpoint of the upload
+        :type checkpoint: :class:`dbbackup.multipart.UploadCheckpoint`
+        """
+        self.logger.info("Resuming upload of %s", checkpoint.name)
+        uploader = self.get_uploader()
+        if uploader is None:
+            msg = f"Storage cannot resume the upload of {checkpoint.name}"
+            raise StorageError(msg)
+        backup_catalog = self.get_catalog()
+        with checkpoint.open_data() as data:
+            if backup_catalog is not None:
+                size, checksum = catalog.get_digest(data)
+            uploader.upload(data, checkpoint.name, checkpoint=checkpoint)
+        if backup_catalog is not None and catalog.is_backup_filename(checkpoint.name):
+            backup_catalog.add(
+                catalog.build_entry(
+                    checkpoint.name, size, checksum, **checkpoint.details
+                )
+            )
+
+    def get_downloader(self):
+        """
+        Get the ranged downloader of the storage, see
+        :func:`dbbackup.multipart.get_downloader`.
+        """
+        if not hasattr(self, "_downloader"):
+            self._downloader = multipart.get_downloader(self.storage)
+        return self._downloader
 
     def read_file(self, filepath):
         self.logger.debug("Reading file %s", filepath)
+        downloader = self.get_downloader()
+        if downloader is not None:
+            size = downloader.get_size(filepath)
+            # A single range is read as fast by the storage
+            if size > settings.DOWNLOAD_RANGE_SIZE:
+                self.logger.debug("Downloading %s by ranges", filepath)
+                # Buffered for consumers reading by lines or small records
+                return io.BufferedReader(
+                    multipart.RangedReader(downloader, filepath, size),
+                    buffer_size=settings.DOWNLOAD_RANGE_SIZE,
+                )
         file_ = self.storage.open(name=filepath, mode="rb")
         if not getattr(file_, "name", None):
             file_.name = filepath
@@ -128,12 +306,24 @@ class Storage:
         if content_type not in ("db", "media", None):
             msg = "Bad content_type %s, must be 'db', 'media', or None" % (content_type)
             raise TypeError(msg)
-        # TODO: Make better filter for include only backups
-        files = [f for f in self.list_directory() if utils.filename_to_datestring(f)]
+        backup_catalog = self.get_catalog()
+        if backup_catalog is not None:
+            files = list(backup_catalog.load())
+        else:
+            # TODO: Make better filter for include only backups
+            files = [f for f in self.list_directory() if catalog.is_backup_filename(f)]
         if encrypted is not None:
-            files = [f for f in files if (".gpg" in f) == encrypted]
+            files = [
+                f
+                for f in files
+                if ("encryption" in stages.get_stage_kinds(f)) == encrypted
+            ]
         if compressed is not None:
-            files = [f for f in files if (".gz" in f) == compressed]
+            files = [
+                f
+                for f in files
+                if ("compression" in stages.get_stage_kinds(f)) == compressed
+            ]
         if content_type == "media":
             files = [f for f in files if ".tar" in f]
         elif content_type == "db":
@@ -232,6 +422,30 @@ class Storage:
             raise FileNotFound("There's no backup file available.")
         return min(files, key=utils.filename_to_date)
 
+    def _get_delta_bases(self, filenames):
+        """
+        Get the backups needed to restore delta backups, following their
+        chain of bases down to full backups.
+
+        :rtype: ``set`` of ``str``
+        """
+        bases = set()
+        pending = list(filenames)
+        while pending:
+            filename = pending.pop()
+            stage_list = stages.stages_from_filename(filename)
+            if not any(isinstance(stage, stages.DeltaStage) for stage in stage_list):
+                continue
+            input_file = self.read_file(filename)
+            try:
+                base = stages.get_delta_base(input_file, filename)
+            finally:
+                input_file.close()
+            if base and base not in bases:
+                bases.add(base)
+                pending.append(base)
+        return bases
+
     def clean_old_backups(
         self,
         encrypted=None,
@@ -279,11 +493,20 @@ class Storage:
             servername=servername,
         )
         files = sorted(files, key=utils.filename_to_date, reverse=True)
-        files_to_delete = [fi for i, fi in enumerate(files) if i >= keep_number]
+        kept_files = [
+            fi for i, fi in enumerate(files) if i < keep_number or keep_filter(fi)
+        ]
+        # Kept delta backups need their chain of bases to be restored
+        bases = self._get_delta_bases(kept_files)
+        files_to_delete = [
+            fi for fi in files if fi not in kept_files and fi not in bases
+        ]
         for filename in files_to_delete:
-            if keep_filter(filename):
-                continue
             self.delete_file(filename)
+            for new in (False, True):
+                sidecar_filename = aead.get_sidecar_filename(filename, new)
+                if self.storage.exists(sidecar_filename):
+                    self.delete_file(sidecar_filename)
 
 
 def get_storage_class(path=None):
@@ -0,0 +1,726 @@
+"""
+Helpers for streaming backups as iterators of byte chunks.
+
+A chunk iterator lets dump, compression, encryption and storage stages work
+on the data as it is produced instead of materializing a full copy of the
+backup between each of them.
+"""
+
+import gzip
+import io
+import itertools
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import settings, utils
+
+GZIP_WBITS = zlib.MAX_WBITS | 16
+# Gzip members written in parallel carry their size in this extra subfield,
+# like BGZF's "BC" but on 4 bytes to allow blocks bigger than 64 KiB
+GZIP_SIZE_SUBFIELD = b"DB"
+
+
+def iter_file(fileobj, chunk_size=None):
+    """
+    Iterate over the content of a file object by chunks.
+
+    :param fileobj: File to read
+    :type fileobj: ``file`` like object
+
+    :param chunk_size: Size of read chunks, ``settings.TMP_FILE_READ_SIZE``
+                       is used if ``None``
+    :type chunk_size: ``int`` or ``None``
+
+    :returns: Iterator of bytes
+    :rtype: ``generator``
+    """
+    chunk_size = chunk_size or settings.TMP_FILE_READ_SIZE
+    # Spill buffers give views of their content instead of copies
+    read = getattr(fileobj, "read_view", fileobj.read)
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def join_chunks(chunks, chunk_size=None):
+    """
+    Join small chunks, like the lines of a dump, into bigger ones.
+
+    :param chunks: Chunks to join
+    :type chunks: iterable of ``bytes``
+
+    :param chunk_size: Minimal size of joined chunks,
+                       ``settings.TMP_FILE_READ_SIZE`` is used if ``None``
+    :type chunk_size: ``int`` or ``None``
+
+    :returns: Iterator of bytes
+    :rtype: ``generator``
+    """
+    chunk_size = chunk_size or settings.TMP_FILE_READ_SIZE
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= chunk_size:
+            yield b"".join(pending)
+            pending = []
+            pending_size = 0
+    if pending_size:
+        yield b"".join(pending)
+
+
+def peek_chunks(chunks, size):
+    """
+    Read the first ``size`` bytes of chunks without consuming them.
+
+    :returns: Tuple with the first bytes and all chunks
+    :rtype: ``bytes``, ``generator``
+    """
+    chunks = iter(chunks)
+    head = []
+    head_size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        head_size += len(chunk)
+        if head_size >= size:
+            break
+    return b"".join(head)[:size], itertools.chain(head, chunks)
+
+
+def skip_chunks(chunks, size):
+    """
+    Skip the first ``size`` bytes of chunks.
+
+    :rtype: ``generator``
+    """
+    for chunk in chunks:
+        if size >= len(chunk):
+            size -= len(chunk)
+            continue
+        yield chunk[size:]
+        size = 0
+
+
+def limit_chunks(chunks, size):
+    """
+    Get exactly the first ``size`` bytes of chunks, like the content of a
+    file given in a TAR header.
+
+    :raises: :class:`OSError` if chunks end before
+    :rtype: ``generator``
+    """
+    for chunk in chunks:
+        if size <= 0:
+            break
+        chunk = chunk[:size]
+        size -= len(chunk)
+        yield chunk
+    if size > 0:
+        raise OSError("unexpected end of data")
+
+
+def spool_chunks(chunks):
+    """
+    Write chunks into a spooled temporary file.
+
+    :param chunks: Chunks to write
+    :type chunks: iterable of ``bytes``
+
+    :returns: Spooled temporary file, rewound
+    :rtype: :class:`dbbackup.buffers.SpillBuffer`
+    """
+    spooled_file = utils.create_spooled_temporary_file()
+    for chunk in chunks:
+        spooled_file.write(chunk)
+    spooled_file.seek(0)
+    return spooled_file
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Non-seekable file object reading from an iterable of byte chunks.
+
+    It is the bridge between a chunk iterator and APIs expecting files, like
+    Django storages or subprocess' standard input.
+    """
+
+    def __init__(self, chunks, name=None):
+        self._chunks = iter(chunks)
+        self._pending = b""
+        self._position = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            try:
+                self._pending = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        self._position += size
+        return size
+
+    def tell(self):
+        """Return the number of bytes read so far."""
+        return self._position
+
+    def close(self):
+        if not self.closed and hasattr(self._chunks, "close"):
+            self._chunks.close()
+        super().close()
+
+
+def open_chunks(chunks, name=None):
+    """
+    Open an iterable of chunks as a buffered, non-seekable, file object.
+
+    :param chunks: Chunks to read
+    :type chunks: iterable of ``bytes``
+
+    :param name: Name given to the file object
+    :type name: ``str`` or ``None``
+
+    :returns: File object
+    :rtype: :class:`io.BufferedReader`
+    """
+    return io.BufferedReader(
+        ChunkReader(chunks, name=name), settings.TMP_FILE_READ_SIZE
+    )
+
+
+class _ChunkSink:
+    """Write-only file object collecting data until drained."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        if self._chunks:
+            data = b"".join(self._chunks)
+            self._chunks = []
+            yield data
+
+
+def _gzip_chunks(chunks, filename, level=9):
+    output = _ChunkSink()
+    zipfile = gzip.GzipFile(
+        filename=filename, fileobj=output, mode="wb", compresslevel=level
+    )
+    try:
+        for chunk in chunks:
+            zipfile.write(chunk)
+            yield from output.drain()
+    finally:
+        zipfile.close()
+    yield from output.drain()
+
+
+def compress_chunks(chunks, filename, level=9):
+    """
+    Compress chunks using gzip and change the file's name, it is the
+    streaming version of :func:`dbbackup.utils.compress_file`.
+
+    :param chunks: Chunks to compress
+    :type chunks: iterable of ``bytes``
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :param level: Compression level, from ``1`` to ``9``
+    :type level: ``int``
+
+    :returns: Tuple with compressed chunks and new file's name
+    :rtype: ``generator``, ``str``
+    """
+    return _gzip_chunks(chunks, filename, level), f"{filename}.gz"
+
+
+def _gunzip_chunks(chunks):
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    for chunk in chunks:
+        while chunk:
+            if decompressor.eof:
+                # Concatenated gzip members
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+            data = decompressor.decompress(chunk, settings.TMP_FILE_READ_SIZE)
+            if data:
+                yield data
+            chunk = decompressor.unconsumed_tail or decompressor.unused_data
+    if not decompressor.eof:
+        raise EOFError(
+            "Compressed file ended before the end-of-stream marker was reached"
+        )
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def uncompress_chunks(chunks, filename):
+    """
+    Uncompress gzip chunks and change the file's name, it is the streaming
+    version of :func:`dbbackup.utils.uncompress_file`.
+
+    :param chunks: Chunks to uncompress
+    :type chunks: iterable of ``bytes``
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :returns: Tuple with uncompressed chunks and new file's name
+    :rtype: ``generator``, ``str``
+    """
+    new_basename = os.path.basename(filename).replace(".gz", "")
+    return _gunzip_chunks(chunks), new_basename
+
+
+def get_thread_count(threads):
+    """Get a number of threads, ``-1`` meaning one per CPU."""
+    if threads == -1:
+        return os.cpu_count() or 1
+    return max(threads, 1)
+
+
+def split_chunks(chunks, block_size):
+    """
+    Cut chunks into blocks of ``block_size`` bytes, the last one possibly
+    smaller.
+
+    :rtype: ``generator`` of ``bytes``
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= block_size:
+            yield bytes(buffer[:block_size])
+            del buffer[:block_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def map_ordered(func, items, threads):
+    """
+    Apply ``func`` on items in a pool of threads, yielding results in order.
+    At most two items per thread are in flight, so items are consumed as
+    results are used.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(threads) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= threads * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _gzip_member(data, level):
+    """
+    Compress data as a standalone gzip member, with its total size in the
+    ``GZIP_SIZE_SUBFIELD`` extra subfield.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    # Header of 12 bytes, extra field of 8 bytes, trailer of 8 bytes
+    size = 20 + len(body) + 8
+    extra = GZIP_SIZE_SUBFIELD + struct.pack("<HI", 4, size)
+    # Magic, deflate, FEXTRA flag, no mtime, no extra flags, unknown OS
+    header = struct.pack("<BBBBIBBH", 0x1F, 0x8B, 8, 4, 0, 0, 255, len(extra))
+    trailer = struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+    return b"".join((header, extra, body, trailer))
+
+
+def parallel_gzip_chunks(chunks, threads, block_size, level=9):
+    """
+    Compress chunks with gzip on several threads. Blocks of ``block_size``
+    bytes are compressed as independent members: the output is a standard
+    multi-member gzip file, slightly bigger than a single member one.
+
+    :param threads: Number of threads, ``-1`` for one per CPU
+    :type threads: ``int``
+
+    :returns: Compressed chunks
+    :rtype: ``generator``
+    """
+    return map_ordered(
+        lambda block: _gzip_member(block, level),
+        split_chunks(chunks, block_size),
+        get_thread_count(threads),
+    )
+
+
+def _get_gzip_member_size(buffer):
+    """
+    Get the size of the gzip member at the start of ``buffer`` from its
+    ``GZIP_SIZE_SUBFIELD`` extra subfield.
+
+    :returns: ``False`` if the header is incomplete, the size, or ``None`` if
+              the member has no size subfield
+    :rtype: ``int``, ``False`` or ``None``
+    """
+    if len(buffer) < 12:
+        return False
+    if buffer[:2] != b"\x1f\x8b" or not buffer[3] & gzip.FEXTRA:
+        return None
+    (extra_size,) = struct.unpack_from("<H", buffer, 10)
+    if len(buffer) < 12 + extra_size:
+        return False
+    position = 12
+    while position + 4 <= 12 + extra_size:
+        subfield_id = bytes(buffer[position : position + 2])
+        (subfield_size,) = struct.unpack_from("<H", buffer, position + 2)
+        if subfield_id == GZIP_SIZE_SUBFIELD and subfield_size == 4:
+            return struct.unpack_from("<I", buffer, position + 4)[0]
+        position += 4 + subfield_size
+    return None
+
+
+def _split_gzip_members(chunks, fallback):
+    """
+    Cut a gzip stream into members using their size subfield. The rest of
+    the stream from the first member without size is added to ``fallback``.
+    """
+    buffer = bytearray()
+    chunks = iter(chunks)
+    for chunk in chunks:
+        buffer += chunk
+        while buffer:
+            size = _get_gzip_member_size(buffer)
+            if size is None:
+                fallback.append(itertools.chain([bytes(buffer)], chunks))
+                return
+            if size is False or len(buffer) < size:
+                break
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        raise EOFError(
+            "Compressed file ended before the end-of-stream marker was reached"
+        )
+
+
+def parallel_gunzip_chunks(chunks, threads):
+    """
+    Uncompress gzip chunks on several threads. Members written by
+    :func:`parallel_gzip_chunks` are uncompressed in parallel, other gzip
+    files are uncompressed sequentially.
+
+    :param threads: Number of threads, ``-1`` for one per CPU
+    :type threads: ``int``
+
+    :returns: Uncompressed chunks
+    :rtype: ``generator``
+    """
+    fallback = []
+    yield from map_ordered(
+        lambda member: zlib.decompress(member, GZIP_WBITS),
+        _split_gzip_members(chunks, fallback),
+        get_thread_count(threads),
+    )
+    if fallback:
+        yield from _gunzip_chunks(fallback[0])
+
+
+def compress_with(chunks, compressor):
+    """
+    Compress chunks with a compressor object having ``compress`` and
+    ``flush`` methods, like :class:`lzma.LZMACompressor`.
+
+    :returns: Compressed chunks
+    :rtype: ``generator``
+    """
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    data = compressor.flush()
+    if data:
+        yield data
+
+
+def decompress_with(chunks, decompressor_factory):
+    """
+    Uncompress chunks made of one or more concatenated frames, with
+    decompressor objects having ``decompress``, ``eof`` and ``unused_data``
+    like :class:`lzma.LZMADecompressor`.
+
+    :param decompressor_factory: Callable returning a new decompressor
+    :type decompressor_factory: ``callable``
+
+    :returns: Uncompressed chunks
+    :rtype: ``generator``
+
+    :raises EOFError: If the last frame is truncated
+    """
+    decompressor = decompressor_factory()
+    started = False
+    for chunk in chunks:
+        while chunk:
+            if decompressor.eof:
+                decompressor = decompressor_factory()
+            started = True
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            chunk = decompressor.unused_data if decompressor.eof else b""
+    if started and not decompressor.eof:
+        raise EOFError(
+            "Compressed file ended before the end-of-stream marker was reached"
+        )
+
+
+def encrypt_chunks(chunks, filename):
+    """
+    Encrypt chunks using GPG and change the file's name, see
+    :class:`dbbackup.stages.GPGStage`.
+
+    :param chunks: Chunks to encrypt
+    :type chunks: iterable of ``bytes``
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :returns: Tuple with encrypted chunks and new file's name
+    :rtype: ``generator``, ``str``
+    """
+    from .stages import GPGStage
+
+    return GPGStage().apply(chunks, filename)
+
+
+def unencrypt_chunks(chunks, filename, passphrase=None):
+    """
+    Unencrypt chunks using GPG and change the file's name, see
+    :class:`dbbackup.stages.GPGStage`.
+
+    :param chunks: Chunks to unencrypt
+    :type chunks: iterable of ``bytes``
+
+    :param filename: File's name
+    :type filename: ``str``
+
+    :param passphrase: Passphrase of GPG key, see
+                       :func:`dbbackup.utils.unencrypt_file`
+    :type passphrase: ``str`` or ``None``
+
+    :returns: Tuple with unencrypted chunks and new file's name
+    :rtype: ``generator``, ``str``
+    """
+    from .stages import GPGStage
+
+    return GPGStage(passphrase=passphrase).revert(chunks, filename)
+
+
+class PipelineCancelled(Exception):
+    """Raised in a pipeline's thread when another one has failed."""
+
+
+class ChunkQueue:
+    """
+    Queue of chunks between two threads, bounded by the size of the chunks
+    it holds. A producer blocks while the queue is full, which is the
+    backpressure slowing down a stage faster than the next one.
+
+    Time spent blocked is recorded: a long ``put_stall`` means the consumer
+    is the bottleneck, a long ``get_stall`` means the producer is.
+    """
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.size = 0
+        self.peak_size = 0
+        self.peak_depth = 0
+        self.put_stall = 0.0
+        self.get_stall = 0.0
+        self._chunks = deque()
+        self._closed = False
+        self._cancelled = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def put(self, chunk):
+        with self._condition:
+            start = time.monotonic()
+            # A chunk bigger than the queue is accepted when the queue is empty
+            while self.size and self.size + len(chunk) > self.max_size:
+                if self._cancelled:
+                    break
+                self._condition.wait()
+            self.put_stall += time.monotonic() - start
+            if self._cancelled:
+                raise PipelineCancelled(self.name)
+            self._chunks.append(chunk)
+            self.size += len(chunk)
+            self.peak_size = max(self.peak_size, self.size)
+            self.peak_depth = max(self.peak_depth, len(self._chunks))
+            self._condition.notify_all()
+
+    def get(self):
+        """
+        :returns: Next chunk or ``None`` once the producer is done
+        :rtype: ``bytes`` or ``None``
+        """
+        with self._condition:
+            start = time.monotonic()
+            while not self._chunks and not self._closed and not self._cancelled:
+                self._condition.wait()
+            self.get_stall += time.monotonic() - start
+            if self._cancelled:
+                raise PipelineCancelled(self.name)
+            if self._chunks:
+                chunk = self._chunks.popleft()
+                self.size -= len(chunk)
+                self._condition.notify_all()
+                return chunk
+            if self._error is not None:
+                raise PipelineCancelled(self.name)
+            return None
+
+    def __iter__(self):
+        while True:
+            chunk = self.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self, error=None):
+        """Tell the consumer no more chunks will come."""
+        with self._condition:
+            self._closed = True
+            self._error = error
+            self._condition.notify_all()
+
+    def cancel(self):
+        """Unblock and stop both ends of the queue."""
+        with self._condition:
+            self._cancelled = True
+            self._chunks.clear()
+            self.size = 0
+            self._condition.notify_all()
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "peak_size": self.peak_size,
+            "peak_depth": self.peak_depth,
+            "put_stall": self.put_stall,
+            "get_stall": self.get_stall,
+        }
+
+
+class _PipelineThread(threading.Thread):
+    def __init__(self, target, queues):
+        super().__init__(daemon=True)
+        self._target = target
+        self.queues = queues
+        self.error = None
+
+    def run(self):
+        try:
+            self._target()
+        except Exception as err:
+            self.error = err
+            for queue in self.queues:
+                queue.cancel()
+
+
+def run_pipeline(source, transform, sink, max_memory=None):
+    """
+    Run a backup's production, transformation and storage concurrently.
+
+    ``source`` is iterated in the calling thread, so it can use the
+    database connection. ``transform`` runs in a worker thread and ``sink``
+    in another one. They are connected by two :class:`ChunkQueue`, sharing
+    ``max_memory`` bytes, so the peak memory of the pipeline is fixed
+    whatever the size of the backup.
+
+    :param source: Chunks of the backup
+    :type source: iterable of ``bytes``
+
+    :param transform: Callable taking chunks and returning transformed ones
+    :type transform: ``callable``
+
+    :param sink: Callable taking a non-seekable file object to store
+    :type sink: ``callable``
+
+    :param max_memory: Maximum bytes held by queues,
+                       ``settings.PIPELINE_MAX_MEMORY`` is used if ``None``
+    :type max_memory: ``int`` or ``None``
+
+    :returns: Statistics of queues, see :meth:`ChunkQueue.stats`
+    :rtype: ``list`` of ``dict``
+    """
+    max_memory = max_memory or settings.PIPELINE_MAX_MEMORY
+    source_queue = ChunkQueue("source", max_memory // 2)
+    sink_queue = ChunkQueue("sink", max_memory // 2)
+    queues = [source_queue, sink_queue]
+
+    def transform_target():
+        try:
+            for chunk in transform(iter(source_queue)):
+                sink_queue.put(chunk)
+        except Exception as err:
+            sink_queue.close(error=err)
+            raise
+        sink_queue.close()
+
+    def sink_target():
+        reader = ChunkReader(iter(sink_queue))
+        sink(reader)
+        # Check the transform finished even if the sink stopped reading
+        if sink_queue.get() is not None:
+            raise PipelineCancelled("Data left unread by the sink")
+
+    threads = [
+        _PipelineThread(transform_target, queues),
+        _PipelineThread(sink_target, queues),
+    ]
+    for thread in threads:
+        thread.start()
+    source_error = None
+    try:
+        for chunk in source:
+            source_queue.put(chunk)
+    except PipelineCancelled:
+        pass
+    except Exception as err:
+        source_error = err
+        for queue in queues:
+            queue.cancel()
+    finally:
+        source_queue.close()
+        for thread in threads:
+            thread.join()
+    errors = [source_error] + [thread.error for thread in threads]
+    errors = [err for err in errors if err is not None]
+    if errors:
+        # The first error not caused by the failure of another thread
+        for err in errors:
+            if not isinstance(err, PipelineCancelled):
+                raise err
+        raise errors[0]
+    return [queue.stats() for queue in queues]
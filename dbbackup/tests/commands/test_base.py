@@ -5,12 +5,14 @@ Tests for base command class.
 import logging
 import os
 from io import BytesIO
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 from django.core.files import File
+from django.core.management.base import CommandError
 from django.test import TestCase
 
 from dbbackup.management.commands._base import BaseDbBackupCommand
+from dbbackup.stages import ChecksumStage, GPGStage, GzipStage, XzStage
 from dbbackup.storage import get_storage
 from dbbackup.tests.utils import DEV_NULL, HANDLED_FILES
 
@@ -60,6 +62,21 @@ class BaseDbBackupCommandMethodsTest(TestCase):
         self.command.write_to_storage(BytesIO(b"foo"), "bar")
         self.assertEqual(HANDLED_FILES["written_files"][0][0], "bar")
 
+    def test_resume_uploads(self):
+        self.command.content_type = "db"
+        checkpoints = [Mock(), Mock()]
+        with (
+            patch.object(
+                self.command.storage,
+                "list_interrupted_uploads",
+                return_value=checkpoints,
+            ) as list_uploads,
+            patch.object(self.command.storage, "resume_upload") as resume_upload,
+        ):
+            self.assertEqual(self.command._resume_uploads(database="foo"), 2)
+        list_uploads.assert_called_once_with(content_type="db", database="foo")
+        self.assertEqual([c.args[0] for c in resume_upload.call_args_list], checkpoints)
+
     def test_read_local_file(self):
         # setUp
         self.command.path = "/tmp/foo.bak"
@@ -98,6 +115,85 @@ class BaseDbBackupCommandMethodsTest(TestCase):
                 self.command._ask_confirmation()
 
 
+class BaseDbBackupCommandGetStagesTest(TestCase):
+    def setUp(self):
+        self.command = BaseDbBackupCommand()
+        self.command.compress = False
+        self.command.encrypt = False
+        self.command.uncompress = False
+        self.command.decrypt = False
+
+    def test_get_backup_stages(self):
+        self.assertEqual(self.command._get_backup_stages(), [])
+        self.command.compress = True
+        self.command.encrypt = True
+        self.command.extra_stages = ["checksum"]
+        self.assertEqual(
+            [type(stage) for stage in self.command._get_backup_stages()],
+            [GzipStage, GPGStage, ChecksumStage],
+        )
+
+    def test_get_restore_stages_from_filename(self):
+        stage_list = self.command._get_restore_stages("foo.psql.gz.gpg")
+        self.assertEqual([type(stage) for stage in stage_list], [GPGStage, GzipStage])
+
+    def test_get_restore_stages_from_options(self):
+        self.command.uncompress = True
+        self.command.decrypt = True
+        self.command.passphrase = "foo"
+        stage_list = self.command._get_restore_stages("foo")
+        self.assertEqual([type(stage) for stage in stage_list], [GPGStage, GzipStage])
+        self.assertEqual(stage_list[0].passphrase, "foo")
+        # Not duplicated when the name tells it
+        stage_list = self.command._get_restore_stages("foo.gz.gpg")
+        self.assertEqual(len(stage_list), 2)
+
+    def test_compress_format(self):
+        self.command.compress = True
+        self.command.compress_format = "xz"
+        (stage,) = self.command._get_backup_stages()
+        self.assertIsInstance(stage, XzStage)
+        self.command.uncompress = True
+        (stage,) = self.command._get_restore_stages("foo")
+        self.assertIsInstance(stage, XzStage)
+
+    @patch("dbbackup.settings.COMPRESSION_FORMAT", "xz")
+    def test_compress_format_setting(self):
+        self.command.compress = True
+        (stage,) = self.command._get_backup_stages()
+        self.assertIsInstance(stage, XzStage)
+
+    @patch("dbbackup.settings.COMPRESSION_CANDIDATES", [("xz", {})])
+    def test_auto_compress_format(self):
+        self.command.compress = True
+        self.command.compress_format = "auto"
+        (stage,) = self.command._get_backup_stages(b"foo" * 1000)
+        self.assertIsInstance(stage, XzStage)
+        self.assertEqual(self.command._get_backup_stages(os.urandom(1000)), [])
+        # The extension tells which compression was chosen
+        self.command.uncompress = True
+        self.assertEqual(self.command._get_restore_stages("foo"), [])
+        (stage,) = self.command._get_restore_stages("foo.xz")
+        self.assertIsInstance(stage, XzStage)
+
+    def test_bad_compress_format(self):
+        self.command.compress = True
+        for compress_format in ("foo", "checksum"):
+            self.command.compress_format = compress_format
+            with self.assertRaises(CommandError):
+                self.command._get_backup_stages()
+
+    def test_delta_encrypted(self):
+        self.command.compress = True
+        self.command.encrypt = True
+        self.command.compress_format = "delta"
+        with (
+            patch.object(self.command, "_get_delta_base", return_value=None),
+            self.assertRaises(CommandError),
+        ):
+            self.command._get_backup_stages()
+
+
 class BaseDbBackupCommandCleanupOldBackupsTest(TestCase):
     def setUp(self):
         HANDLED_FILES.clean()
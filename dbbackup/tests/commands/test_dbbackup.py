@@ -2,15 +2,32 @@
 Tests for dbbackup command.
 """
 
+import gzip
+import lzma
 import os
+from unittest import skipUnless
 from unittest.mock import patch
 
 from django.test import TestCase
 
+from dbbackup import stages, utils
 from dbbackup.db.base import get_connector
 from dbbackup.management.commands.dbbackup import Command as DbbackupCommand
+from dbbackup.stages import NativeCompressionStage
 from dbbackup.storage import get_storage
-from dbbackup.tests.utils import DEV_NULL, TEST_DATABASE, add_public_gpg, clean_gpg_keys
+from dbbackup.tests.utils import (
+    DEV_NULL,
+    HANDLED_FILES,
+    TEST_DATABASE,
+    add_public_gpg,
+    clean_gpg_keys,
+    get_dump,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 @patch("dbbackup.settings.GPG_RECIPIENT", "test@test")
@@ -28,6 +45,7 @@ class DbbackupCommandSaveNewBackupTest(TestCase):
         self.command.filename = None
         self.command.path = None
         self.command.schemas = []
+        self.command.stream = False
 
     def tearDown(self):
         clean_gpg_keys()
@@ -57,6 +75,109 @@ class DbbackupCommandSaveNewBackupTest(TestCase):
 
         self.assertIsNone(result)
 
+    def test_stream(self):
+        HANDLED_FILES.clean()
+        self.command.stream = True
+        self.command._save_new_backup(TEST_DATABASE)
+        outputfile = HANDLED_FILES["written_files"][0][1]
+        outputfile.seek(0)
+        self.assertEqual(outputfile.read(), get_dump().read())
+
+    def test_stream_compress(self):
+        HANDLED_FILES.clean()
+        self.command.stream = True
+        self.command.compress = True
+        self.command._save_new_backup(TEST_DATABASE)
+        filename, outputfile = HANDLED_FILES["written_files"][0]
+        self.assertTrue(filename.endswith(".gz"))
+        outputfile.seek(0)
+        self.assertEqual(gzip.decompress(outputfile.read()), get_dump().read())
+
+    def test_stream_stage_filename(self):
+        HANDLED_FILES.clean()
+        self.command.stream = True
+        self.command.compress = True
+        self.command.filename = "foo.bak"
+        with patch(
+            "dbbackup.stages.apply_stages", wraps=stages.apply_stages
+        ) as apply_stages:
+            self.command._save_new_backup(TEST_DATABASE)
+        # Stages get the dump's name, not the one in storage
+        self.assertTrue(apply_stages.call_args[0][1].endswith(".dump"))
+        self.assertEqual(HANDLED_FILES["written_files"][0][0], "foo.bak")
+
+    @patch("dbbackup.settings.COMPRESSION_CANDIDATES", [("xz", {})])
+    def test_auto_compress(self):
+        self.command.compress = True
+        self.command.compress_format = "auto"
+        for stream in (False, True):
+            HANDLED_FILES.clean()
+            self.command.stream = stream
+            self.command._save_new_backup(TEST_DATABASE)
+            filename, outputfile = HANDLED_FILES["written_files"][0]
+            self.assertTrue(filename.endswith(".xz"))
+            outputfile.seek(0)
+            self.assertEqual(lzma.decompress(outputfile.read()), get_dump().read())
+
+    def test_native_compression(self):
+        self.command.compress = True
+        self.command.connector.get_native_compression_stage = (
+            lambda: NativeCompressionStage(format="gzip")
+        )
+        for stream in (False, True):
+            HANDLED_FILES.clean()
+            self.command.stream = stream
+            self.command._save_new_backup(TEST_DATABASE)
+            filename, outputfile = HANDLED_FILES["written_files"][0]
+            # Named after the tool's compression, not compressed again
+            self.assertTrue(filename.endswith(".gz"))
+            outputfile.seek(0)
+            self.assertEqual(outputfile.read(), get_dump().read())
+
+    @skipUnless(zstandard, "zstandard not installed")
+    def test_delta_compress(self):
+        HANDLED_FILES.clean()
+        self.command.compress = True
+        self.command.compress_format = "delta"
+        self.command._save_new_backup(TEST_DATABASE)
+        # Make the first backup older
+        base, base_file = HANDLED_FILES["written_files"][0]
+        base = base.replace(utils.filename_to_datestring(base), "2015-02-06-042810")
+        HANDLED_FILES["written_files"][0] = (base, base_file)
+        self.command._save_new_backup(TEST_DATABASE)
+        _, (filename, outputfile) = HANDLED_FILES["written_files"]
+        self.assertTrue(filename.endswith(".zdelta"))
+        outputfile.seek(0)
+        self.assertIn(base.encode(), outputfile.read(200))
+
+    def test_stream_encrypt(self):
+        HANDLED_FILES.clean()
+        add_public_gpg()
+        self.command.stream = True
+        self.command.encrypt = True
+        self.command._save_new_backup(TEST_DATABASE)
+        filename, outputfile = HANDLED_FILES["written_files"][0]
+        self.assertTrue(filename.endswith(".gpg"))
+        outputfile.seek(0)
+        self.assertTrue(outputfile.read().startswith(b"-----BEGIN PGP MESSAGE-----"))
+
+    def test_extra_stages(self):
+        HANDLED_FILES.clean()
+        self.command.compress = True
+        self.command.extra_stages = ["checksum"]
+        with self.assertLogs("dbbackup.command", "INFO") as cm:
+            self.command._save_new_backup(TEST_DATABASE)
+        self.assertTrue(HANDLED_FILES["written_files"][0][0].endswith(".gz"))
+        self.assertTrue(any("Checksum (sha256)" in line for line in cm.output))
+
+    def test_stream_path(self):
+        self.command.stream = True
+        self.command.path = "/tmp/foo.bak"
+        self.command._save_new_backup(TEST_DATABASE)
+        self.assertTrue(os.path.exists(self.command.path))
+        # tearDown
+        os.remove(self.command.path)
+
     @patch("dbbackup.settings.DATABASES", ["db-from-settings"])
     def test_get_database_keys(self):
         with self.subTest("use --database from CLI"):
@@ -84,6 +205,7 @@ class DbbackupCommandSaveNewMongoBackupTest(TestCase):
         self.command.path = None
         self.command.connector = get_connector("default")
         self.command.schemas = []
+        self.command.stream = False
 
     def tearDown(self):
         clean_gpg_keys()
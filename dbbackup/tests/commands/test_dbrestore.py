@@ -49,6 +49,7 @@ class DbrestoreCommandRestoreBackupTest(TestCase):
         self.command.database_name = "default"
         self.command.connector = get_connector("default")
         self.command.schemas = []
+        self.command.stream = False
         HANDLED_FILES.clean()
 
     def tearDown(self):
@@ -93,6 +94,42 @@ class DbrestoreCommandRestoreBackupTest(TestCase):
         )
         self.command._restore_backup()
 
+    def test_stream(self, *args):
+        self.command.path = None
+        self.command.stream = True
+        HANDLED_FILES["written_files"].append((self.command.filename, File(get_dump())))
+        self.command._restore_backup()
+
+    def test_stream_uncompress(self, *args):
+        self.command.path = None
+        self.command.stream = True
+        compressed_file, self.command.filename = utils.compress_file(
+            get_dump(), get_dump_name()
+        )
+        HANDLED_FILES["written_files"].append(
+            (self.command.filename, File(compressed_file))
+        )
+        self.command.uncompress = True
+        with patch(
+            "dbbackup.db.sqlite.SqliteConnector.restore_dump_stream"
+        ) as mock_restore:
+            self.command._restore_backup()
+        chunks = mock_restore.call_args[0][0]
+        self.assertEqual(b"".join(chunks), get_dump().read())
+
+    @patch("dbbackup.utils.getpass", return_value=None)
+    def test_stream_decrypt(self, *args):
+        self.command.path = None
+        self.command.stream = True
+        self.command.decrypt = True
+        encrypted_file, self.command.filename = utils.encrypt_file(
+            get_dump(), get_dump_name()
+        )
+        HANDLED_FILES["written_files"].append(
+            (self.command.filename, File(encrypted_file))
+        )
+        self.command._restore_backup()
+
     def test_path(self, *args):
         temp_dump = get_dump()
         dump_path = mktemp()
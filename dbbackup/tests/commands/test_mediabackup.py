@@ -3,8 +3,14 @@ Tests for mediabackup command.
 """
 
 import contextlib
+import gzip
 import os
+import tarfile
 import tempfile
+from io import BytesIO
+from unittest.mock import Mock
+
+from django.core.files import File
 
 from django.test import TestCase
 
@@ -25,6 +31,7 @@ class MediabackupBackupMediafilesTest(TestCase):
         self.command.path = None
         self.command.media_storage = get_storage_class()()
         self.command.filename = None
+        self.command.stream = False
 
     def tearDown(self):
         if self.command.path is not None:
@@ -70,3 +77,68 @@ class MediabackupBackupMediafilesTest(TestCase):
         self.command.filename = "my_new_name.tar"
         self.command.backup_mediafiles()
         self.assertEqual(HANDLED_FILES["written_files"][0][0], self.command.filename)
+
+    def test_stream(self):
+        self.command.stream = True
+        self.command.compress = True
+        self.command.backup_mediafiles()
+        filename, outputfile = HANDLED_FILES["written_files"][0]
+        self.assertTrue(filename.endswith(".tar.gz"))
+        outputfile.seek(0)
+        self.assertEqual(
+            gzip.decompress(outputfile.read()),
+            self.command._create_tar(filename).read(),
+        )
+
+    def test_iter_tar(self):
+        tarball = b"".join(self.command._iter_tar())
+        self.assertEqual(len(tarball) % tarfile.RECORDSIZE, 0)
+        with tempfile.TemporaryFile() as fileobj:
+            fileobj.write(tarball)
+            fileobj.seek(0)
+            with tarfile.open(fileobj=fileobj, mode="r:") as tar_file:
+                names = tar_file.getnames()
+        self.assertEqual(sorted(names), sorted(self.command._explore_storage()))
+
+    def test_iter_tar_compress_members(self):
+        self.command.compress_members = True
+        self.command._explore_storage = lambda: ["foo.txt", "bar.jpg"]
+        self.command.media_storage = Mock()
+        self.command.media_storage.open.side_effect = lambda name: File(
+            BytesIO(b"foo" * 1000), name=name
+        )
+        tarball = b"".join(self.command._iter_tar())
+        with tarfile.open(fileobj=BytesIO(tarball), mode="r:") as tar_file:
+            text, image = tar_file.getmembers()
+            self.assertEqual(text.pax_headers["DBBACKUP.compression"], "gzip")
+            self.assertEqual(text.pax_headers["DBBACKUP.size"], "3000")
+            self.assertEqual(
+                gzip.decompress(tar_file.extractfile(text).read()), b"foo" * 1000
+            )
+            self.assertNotIn("DBBACKUP.compression", image.pax_headers)
+            self.assertEqual(tar_file.extractfile(image).read(), b"foo" * 1000)
+
+    def test_iter_tar_changed_file(self):
+        def open_media(name, size):
+            media_file = File(BytesIO(b"foo" * 1000), name=name)
+            media_file.size = size
+            return media_file
+
+        self.command.compress_members = False
+        self.command._explore_storage = lambda: ["foo.txt", "bar.txt"]
+        self.command.media_storage = Mock()
+        # Grown since its size was read
+        self.command.media_storage.open.side_effect = lambda name: open_media(
+            name, 2000
+        )
+        tarball = b"".join(self.command._iter_tar())
+        with tarfile.open(fileobj=BytesIO(tarball), mode="r:") as tar_file:
+            foo, bar = tar_file.getmembers()
+            self.assertEqual(tar_file.extractfile(foo).read(), (b"foo" * 1000)[:2000])
+            self.assertEqual(bar.name, "bar.txt")
+        # Shrunk since its size was read
+        self.command.media_storage.open.side_effect = lambda name: open_media(
+            name, 4000
+        )
+        with self.assertRaises(OSError):
+            b"".join(self.command._iter_tar())
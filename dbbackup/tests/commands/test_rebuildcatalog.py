@@ -0,0 +1,53 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from django.core.management import execute_from_command_line
+from django.test import TestCase
+
+from dbbackup.storage import Storage
+
+FILENAME = "default-foo-server-2015-02-06-042810.psql.gz"
+
+
+@patch("dbbackup.settings.CATALOG_PATH", "catalog")
+class RebuildcatalogCommandTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = Storage(
+            "django.core.files.storage.FileSystemStorage", location=self.location
+        )
+        for filename in (FILENAME, "foo.txt"):
+            with open(os.path.join(self.location, filename), "wb") as fd:
+                fd.write(b"foo")
+        patcher = patch(
+            "dbbackup.management.commands.rebuildcatalog.get_storage",
+            return_value=self.storage,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_func(self):
+        execute_from_command_line(["", "rebuildcatalog"])
+        (entry,) = self.storage.get_catalog().list_entries()
+        self.assertEqual(entry["name"], FILENAME)
+        self.assertEqual(entry["codec"], "gz")
+        self.assertEqual(entry["size"], 3)
+        self.assertIsNone(entry["checksum"])
+
+    def test_checksum(self):
+        execute_from_command_line(["", "rebuildcatalog", "--checksum"])
+        (entry,) = self.storage.get_catalog().list_entries()
+        self.assertEqual(entry["checksum"], hashlib.sha256(b"foo").hexdigest())
+
+    def test_no_catalog(self):
+        with (
+            patch("dbbackup.settings.CATALOG_PATH", None),
+            self.assertRaises(SystemExit),
+        ):
+            execute_from_command_line(["", "rebuildcatalog"])
@@ -0,0 +1,113 @@
+from io import BytesIO
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.core.management import execute_from_command_line
+from django.test import TestCase
+
+from dbbackup import aead, stages
+from dbbackup.storage import get_storage
+from dbbackup.tests.utils import HANDLED_FILES
+
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import x25519
+except ImportError:
+    x25519 = None
+
+
+def generate_key():
+    private_key = x25519.X25519PrivateKey.generate()
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    return public_pem, private_pem
+
+
+@skipUnless(x25519, "cryptography not installed")
+class RewrapkeysCommandTest(TestCase):
+    def setUp(self):
+        HANDLED_FILES.clean()
+        self.storage = get_storage()
+        self.old_public, self.old_private = generate_key()
+        self.new_public, self.new_private = generate_key()
+        stage = stages.AeadStage(recipients=[self.old_public])
+        self.filename = "foo-server-2015-02-06-042810.psql.aead"
+        chunks, _ = stage.apply([b"foo"], "foo")
+        self.storage.write_file(BytesIO(b"".join(chunks)), self.filename)
+        self.stage_options = {
+            "aead": {"RECIPIENTS": [self.new_public], "IDENTITIES": [self.old_private]}
+        }
+
+    def decrypt(self, identity, sidecar=True):
+        stage = stages.AeadStage(identities=[identity], sidecar=sidecar)
+        chunks, _ = stage.revert(
+            [self.storage.read_file(self.filename).read()], self.filename
+        )
+        return b"".join(chunks)
+
+    def test_func(self):
+        with patch("dbbackup.settings.STAGES", self.stage_options):
+            execute_from_command_line(["", "rewrapkeys"])
+        written = [name for name, _ in HANDLED_FILES["written_files"]]
+        self.assertIn(aead.get_sidecar_filename(self.filename), written)
+        self.assertEqual(self.decrypt(self.new_private), b"foo")
+        # The backup itself is unchanged
+        self.assertEqual(self.decrypt(self.old_private, sidecar=False), b"foo")
+
+    def test_rewrap_sidecar(self):
+        newest_public, newest_private = generate_key()
+        with patch("dbbackup.settings.STAGES", self.stage_options):
+            execute_from_command_line(["", "rewrapkeys"])
+        stage_options = {
+            "aead": {"RECIPIENTS": [newest_public], "IDENTITIES": [self.new_private]}
+        }
+        with patch("dbbackup.settings.STAGES", stage_options):
+            execute_from_command_line(["", "rewrapkeys"])
+        self.assertEqual(self.decrypt(newest_private), b"foo")
+        with self.assertRaises(aead.DecryptionError):
+            self.decrypt(self.new_private)
+
+    def test_write_fails(self):
+        with patch("dbbackup.settings.STAGES", self.stage_options):
+            execute_from_command_line(["", "rewrapkeys"])
+            with (
+                patch("dbbackup.storage.Storage.write_file", side_effect=OSError),
+                self.assertRaises(SystemExit),
+            ):
+                execute_from_command_line(["", "rewrapkeys"])
+        # The sidecar written first is kept
+        self.assertEqual(HANDLED_FILES["deleted_files"], [])
+        self.assertEqual(self.decrypt(self.new_private), b"foo")
+
+    def test_replace_sidecar(self):
+        with patch("dbbackup.settings.STAGES", self.stage_options):
+            execute_from_command_line(["", "rewrapkeys"])
+        HANDLED_FILES["deleted_files"] = []
+        self.stage_options["aead"]["IDENTITIES"] = [self.new_private]
+        with patch("dbbackup.settings.STAGES", self.stage_options):
+            execute_from_command_line(["", "rewrapkeys"])
+        sidecar_filename = aead.get_sidecar_filename(self.filename)
+        new_filename = aead.get_sidecar_filename(self.filename, new=True)
+        written = [name for name, _ in HANDLED_FILES["written_files"]]
+        # The new envelope is written before the current one is deleted
+        self.assertEqual(written[-2:], [new_filename, sidecar_filename])
+        self.assertEqual(
+            HANDLED_FILES["deleted_files"], [sidecar_filename, new_filename]
+        )
+
+    def test_dry_run(self):
+        with patch("dbbackup.settings.STAGES", self.stage_options):
+            execute_from_command_line(["", "rewrapkeys", "--dry-run"])
+        self.assertEqual(len(HANDLED_FILES["written_files"]), 1)
+
+    def test_wrong_identity(self):
+        self.stage_options["aead"]["IDENTITIES"] = [self.new_private]
+        with patch("dbbackup.settings.STAGES", self.stage_options):
+            with self.assertRaises(SystemExit):
+                execute_from_command_line(["", "rewrapkeys"])
@@ -0,0 +1,38 @@
+from io import BytesIO
+from unittest import skipUnless
+
+from django.core.management import execute_from_command_line
+from django.test import TestCase
+
+from dbbackup import dictionaries
+from dbbackup.tests.test_dictionaries import get_samples
+from dbbackup.tests.utils import HANDLED_FILES
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+@skipUnless(zstandard, "zstandard not installed")
+class ZstdtrainCommandTest(TestCase):
+    def setUp(self):
+        dictionaries._default_storage = None
+        HANDLED_FILES.clean()
+        HANDLED_FILES["written_files"] = [
+            (
+                f"foo-server-2015-02-06-04{index // 60:02d}{index % 60:02d}.psql",
+                BytesIO(sample),
+            )
+            for index, sample in enumerate(get_samples())
+        ]
+
+    def test_func(self):
+        execute_from_command_line(["", "zstdtrain", "--name", "foo", "--size", "4096"])
+        (found,) = dictionaries.list_dictionaries(name="foo")
+        self.assertEqual(found[1], 1)
+
+    def test_no_backup(self):
+        HANDLED_FILES.clean()
+        with self.assertRaises(SystemExit):
+            execute_from_command_line(["", "zstdtrain"])
@@ -1,5 +1,6 @@
 import os
 import tempfile
+from unittest import skipUnless
 from unittest.mock import patch
 
 from django.conf import settings
@@ -15,6 +16,16 @@ from dbbackup.tests.utils import (
     clean_gpg_keys,
 )
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import x25519
+except ImportError:
+    x25519 = None
+
 
 class DbBackupCommandTest(TestCase):
     def setUp(self):
@@ -236,6 +247,111 @@ class MediaRestoreCommandTest(TestCase):
         execute_from_command_line(["", "mediarestore", "--uncompress"])
         self.assertTrue(self._is_restored())
 
+    @skipUnless(zstandard, "zstandard not installed")
+    @patch("dbbackup.settings.STAGES", {"zstd": {"FRAME_SIZE": 1024}})
+    def test_seekable_path(self, *args):
+        # Create backup
+        self._create_file("foo")
+        self._create_file("bar")
+        execute_from_command_line(["", "mediabackup", "--compress-format", "zstd"])
+        self._emtpy_media()
+        # Restore without uncompressing the whole backup
+        with patch("dbbackup.stages.revert_stages", side_effect=AssertionError):
+            execute_from_command_line(
+                ["", "mediarestore", "--uncompress", "--path", "foo"]
+            )
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), ["foo"])
+
+    @skipUnless(zstandard, "zstandard not installed")
+    def test_not_seekable_path(self, *args):
+        # Create backup
+        self._create_file("foo")
+        self._create_file("bar")
+        execute_from_command_line(["", "mediabackup", "--compress-format", "zstd"])
+        self._emtpy_media()
+        # Restore by uncompressing the whole backup
+        execute_from_command_line(["", "mediarestore", "--uncompress", "--path", "foo"])
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), ["foo"])
+
+    def test_compress_members(self, *args):
+        # Create backup
+        with open(os.path.join(settings.MEDIA_ROOT, "foo.txt"), "wb") as fd:
+            fd.write(b"foo" * 1000)
+        with open(os.path.join(settings.MEDIA_ROOT, "bar.jpg"), "wb") as fd:
+            fd.write(b"bar" * 1000)
+        execute_from_command_line(["", "mediabackup", "--compress-members"])
+        filename = HANDLED_FILES["written_files"][0][0]
+        self.assertFalse(filename.endswith(".gz"))
+        self._emtpy_media()
+        # Restore
+        execute_from_command_line(["", "mediarestore"])
+        with open(os.path.join(settings.MEDIA_ROOT, "foo.txt"), "rb") as fd:
+            self.assertEqual(fd.read(), b"foo" * 1000)
+        with open(os.path.join(settings.MEDIA_ROOT, "bar.jpg"), "rb") as fd:
+            self.assertEqual(fd.read(), b"bar" * 1000)
+
+    @skipUnless(zstandard and x25519, "zstandard or cryptography not installed")
+    def test_seekable_encrypted_path(self, *args):
+        private_key = x25519.X25519PrivateKey.generate()
+        recipient = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        identity = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        stage_options = {
+            "zstd": {"FRAME_SIZE": 1024},
+            "aead": {"RECIPIENTS": [recipient], "IDENTITIES": [identity]},
+        }
+        # Create backup
+        self._create_file("foo")
+        self._create_file("bar")
+        with (
+            patch("dbbackup.settings.STAGES", stage_options),
+            patch("dbbackup.settings.ENCRYPTION_FORMAT", "aead"),
+        ):
+            execute_from_command_line(
+                ["", "mediabackup", "--compress-format", "zstd", "--encrypt"]
+            )
+            self._emtpy_media()
+            # Restore without decrypting and uncompressing the whole backup
+            with patch("dbbackup.stages.revert_stages", side_effect=AssertionError):
+                execute_from_command_line(
+                    ["", "mediarestore", "--decrypt", "--uncompress", "--path", "foo"]
+                )
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), ["foo"])
+
+    @skipUnless(x25519, "cryptography not installed")
+    def test_encrypted_not_seekable_path(self, *args):
+        private_key = x25519.X25519PrivateKey.generate()
+        recipient = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        identity = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        stage_options = {
+            "aead": {"RECIPIENTS": [recipient], "IDENTITIES": [identity]},
+        }
+        # Create backup
+        self._create_file("foo")
+        self._create_file("bar")
+        with (
+            patch("dbbackup.settings.STAGES", stage_options),
+            patch("dbbackup.settings.ENCRYPTION_FORMAT", "aead"),
+        ):
+            execute_from_command_line(["", "mediabackup", "--compress", "--encrypt"])
+            self._emtpy_media()
+            # Restore by reverting the stages of the whole backup
+            execute_from_command_line(
+                ["", "mediarestore", "--decrypt", "--uncompress", "--path", "foo"]
+            )
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), ["foo"])
+
     def test_no_backup_available(self, *args):
         with self.assertRaises(SystemExit):
             execute_from_command_line(["", "mediarestore"])
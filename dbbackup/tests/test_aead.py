@@ -0,0 +1,77 @@
+import io
+import os
+from unittest import skipUnless
+
+from django.test import TestCase
+
+from dbbackup import aead
+from dbbackup.utils import DecryptionError
+
+try:
+    from cryptography.hazmat.primitives.asymmetric import rsa, x25519
+except ImportError:
+    rsa = x25519 = None
+
+
+@skipUnless(x25519, "cryptography not installed")
+class AeadTest(TestCase):
+    def setUp(self):
+        self.data = os.urandom(1000) * 10
+        self.x25519_key = x25519.X25519PrivateKey.generate()
+        self.rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        public_keys = [self.x25519_key.public_key(), self.rsa_key.public_key()]
+        self.encrypted = b"".join(
+            aead.encrypt_chunks([self.data], public_keys, chunk_size=3000, threads=2)
+        )
+
+    def decrypt(self, encrypted, private_keys, threads=2):
+        return b"".join(aead.decrypt_chunks([encrypted], private_keys, threads))
+
+    def test_decrypt(self):
+        self.assertEqual(self.decrypt(self.encrypted, [self.x25519_key]), self.data)
+        self.assertEqual(self.decrypt(self.encrypted, [self.rsa_key]), self.data)
+
+    def test_chacha20(self):
+        encrypted = b"".join(
+            aead.encrypt_chunks(
+                [self.data], [self.x25519_key.public_key()], "chacha20-poly1305"
+            )
+        )
+        self.assertEqual(self.decrypt(encrypted, [self.x25519_key]), self.data)
+
+    def test_empty(self):
+        encrypted = b"".join(aead.encrypt_chunks([], [self.x25519_key.public_key()]))
+        self.assertEqual(self.decrypt(encrypted, [self.x25519_key]), b"")
+
+    def test_not_a_recipient(self):
+        with self.assertRaises(DecryptionError):
+            self.decrypt(self.encrypted, [x25519.X25519PrivateKey.generate()])
+
+    def test_truncated(self):
+        with self.assertRaises(DecryptionError):
+            self.decrypt(self.encrypted[: -1000 - aead.TAG_SIZE], [self.x25519_key])
+
+    def test_reordered(self):
+        header, envelope = aead.read_header(io.BytesIO(self.encrypted))
+        data_offset = len(header) + len(envelope)
+        size = 3000 + aead.TAG_SIZE
+        first = self.encrypted[data_offset : data_offset + size]
+        second = self.encrypted[data_offset + size : data_offset + size * 2]
+        encrypted = (
+            self.encrypted[:data_offset]
+            + second
+            + first
+            + self.encrypted[data_offset + size * 2 :]
+        )
+        with self.assertRaises(DecryptionError):
+            self.decrypt(encrypted, [self.x25519_key])
+
+    def test_reader(self):
+        reader = aead.DecryptingReader(io.BytesIO(self.encrypted), [self.rsa_key])
+        reader.seek(5000)
+        self.assertEqual(reader.read(2000), self.data[5000:7000])
+        self.assertEqual(reader.frames_read, 2)
+        reader.seek(-10, io.SEEK_END)
+        self.assertEqual(reader.read(), self.data[-10:])
+        reader.seek(0)
+        self.assertEqual(reader.read(), self.data)
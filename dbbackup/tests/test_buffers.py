@@ -0,0 +1,156 @@
+import os
+import subprocess
+import tempfile
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from dbbackup.buffers import MemoryBudget, SpillBuffer, SpillManager, memory_budget
+
+
+class MemoryBudgetTest(TestCase):
+    @patch("dbbackup.settings.MEMORY_BUDGET", 10)
+    def test_func(self):
+        budget = MemoryBudget()
+        self.assertTrue(budget.acquire(6))
+        self.assertFalse(budget.acquire(6))
+        budget.release(6)
+        self.assertTrue(budget.acquire(6))
+        self.assertEqual(budget.peak, 6)
+
+    @patch("dbbackup.settings.MEMORY_BUDGET", None)
+    def test_unlimited(self):
+        budget = MemoryBudget()
+        self.assertTrue(budget.acquire(2**40))
+        self.assertEqual(budget.peak, 2**40)
+
+    def test_reset_peak(self):
+        budget = MemoryBudget()
+        budget.acquire(6)
+        budget.release(4)
+        budget.reset_peak()
+        self.assertEqual(budget.peak, 2)
+
+
+class SpillManagerTest(TestCase):
+    def setUp(self):
+        self.dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+
+    def tearDown(self):
+        for dir in self.dirs:
+            os.rmdir(dir)
+
+    def test_get_dir(self):
+        with patch("dbbackup.settings.TMP_DIRS", self.dirs):
+            manager = SpillManager()
+            dirs = [manager.get_dir() for _ in range(4)]
+        self.assertEqual(dirs, self.dirs * 2)
+
+    def test_get_dir_without_space(self):
+        with patch("dbbackup.settings.TMP_DIRS", self.dirs):
+            manager = SpillManager()
+            # No directory has room, the next one is used anyway
+            self.assertEqual(manager.get_dir(expected_size=2**62), self.dirs[0])
+
+    def test_create(self):
+        with SpillManager().create(dir=self.dirs[0]) as fileobj:
+            fileobj.write(b"foo")
+            # The file is anonymous
+            self.assertEqual(os.listdir(self.dirs[0]), [])
+
+    def test_create_expected_size(self):
+        manager = SpillManager()
+        with manager.create(expected_size=1024 * 1024, dir=self.dirs[0]) as fileobj:
+            self.assertEqual(os.fstat(fileobj.fileno()).st_size, 0)
+
+
+class SpillBufferTest(TestCase):
+    def test_write_read(self):
+        buffer = SpillBuffer(max_size=10)
+        buffer.write(b"foobar")
+        self.assertFalse(buffer.spilled)
+        buffer.seek(0)
+        self.assertEqual(buffer.read(), b"foobar")
+        buffer.close()
+
+    def test_rollover(self):
+        buffer = SpillBuffer(max_size=4)
+        buffer.write(b"foo")
+        buffer.write(b"bar")
+        self.assertTrue(buffer.spilled)
+        buffer.seek(0)
+        self.assertEqual(buffer.read(), b"foobar")
+        buffer.close()
+
+    def test_no_memory(self):
+        buffer = SpillBuffer(max_size=0)
+        self.assertTrue(buffer.spilled)
+        buffer.write(b"foo")
+        self.assertEqual(buffer.seek(0, os.SEEK_END), 3)
+        buffer.close()
+
+    def test_read_view(self):
+        for max_size in (10, 0):
+            with self.subTest(max_size=max_size):
+                buffer = SpillBuffer(max_size=max_size)
+                buffer.write(b"foobar")
+                buffer.seek(0)
+                view = buffer.read_view(4)
+                self.assertIsInstance(view, memoryview)
+                self.assertEqual(view, b"foob")
+                self.assertEqual(buffer.read_view(), b"ar")
+                self.assertEqual(buffer.read_view(), b"")
+                buffer.close()
+                # Views outlive the buffer
+                self.assertEqual(view, b"foob")
+                view.release()
+
+    def test_overwrite(self):
+        buffer = SpillBuffer(max_size=10)
+        buffer.write(b"foobar")
+        buffer.seek(3)
+        buffer.write(b"BAZ!")
+        buffer.seek(0)
+        self.assertEqual(buffer.read(), b"fooBAZ!")
+        buffer.close()
+
+    def test_truncate(self):
+        for max_size in (10, 0):
+            with self.subTest(max_size=max_size):
+                buffer = SpillBuffer(max_size=max_size)
+                buffer.write(b"foobar")
+                buffer.seek(0)
+                buffer.read(6)
+                buffer.truncate(3)
+                buffer.seek(0)
+                self.assertEqual(buffer.read(), b"foo")
+                buffer.close()
+
+    def test_subprocess_output(self):
+        buffer = SpillBuffer()
+        subprocess.run(["echo", "foo"], stdout=buffer, check=True)
+        self.assertTrue(buffer.spilled)
+        buffer.seek(0)
+        self.assertEqual(buffer.read(), b"foo\n")
+        buffer.close()
+
+    def test_memory_budget(self):
+        used = memory_budget.used
+        with patch("dbbackup.settings.MEMORY_BUDGET", used + 8):
+            buffer = SpillBuffer(max_size=10)
+            buffer.write(b"foo")
+            self.assertEqual(memory_budget.used, used + 3)
+            other_buffer = SpillBuffer(max_size=10)
+            other_buffer.write(b"foobar")
+            # The budget is exhausted, the other buffer spills
+            self.assertTrue(other_buffer.spilled)
+            self.assertFalse(buffer.spilled)
+            buffer.close()
+            other_buffer.close()
+        self.assertEqual(memory_budget.used, used)
+
+    def test_expected_size(self):
+        buffer = SpillBuffer(max_size=10, expected_size=20)
+        # Content bigger than the memory part is directly written on disk
+        self.assertTrue(buffer.spilled)
+        buffer.close()
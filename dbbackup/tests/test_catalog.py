@@ -0,0 +1,209 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest.mock import patch
+
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+
+from dbbackup import catalog, streams
+from dbbackup.storage import Storage
+
+DB_FILENAME = "default-foo-server-2015-02-06-042810.psql.gz.gpg"
+MEDIA_FILENAME = "foo-server-2015-02-08-042810.tar"
+
+
+class Build_EntryTest(TestCase):
+    def test_func(self):
+        entry = catalog.build_entry(
+            DB_FILENAME, 3, "abc", database="default", servername="foo-server"
+        )
+        self.assertEqual(
+            entry,
+            {
+                "name": DB_FILENAME,
+                "database": "default",
+                "servername": "foo-server",
+                "content_type": "db",
+                "codec": "gz",
+                "encryption": "gpg",
+                "size": 3,
+                "timestamp": "2015-02-06T04:28:10",
+                "checksum": "abc",
+            },
+        )
+
+    def test_media(self):
+        entry = catalog.build_entry(MEDIA_FILENAME)
+        self.assertEqual(entry["content_type"], "media")
+        self.assertIsNone(entry["codec"])
+        self.assertIsNone(entry["encryption"])
+
+
+class Is_Backup_FilenameTest(TestCase):
+    def test_func(self):
+        self.assertTrue(catalog.is_backup_filename(DB_FILENAME))
+        self.assertFalse(catalog.is_backup_filename("foo.psql"))
+        self.assertFalse(catalog.is_backup_filename(f"{DB_FILENAME}.envelope"))
+
+
+class HashingReaderTest(TestCase):
+    def test_func(self):
+        reader = catalog.HashingReader(streams.open_chunks([b"foo", b"bar"]))
+        self.assertFalse(reader.seekable())
+        self.assertEqual(reader.read(), b"foobar")
+        self.assertEqual(reader.size, 6)
+        self.assertEqual(reader.hexdigest(), hashlib.sha256(b"foobar").hexdigest())
+
+
+class CatalogTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=self.location)
+        self.catalog = catalog.Catalog(self.storage, "catalog")
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def list_files(self):
+        return sorted(os.listdir(os.path.join(self.location, "catalog")))
+
+    def test_empty(self):
+        self.assertEqual(self.catalog.load(), {})
+
+    def test_add_remove(self):
+        self.catalog.add(catalog.build_entry(DB_FILENAME))
+        self.catalog.add(catalog.build_entry(MEDIA_FILENAME))
+        self.catalog.remove(DB_FILENAME)
+        entries = catalog.Catalog(self.storage, "catalog").list_entries()
+        self.assertEqual([e["name"] for e in entries], [MEDIA_FILENAME])
+
+    @patch("dbbackup.catalog.COMPACT_SIZE", 3)
+    def test_compact(self):
+        self.catalog.add(catalog.build_entry(DB_FILENAME))
+        self.catalog.add(catalog.build_entry(MEDIA_FILENAME))
+        self.assertEqual(len(self.list_files()), 2)
+        self.catalog.remove(DB_FILENAME)
+        (snapshot,) = self.list_files()
+        self.assertTrue(snapshot.startswith(catalog.SNAPSHOT_PREFIX))
+        self.catalog.add(catalog.build_entry(DB_FILENAME))
+        self.assertEqual(len(self.list_files()), 2)
+        self.assertEqual(
+            sorted(self.catalog.load()), sorted([DB_FILENAME, MEDIA_FILENAME])
+        )
+
+    def test_late_clock(self):
+        self.catalog.add(catalog.build_entry(DB_FILENAME))
+        self.catalog.compact()
+        # Journal written before the snapshot by its key
+        with patch("dbbackup.catalog.time.time_ns", return_value=1):
+            self.catalog.add(catalog.build_entry(MEDIA_FILENAME))
+            self.assertEqual(
+                sorted(self.catalog.load()), sorted([DB_FILENAME, MEDIA_FILENAME])
+            )
+            self.catalog.compact()
+        (snapshot,) = self.list_files()
+        self.assertTrue(snapshot.startswith(catalog.SNAPSHOT_PREFIX))
+        self.assertEqual(
+            sorted(self.catalog.load()), sorted([DB_FILENAME, MEDIA_FILENAME])
+        )
+
+    def test_journal_during_compaction(self):
+        self.catalog.add(catalog.build_entry(DB_FILENAME))
+        load = self.catalog._load
+
+        def add_then_load():
+            loaded = load()
+            catalog.Catalog(self.storage, "catalog").add(
+                catalog.build_entry(MEDIA_FILENAME)
+            )
+            return loaded
+
+        with patch.object(self.catalog, "_load", side_effect=add_then_load):
+            self.catalog.compact()
+        self.assertEqual(len(self.list_files()), 2)
+        self.assertEqual(
+            sorted(self.catalog.load()), sorted([DB_FILENAME, MEDIA_FILENAME])
+        )
+
+    def test_concurrent_compaction(self):
+        self.catalog.add(catalog.build_entry(DB_FILENAME))
+        other = catalog.Catalog(self.storage, "catalog")
+        load = self.catalog._load
+
+        def compact_then_load():
+            loaded = load()
+            # Deletes the journal read here, and writes an earlier snapshot
+            other.add(catalog.build_entry(MEDIA_FILENAME))
+            other.compact()
+            return loaded
+
+        with patch.object(self.catalog, "_load", side_effect=compact_then_load):
+            self.catalog.compact()
+        self.assertEqual(len(self.list_files()), 1)
+        self.assertEqual(
+            sorted(self.catalog.load()), sorted([DB_FILENAME, MEDIA_FILENAME])
+        )
+
+    def test_rebuild(self):
+        self.catalog.add(catalog.build_entry(DB_FILENAME))
+        self.catalog.rebuild([catalog.build_entry(MEDIA_FILENAME)])
+        (snapshot,) = self.list_files()
+        self.assertTrue(snapshot.startswith(catalog.SNAPSHOT_PREFIX))
+        self.assertEqual(list(self.catalog.load()), [MEDIA_FILENAME])
+        self.catalog.remove(MEDIA_FILENAME)
+        self.assertEqual(self.catalog.load(), {})
+
+
+@patch("dbbackup.settings.CATALOG_PATH", "catalog")
+class StorageCatalogTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = Storage(
+            "django.core.files.storage.FileSystemStorage", location=self.location
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_write_file(self):
+        self.storage.write_file(BytesIO(b"foo"), DB_FILENAME, database="default")
+        (entry,) = self.storage.get_catalog().list_entries()
+        self.assertEqual(entry["name"], DB_FILENAME)
+        self.assertEqual(entry["database"], "default")
+        self.assertEqual(entry["size"], 3)
+        self.assertEqual(entry["checksum"], hashlib.sha256(b"foo").hexdigest())
+
+    def test_write_stream(self):
+        self.storage.write_file(streams.open_chunks([b"foo", b"bar"]), DB_FILENAME)
+        (entry,) = self.storage.get_catalog().list_entries()
+        self.assertEqual(entry["size"], 6)
+        self.assertEqual(entry["checksum"], hashlib.sha256(b"foobar").hexdigest())
+        with open(os.path.join(self.location, DB_FILENAME), "rb") as fd:
+            self.assertEqual(fd.read(), b"foobar")
+
+    def test_not_a_backup(self):
+        self.storage.write_file(BytesIO(b"foo"), f"{DB_FILENAME}.envelope")
+        self.assertEqual(self.storage.get_catalog().load(), {})
+
+    def test_delete_file(self):
+        self.storage.write_file(BytesIO(b"foo"), DB_FILENAME)
+        self.storage.delete_file(DB_FILENAME)
+        self.assertEqual(self.storage.get_catalog().load(), {})
+
+    def test_queries(self):
+        self.storage.write_file(BytesIO(b"foo"), DB_FILENAME)
+        self.storage.write_file(BytesIO(b"foo"), MEDIA_FILENAME)
+        with patch.object(self.storage, "list_directory") as list_directory:
+            self.assertEqual(
+                self.storage.list_backups(content_type="media"), [MEDIA_FILENAME]
+            )
+            self.assertEqual(
+                self.storage.get_latest_backup(encrypted=True), DB_FILENAME
+            )
+            self.storage.clean_old_backups(content_type="db", keep_number=0)
+        list_directory.assert_not_called()
+        self.assertEqual(self.storage.list_backups(), [MEDIA_FILENAME])
+        self.assertFalse(os.path.exists(os.path.join(self.location, DB_FILENAME)))
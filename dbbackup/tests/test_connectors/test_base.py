@@ -1,10 +1,19 @@
 import os
+from io import BytesIO
 from tempfile import SpooledTemporaryFile
+from unittest.mock import patch
 
 from django.test import TestCase
 
+from dbbackup import streams
+from dbbackup.buffers import SpillBuffer
 from dbbackup.db import exceptions
-from dbbackup.db.base import BaseCommandDBConnector, BaseDBConnector, get_connector
+from dbbackup.db.base import (
+    BaseCommandDBConnector,
+    BaseDBConnector,
+    CommandStream,
+    get_connector,
+)
 
 
 class GetConnectorTest(TestCase):
@@ -26,6 +35,51 @@ class BaseDBConnectorTest(TestCase):
         connector.generate_filename()
 
 
+class FileDBConnector(BaseDBConnector):
+    """Connector only implementing the file API."""
+
+    def _create_dump(self):
+        return BytesIO(b"foobar")
+
+    def _restore_dump(self, dump):
+        self.restored = dump
+        return dump.read()
+
+
+class BaseDBConnectorStreamTest(TestCase):
+    def test_stream_dump(self):
+        connector = FileDBConnector()
+        self.assertEqual(b"".join(connector.stream_dump()), b"foobar")
+
+    def test_restore_dump_stream(self):
+        connector = FileDBConnector()
+        result = connector.restore_dump_stream([b"foo", b"bar"])
+        self.assertEqual(result, b"foobar")
+        self.assertTrue(connector.restored.seekable())
+
+
+class EchoCommandDBConnector(BaseCommandDBConnector):
+    supports_streaming = True
+
+    def _create_dump(self):
+        stdout, _ = self.run_command("echo foo")
+        self.stream_output_used = isinstance(stdout, CommandStream)
+        return stdout
+
+
+class LegacyCommandDBConnector(BaseCommandDBConnector):
+    """Command connector only implementing the file API."""
+
+    def _create_dump(self):
+        stdout, _ = self.run_command("echo foo")
+        self.stream_output_used = isinstance(stdout, CommandStream)
+        return stdout
+
+    def _restore_dump(self, dump):
+        self.restored = dump
+        return dump.read()
+
+
 class BaseCommandDBConnectorTest(TestCase):
     def test_run_command(self):
         connector = BaseCommandDBConnector()
@@ -48,6 +102,86 @@ class BaseCommandDBConnectorTest(TestCase):
         self.assertEqual(stdout.read(), b"foo")
         self.assertFalse(stderr.read())
 
+    def test_run_command_stdin_spill_buffer(self):
+        connector = BaseCommandDBConnector()
+        for max_size in (0, 1024):
+            stdin = SpillBuffer(max_size=max_size)
+            stdin.write(b"foo")
+            stdin.seek(0)
+            stdout, stderr = connector.run_command("cat", stdin=stdin)
+            self.assertEqual(stdout.read(), b"foo")
+            stdin.close()
+
+    def test_run_command_stdin_without_fileno(self):
+        connector = BaseCommandDBConnector()
+        stdin = streams.open_chunks([b"foo", b"bar"])
+        stdout, stderr = connector.run_command("cat", stdin=stdin)
+        self.assertEqual(stdout.read(), b"foobar")
+
+    def test_run_command_stdin_error(self):
+        def chunks():
+            yield b"foo"
+            raise EOFError("truncated")
+
+        connector = BaseCommandDBConnector()
+        stdin = streams.open_chunks(chunks())
+        with self.assertRaises(EOFError):
+            connector.run_command("cat", stdin=stdin)
+
+    def test_run_command_stream(self):
+        connector = BaseCommandDBConnector()
+        stdout, stderr = connector.run_command("echo 123", stream=True)
+        self.assertFalse(stdout.seekable())
+        self.assertEqual(stdout.read(), b"123\n")
+        self.assertEqual(stderr.read(), b"")
+
+    def test_run_command_stream_error(self):
+        connector = BaseCommandDBConnector()
+        stdout, stderr = connector.run_command(
+            "sh -c 'echo foo; echo bar >&2; exit 1'", stream=True
+        )
+        with self.assertRaises(exceptions.CommandConnectorError) as context:
+            stdout.read()
+        self.assertIn("bar", str(context.exception))
+
+    def test_run_command_stream_stderr_tail(self):
+        connector = BaseCommandDBConnector(stderr_tail_size=4)
+        stdout, stderr = connector.run_command(
+            "sh -c 'echo foobarbaz >&2'", stream=True
+        )
+        stdout.read()
+        self.assertEqual(stderr.read(), b"baz\n")
+        self.assertEqual(stderr.size, 10)
+
+    def test_run_command_stream_close(self):
+        connector = BaseCommandDBConnector()
+        stdout, stderr = connector.run_command("yes", stream=True)
+        self.assertEqual(stdout.read(4), b"y\ny\n")
+        stdout.close()
+        self.assertIsNotNone(stdout.process.returncode)
+
+    def test_stream_dump(self):
+        connector = EchoCommandDBConnector()
+        self.assertEqual(b"".join(connector.stream_dump()), b"foo\n")
+        self.assertTrue(connector.stream_output_used)
+        self.assertFalse(connector._stream_output)
+
+    @patch("dbbackup.db.base.BaseCommandDBConnector.restore_dump")
+    def test_restore_dump_stream(self, mock_restore_dump):
+        connector = BaseCommandDBConnector(supports_streaming=True)
+        connector.restore_dump_stream([b"foo", b"bar"])
+        dump = mock_restore_dump.call_args[0][0]
+        self.assertFalse(dump.seekable())
+        self.assertEqual(dump.read(), b"foobar")
+
+    def test_stream_legacy_connector(self):
+        connector = LegacyCommandDBConnector()
+        self.assertEqual(b"".join(connector.stream_dump()), b"foo\n")
+        # The dump command's output was fully read before returning
+        self.assertFalse(connector.stream_output_used)
+        self.assertEqual(connector.restore_dump_stream([b"foo", b"bar"]), b"foobar")
+        self.assertTrue(connector.restored.seekable())
+
     def test_run_command_with_env(self):
         connector = BaseCommandDBConnector()
         # Empty env
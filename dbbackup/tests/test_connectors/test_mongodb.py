@@ -117,3 +117,27 @@ class MongoDumpConnectorTest(TestCase):
         connector.drop = True
         connector.restore_dump(dump)
         self.assertIn(" --drop", mock_restore_cmd.call_args[0][0])
+
+    def test_native_compression(self, mock_run_command):
+        connector = MongoDumpConnector()
+        connector.native_compression = "gzip"
+        dump = connector.create_dump()
+        self.assertIn(" --gzip", mock_run_command.call_args[0][0])
+        connector.restore_dump(dump)
+        self.assertIn(" --gzip", mock_run_command.call_args[0][0])
+        self.assertIsNotNone(connector.get_native_compression_stage())
+
+    def test_native_compression_from_filename(self, mock_run_command):
+        connector = MongoDumpConnector()
+        connector.native_compression = "gzip"
+        filename = connector.generate_filename()
+        self.assertTrue(filename.endswith(".gz.dump"))
+        # The settings changed since the backup was made
+        connector = MongoDumpConnector()
+        connector.restore_filename = f"{filename}.gpg"
+        connector.restore_dump(BytesIO(b"foo"))
+        self.assertIn(" --gzip", mock_run_command.call_args[0][0])
+        connector.restore_filename = "default-foo-2015-02-06-042810.dump"
+        connector.native_compression = "gzip"
+        connector.restore_dump(BytesIO(b"foo"))
+        self.assertNotIn(" --gzip", mock_run_command.call_args[0][0])
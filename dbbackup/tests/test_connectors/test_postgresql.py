@@ -172,6 +172,22 @@ class PgDumpConnectorTest(TestCase):
         self.connector.restore_dump(dump)
         self.assertNotIn("secret", mock_dump_cmd.call_args[0][0])
 
+    def test_create_dump_native_compression(self, mock_dump_cmd):
+        self.assertIsNone(self.connector.get_native_compression_stage())
+        self.connector.native_compression = "zstd:3"
+        self.connector.create_dump()
+        self.assertIn(" --compress=zstd:3", mock_dump_cmd.call_args[0][0])
+        stage = self.connector.get_native_compression_stage()
+        self.assertEqual(stage.get_applied_filename("foo.psql"), "foo.psql.zst")
+
+    def test_native_compression_level(self, mock_dump_cmd):
+        for level in ("6", 6):
+            self.connector.native_compression = level
+            stage = self.connector.get_native_compression_stage()
+            self.assertEqual(stage.get_applied_filename("foo.psql"), "foo.psql.gz")
+        self.connector.native_compression = "0"
+        self.assertIsNone(self.connector.get_native_compression_stage())
+
 
 @patch(
     "dbbackup.db.postgresql.PgDumpBinaryConnector.run_command",
@@ -194,6 +210,14 @@ class PgDumpBinaryConnectorTest(TestCase):
         self.assertTrue(mock_dump_cmd.called)
         self.assertIn("--format=custom", mock_dump_cmd.call_args[0][0])
 
+    def test_create_dump_native_compression(self, mock_dump_cmd):
+        self.connector.native_compression = "lz4"
+        self.connector.create_dump()
+        self.assertIn(" --compress=lz4", mock_dump_cmd.call_args[0][0])
+        # Compressed inside the custom format
+        stage = self.connector.get_native_compression_stage()
+        self.assertEqual(stage.get_applied_filename("foo.psql.bin"), "foo.psql.bin")
+
     def test_create_dump_exclude(self, mock_dump_cmd):
         # Without
         self.connector.create_dump()
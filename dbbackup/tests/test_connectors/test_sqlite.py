@@ -1,5 +1,7 @@
+import os
+import tempfile
 from io import BytesIO
-from unittest.mock import mock_open, patch
+from unittest.mock import Mock, mock_open, patch
 
 from django.db import connection
 from django.test import TestCase
@@ -51,6 +53,17 @@ class SqliteConnectorTest(TestCase):
         dump = connector.create_dump()
         self.assertTrue(dump.read())
 
+    def test_stream_dump(self):
+        CharModel.objects.create(field="foo")
+        connector = SqliteConnector()
+        chunks = list(connector.stream_dump())
+        self.assertEqual(b"".join(chunks), connector.create_dump().read())
+
+    def test_restore_dump_stream(self):
+        TextModel.objects.create(field="T\nf\nw\nnl")
+        connector = SqliteConnector()
+        connector.restore_dump_stream(connector.stream_dump())
+
 
 @patch("dbbackup.db.sqlite.open", mock_open(read_data=b"foo"), create=True)
 class SqliteCPConnectorTest(TestCase):
@@ -65,3 +78,38 @@ class SqliteCPConnectorTest(TestCase):
         connector = SqliteCPConnector()
         dump = connector.create_dump()
         connector.restore_dump(dump)
+
+    def test_stream_dump(self):
+        connector = SqliteCPConnector()
+        self.assertEqual(b"".join(connector.stream_dump()), b"foo")
+
+
+class SqliteCPConnectorStreamTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "db.sqlite3")
+        with open(self.path, "wb") as db_file:
+            db_file.write(b"foo")
+        self.connector = SqliteCPConnector()
+        self.connector.connection = Mock(settings_dict={"NAME": self.path})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_restore_dump_stream(self):
+        self.connector.restore_dump_stream([b"bar", b"baz"])
+        with open(self.path, "rb") as db_file:
+            self.assertEqual(db_file.read(), b"barbaz")
+        self.assertEqual(os.listdir(self.directory.name), ["db.sqlite3"])
+
+    def test_restore_dump_stream_error(self):
+        def chunks():
+            yield b"bar"
+            raise EOFError("truncated")
+
+        with self.assertRaises(EOFError):
+            self.connector.restore_dump_stream(chunks())
+        # The database is left as it was
+        with open(self.path, "rb") as db_file:
+            self.assertEqual(db_file.read(), b"foo")
+        self.assertEqual(os.listdir(self.directory.name), ["db.sqlite3"])
@@ -0,0 +1,88 @@
+import random
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from dbbackup import dictionaries, stages
+from dbbackup.storage import get_storage
+from dbbackup.tests.utils import HANDLED_FILES
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def get_samples(count=100):
+    random.seed(0)
+    return [
+        b"".join(
+            b"CREATE TABLE tenant_%d_%d (id integer, name text);\n"
+            % (index, random.randint(0, 100))
+            for _ in range(20)
+        )
+        for index in range(count)
+    ]
+
+
+@skipUnless(zstandard, "zstandard not installed")
+class DictionariesTest(TestCase):
+    def setUp(self):
+        HANDLED_FILES.clean()
+        dictionaries._cache.clear()
+        dictionaries._default_storage = None
+        self.storage = get_storage()
+        self.data = dictionaries.train_dictionary(get_samples(), 4096)
+
+    def test_save_dictionary(self):
+        filename = dictionaries.save_dictionary(self.data, "foo", self.storage)
+        self.assertTrue(
+            filename.startswith(f"{dictionaries.DIRECTORY}/zstd-dictionary-foo-1-")
+        )
+        filename = dictionaries.save_dictionary(self.data, "foo", self.storage)
+        self.assertTrue(
+            filename.startswith(f"{dictionaries.DIRECTORY}/zstd-dictionary-foo-2-")
+        )
+        dictionaries.save_dictionary(self.data, "bar", self.storage)
+        found = dictionaries.list_dictionaries(self.storage, "foo")
+        self.assertEqual([version for _, version, _, _ in found], [1, 2])
+
+    def test_get_dictionary(self):
+        with self.assertRaises(dictionaries.DictionaryNotFound):
+            dictionaries.get_latest_dictionary("foo", self.storage)
+        dictionaries.save_dictionary(self.data, "foo", self.storage)
+        dictionary = dictionaries.get_latest_dictionary("foo", self.storage)
+        self.assertEqual(dictionary.as_bytes(), self.data)
+        self.assertIs(
+            dictionaries.get_dictionary_by_id(dictionary.dict_id(), self.storage),
+            dictionary,
+        )
+        with self.assertRaises(dictionaries.DictionaryNotFound):
+            dictionaries.get_dictionary_by_id(42, self.storage)
+
+    def test_listing_kept(self):
+        dictionaries.save_dictionary(self.data, "foo", self.storage)
+        with patch.object(
+            self.storage, "list_directory", wraps=self.storage.list_directory
+        ) as list_directory:
+            dictionary = dictionaries.get_latest_dictionary("foo", self.storage)
+            dictionaries._cache.clear()
+            dictionaries.get_dictionary_by_id(dictionary.dict_id(), self.storage)
+            list_directory.assert_not_called()
+            # An unknown id lists the storage again, only the dictionaries
+            with self.assertRaises(dictionaries.DictionaryNotFound):
+                dictionaries.get_dictionary_by_id(42, self.storage)
+            list_directory.assert_called_once_with(dictionaries.DIRECTORY)
+
+    def test_stage(self):
+        dictionaries.save_dictionary(self.data, "foo", self.storage)
+        data = get_samples(101)[-1]
+        stage = stages.get_stage("zstd", dictionary="foo")
+        compressed = b"".join(stage.apply([data], "foo")[0])
+        plain = b"".join(stages.get_stage("zstd").apply([data], "foo")[0])
+        self.assertLess(len(compressed), len(plain))
+        # Dictionary found from the backup, even if not in memory
+        dictionaries._cache.clear()
+        chunks, _ = stages.get_stage("zstd").revert([compressed], "foo.zst")
+        self.assertEqual(b"".join(chunks), data)
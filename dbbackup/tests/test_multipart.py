@@ -0,0 +1,522 @@
+import io
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import skipUnless
+from unittest.mock import Mock, patch
+
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+
+from dbbackup import buffers, multipart, pagecache, streams
+from dbbackup.storage import Storage
+from dbbackup.tests.utils import FakeStorage
+
+try:
+    import storages
+except ImportError:
+    storages = None
+
+FILESYSTEM_MAPPING = {
+    "django.core.files.storage.filesystem.FileSystemStorage": (
+        "dbbackup.multipart.FileSystemMultipartUploader"
+    )
+}
+FILESYSTEM_DOWNLOADER_MAPPING = {
+    "django.core.files.storage.filesystem.FileSystemStorage": (
+        "dbbackup.multipart.FileSystemRangedDownloader"
+    )
+}
+
+
+class Read_PartsTest(TestCase):
+    def test_func(self):
+        parts = list(multipart.read_parts(BytesIO(b"foobarba"), 3))
+        self.assertEqual(parts, [(1, b"foo"), (2, b"bar"), (3, b"ba")])
+
+    def test_exact(self):
+        parts = list(multipart.read_parts(BytesIO(b"foobar"), 3))
+        self.assertEqual(parts, [(1, b"foo"), (2, b"bar")])
+
+    def test_empty(self):
+        self.assertEqual(list(multipart.read_parts(BytesIO(), 3)), [(1, b"")])
+
+    def test_skip(self):
+        parts = list(multipart.read_parts(BytesIO(b"foobarba"), 3, skip={1, 3}))
+        self.assertEqual(parts, [(2, b"bar")])
+
+    def test_skip_stream(self):
+        fileobj = streams.open_chunks([b"foo", b"bar"])
+        parts = list(multipart.read_parts(fileobj, 3, skip={1}))
+        self.assertEqual(parts, [(2, b"bar")])
+
+    def test_short_reads(self):
+        fileobj = streams.open_chunks([b"fo", b"ob", b"ar"])
+        parts = list(multipart.read_parts(fileobj, 4))
+        self.assertEqual(parts, [(1, b"foob"), (2, b"ar")])
+
+    def test_part_size_function(self):
+        fileobj = BytesIO(b"foobarbazqux")
+        parts = list(multipart.read_parts(fileobj, lambda n: 2 * n, skip={2}))
+        self.assertEqual(parts, [(1, b"fo"), (3, b"bazqux")])
+
+
+@patch.dict(multipart.UPLOADER_MAPPING, FILESYSTEM_MAPPING)
+class Get_UploaderTest(TestCase):
+    def test_func(self):
+        uploader = multipart.get_uploader(FileSystemStorage(location="/tmp"))
+        self.assertIsInstance(uploader, multipart.FileSystemMultipartUploader)
+
+    def test_no_uploader(self):
+        self.assertIsNone(multipart.get_uploader(FakeStorage()))
+
+
+class FileSystemMultipartUploaderTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.uploader = multipart.FileSystemMultipartUploader(
+            FileSystemStorage(location=self.location)
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_upload(self):
+        data = os.urandom(10000)
+        self.uploader.upload(BytesIO(data), "foo/bar", part_size=1000, concurrency=4)
+        with open(os.path.join(self.location, "foo", "bar"), "rb") as fd:
+            self.assertEqual(fd.read(), data)
+        self.assertEqual(os.listdir(os.path.join(self.location, ".multipart")), [])
+
+    def test_part_layout(self):
+        self.uploader.max_parts = 10
+        self.uploader.max_part_size = 1000
+        self.assertEqual(self.uploader.get_part_layout(100, 5001), (501, None))
+        self.assertEqual(self.uploader.get_part_layout(100, 500), (100, None))
+        # Unknown size, doubled every part
+        self.assertEqual(self.uploader.get_part_layout(100), (100, 1))
+        sizes = [self.uploader.get_part_size(100, 1, n) for n in range(1, 6)]
+        self.assertEqual(sizes, [100, 200, 400, 800, 1000])
+        self.uploader.max_parts = None
+        self.assertEqual(self.uploader.get_part_layout(100, 5001), (100, None))
+
+    def test_max_parts(self):
+        self.uploader.max_parts = 10
+        data = os.urandom(10000)
+        for fileobj in (BytesIO(data), streams.open_chunks([data])):
+            with patch.object(
+                self.uploader, "upload_part", wraps=self.uploader.upload_part
+            ) as upload_part:
+                self.uploader.upload(fileobj, "foo", part_size=100)
+            self.assertLessEqual(upload_part.call_count, 10)
+            with open(os.path.join(self.location, "foo"), "rb") as fd:
+                self.assertEqual(fd.read(), data)
+
+    @patch("dbbackup.settings.UPLOAD_RETRIES", 0)
+    def test_abort(self):
+        with (
+            patch.object(self.uploader, "complete", side_effect=OSError),
+            self.assertRaises(OSError),
+        ):
+            self.uploader.upload(BytesIO(b"foo"), "foo", part_size=1)
+        self.assertEqual(os.listdir(os.path.join(self.location, ".multipart")), [])
+        self.assertFalse(os.path.exists(os.path.join(self.location, "foo")))
+
+
+@patch.dict(multipart.DOWNLOADER_MAPPING, FILESYSTEM_DOWNLOADER_MAPPING)
+class Get_DownloaderTest(TestCase):
+    def test_func(self):
+        downloader = multipart.get_downloader(FileSystemStorage(location="/tmp"))
+        self.assertIsInstance(downloader, multipart.FileSystemRangedDownloader)
+
+    def test_no_downloader(self):
+        self.assertIsNone(multipart.get_downloader(FakeStorage()))
+
+
+@patch("dbbackup.settings.UPLOAD_RETRY_DELAY", 0)
+class RangedReaderTest(TestCase):
+    def setUp(self):
+        self.data = os.urandom(10000)
+        self.downloader = Mock()
+        self.downloader.read_range.side_effect = lambda name, start, end: (
+            self.data[start:end]
+        )
+        self.reader = multipart.RangedReader(
+            self.downloader, "foo", len(self.data), range_size=1000, concurrency=3
+        )
+
+    def tearDown(self):
+        self.reader.close()
+
+    def test_read(self):
+        self.assertEqual(self.reader.read(), self.data)
+        self.assertEqual(self.reader.ranges_read, 10)
+        self.assertEqual(self.downloader.read_range.call_count, 10)
+
+    def test_read_ahead(self):
+        self.assertEqual(self.reader.read(10), self.data[:10])
+        self.assertEqual([index for index, _ in self.reader._pending], [1, 2, 3])
+
+    def test_seek(self):
+        self.reader.seek(5500)
+        self.assertEqual(self.reader.read(1000), self.data[5500:6500])
+        self.reader.seek(-10, io.SEEK_END)
+        self.assertEqual(self.reader.read(), self.data[-10:])
+        self.reader.seek(0)
+        self.assertEqual(self.reader.read(), self.data)
+        self.assertEqual(self.reader.tell(), len(self.data))
+
+    @patch("dbbackup.settings.UPLOAD_RETRIES", 1)
+    def test_retry(self):
+        read_range = self.downloader.read_range.side_effect
+        short_reads = [b"short"]
+
+        def side_effect(name, start, end):
+            if start == 2000 and short_reads:
+                return short_reads.pop()
+            return read_range(name, start, end)
+
+        self.downloader.read_range.side_effect = side_effect
+        self.assertEqual(self.reader.read(), self.data)
+        self.assertEqual(self.downloader.read_range.call_count, 11)
+
+    def test_empty(self):
+        reader = multipart.RangedReader(self.downloader, "foo", 0)
+        self.assertEqual(reader.read(), b"")
+        self.downloader.read_range.assert_not_called()
+        reader.close()
+
+
+@patch("dbbackup.settings.UPLOAD_RETRY_DELAY", 0)
+class Call_With_RetriesTest(TestCase):
+    def test_func(self):
+        func = Mock(side_effect=[OSError, OSError, "foo"])
+        self.assertEqual(multipart.call_with_retries(func, "bar", retries=2), "foo")
+        self.assertEqual(func.call_count, 3)
+        func.assert_called_with("bar")
+
+    def test_fail(self):
+        func = Mock(side_effect=OSError)
+        with self.assertRaises(OSError):
+            multipart.call_with_retries(func, retries=2)
+        self.assertEqual(func.call_count, 3)
+
+
+@patch("dbbackup.settings.UPLOAD_RETRY_DELAY", 0)
+class UploadCheckpointTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.checkpoint_dir = os.path.join(self.location, "checkpoints")
+        self.uploader = multipart.FileSystemMultipartUploader(
+            FileSystemStorage(location=self.location)
+        )
+        self.data = os.urandom(10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def fail_part(self, failing):
+        upload_part = self.uploader.upload_part
+
+        def side_effect(upload_id, name, number, data):
+            if number == failing:
+                raise OSError("Connection reset")
+            return upload_part(upload_id, name, number, data)
+
+        return patch.object(self.uploader, "upload_part", side_effect=side_effect)
+
+    def upload(self, fileobj, checkpoint=None):
+        checkpoint = checkpoint or multipart.UploadCheckpoint(
+            "foo", self.checkpoint_dir
+        )
+        self.uploader.upload(fileobj, "foo", 1000, 2, checkpoint)
+
+    @patch("dbbackup.settings.UPLOAD_RETRIES", 2)
+    def test_resume(self):
+        with self.fail_part(7) as upload_part, self.assertRaises(OSError):
+            self.upload(BytesIO(self.data))
+        self.assertEqual(
+            len([c for c in upload_part.call_args_list if c.args[2] == 7]), 3
+        )
+        self.assertFalse(os.path.exists(os.path.join(self.location, "foo")))
+        (checkpoint,) = multipart.list_checkpoints(self.checkpoint_dir)
+        self.assertEqual(checkpoint.name, "foo")
+        self.assertNotIn(7, checkpoint.parts)
+        done = set(checkpoint.parts)
+
+        with (
+            patch.object(
+                self.uploader, "upload_part", wraps=self.uploader.upload_part
+            ) as upload_part,
+            checkpoint.open_data() as data,
+        ):
+            self.upload(data, checkpoint)
+        numbers = {c.args[2] for c in upload_part.call_args_list}
+        self.assertEqual(numbers, set(range(1, 11)) - done)
+        with open(os.path.join(self.location, "foo"), "rb") as fd:
+            self.assertEqual(fd.read(), self.data)
+        self.assertEqual(multipart.list_checkpoints(self.checkpoint_dir), [])
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    @patch("dbbackup.settings.UPLOAD_RETRIES", 0)
+    def test_truncated_journal(self):
+        with self.fail_part(3), self.assertRaises(OSError):
+            self.upload(BytesIO(self.data))
+        (checkpoint,) = multipart.list_checkpoints(self.checkpoint_dir)
+        with open(checkpoint.path, "a") as fd:
+            fd.write('[4, "/tm')
+        (loaded,) = multipart.list_checkpoints(self.checkpoint_dir)
+        self.assertEqual(loaded.parts, checkpoint.parts)
+        self.assertEqual(loaded.upload_id, checkpoint.upload_id)
+
+    @patch("dbbackup.settings.UPLOAD_RETRIES", 0)
+    def test_stream(self):
+        with self.fail_part(3), self.assertRaises(OSError):
+            self.upload(streams.open_chunks([self.data]))
+        self.assertFalse(os.path.exists(self.checkpoint_dir))
+
+    def test_killed(self):
+        def kill(upload_id, name, number, data):
+            # Data is kept before the upload
+            self.assertEqual(len(os.listdir(self.checkpoint_dir)), 2)
+            raise KeyboardInterrupt
+
+        with (
+            patch.object(self.uploader, "upload_part", side_effect=kill),
+            patch(
+                "dbbackup.pagecache.copy_to_path", wraps=pagecache.copy_to_path
+            ) as copy_to_path,
+            self.assertRaises(KeyboardInterrupt),
+        ):
+            self.upload(BytesIO(self.data))
+        # Not copied again once interrupted
+        self.assertEqual(copy_to_path.call_count, 1)
+        (checkpoint,) = multipart.list_checkpoints(self.checkpoint_dir)
+        with checkpoint.open_data() as data:
+            self.upload(data, checkpoint)
+        with open(os.path.join(self.location, "foo"), "rb") as fd:
+            self.assertEqual(fd.read(), self.data)
+
+    def test_link_data(self):
+        with buffers.spill_manager.create(dir=self.location) as fileobj:
+            try:
+                os.link(f"/proc/self/fd/{fileobj.fileno()}", f"{self.location}/link")
+            except OSError:
+                self.skipTest("Open files cannot be linked")
+            fileobj.write(self.data)
+            fileobj.seek(0)
+            with self.fail_part(3), self.assertRaises(OSError):
+                self.upload(fileobj)
+            (checkpoint,) = multipart.list_checkpoints(self.checkpoint_dir)
+            self.assertEqual(
+                os.stat(checkpoint.data_path).st_ino, os.fstat(fileobj.fileno()).st_ino
+            )
+        with checkpoint.open_data() as data:
+            self.assertEqual(data.read(), self.data)
+
+    def test_corrupt_checkpoint(self):
+        os.makedirs(self.checkpoint_dir)
+        checkpoint = multipart.UploadCheckpoint("foo", self.checkpoint_dir)
+        open(checkpoint.data_path, "wb").close()
+        for content in ("", '{"name": "fo'):
+            with open(checkpoint.path, "w") as fd:
+                fd.write(content)
+            self.assertEqual(multipart.list_checkpoints(self.checkpoint_dir), [])
+            # Its data cannot be resumed either
+            self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    def test_orphan_data(self):
+        os.makedirs(self.checkpoint_dir)
+        checkpoint = multipart.UploadCheckpoint("foo", self.checkpoint_dir)
+        for path in (checkpoint.data_path, f"{checkpoint.data_path}.tmp"):
+            open(path, "wb").close()
+        self.assertEqual(multipart.list_checkpoints(self.checkpoint_dir), [])
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+
+@skipUnless(storages, "django-storages not installed")
+class S3MultipartUploaderTest(TestCase):
+    def test_download(self):
+        storage = Mock(bucket_name="bucket")
+        storage._normalize_name.side_effect = lambda name: f"prefix/{name}"
+        client = storage.connection.meta.client
+        client.head_object.return_value = {"ContentLength": 6}
+        client.get_object.side_effect = lambda **kwargs: {
+            "Body": BytesIO(b"foobar"[3:] if kwargs["Range"] == "bytes=3-5" else b"foo")
+        }
+        downloader = multipart.S3RangedDownloader(storage)
+        self.assertEqual(downloader.get_size("foo"), 6)
+        client.head_object.assert_called_once_with(Bucket="bucket", Key="prefix/foo")
+        reader = multipart.RangedReader(downloader, "foo", 6, range_size=3)
+        self.assertEqual(reader.read(), b"foobar")
+        reader.close()
+
+    def test_upload(self):
+        storage = Mock(bucket_name="bucket")
+        storage._normalize_name.side_effect = lambda name: f"prefix/{name}"
+        storage.get_object_parameters.return_value = {"ACL": "private"}
+        client = storage.connection.meta.client
+        client.create_multipart_upload.return_value = {"UploadId": "up"}
+        client.upload_part.side_effect = lambda **kwargs: {
+            "ETag": kwargs["Body"].decode()
+        }
+        uploader = multipart.S3MultipartUploader(storage)
+        uploader.upload(BytesIO(b"foobar"), "foo", part_size=3)
+        client.create_multipart_upload.assert_called_once_with(
+            Bucket="bucket", Key="prefix/foo", ACL="private"
+        )
+        client.complete_multipart_upload.assert_called_once_with(
+            Bucket="bucket",
+            Key="prefix/foo",
+            UploadId="up",
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": 1, "ETag": "foo"},
+                    {"PartNumber": 2, "ETag": "bar"},
+                ]
+            },
+        )
+
+
+@patch.dict(multipart.UPLOADER_MAPPING, FILESYSTEM_MAPPING)
+@patch("dbbackup.settings.MULTIPART_THRESHOLD", 10)
+class StorageWriteFileTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = Storage(
+            "django.core.files.storage.FileSystemStorage", location=self.location
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    @patch("dbbackup.settings.MULTIPART_PART_SIZE", 7)
+    def test_multipart(self):
+        data = os.urandom(100)
+        with patch.object(
+            multipart.FileSystemMultipartUploader,
+            "upload_part",
+            autospec=True,
+            side_effect=multipart.FileSystemMultipartUploader.upload_part,
+        ) as upload_part:
+            self.storage.write_file(BytesIO(data), "foo")
+        self.assertEqual(upload_part.call_count, 15)
+        with open(os.path.join(self.location, "foo"), "rb") as fd:
+            self.assertEqual(fd.read(), data)
+
+    def test_small_file(self):
+        with patch.object(multipart.FileSystemMultipartUploader, "upload") as upload:
+            self.storage.write_file(BytesIO(b"foo"), "foo")
+        upload.assert_not_called()
+        with open(os.path.join(self.location, "foo"), "rb") as fd:
+            self.assertEqual(fd.read(), b"foo")
+
+    def test_stream(self):
+        self.storage.write_file(streams.open_chunks([b"foo", b"bar"]), "foo")
+        with open(os.path.join(self.location, "foo"), "rb") as fd:
+            self.assertEqual(fd.read(), b"foobar")
+
+    @patch("dbbackup.settings.UPLOAD_RETRIES", 0)
+    @patch("dbbackup.settings.MULTIPART_PART_SIZE", 7)
+    def test_resume_upload(self):
+        data = os.urandom(100)
+        checkpoint_dir = os.path.join(self.location, "checkpoints")
+        upload_part = multipart.FileSystemMultipartUploader.upload_part
+
+        def fail_part(uploader, upload_id, name, number, data):
+            if number == 5:
+                raise OSError("Connection reset")
+            return upload_part(uploader, upload_id, name, number, data)
+
+        with (
+            patch("dbbackup.settings.UPLOAD_CHECKPOINT_DIR", checkpoint_dir),
+            patch.object(
+                multipart.FileSystemMultipartUploader,
+                "upload_part",
+                autospec=True,
+                side_effect=fail_part,
+            ),
+            self.assertRaises(OSError),
+        ):
+            self.storage.write_file(BytesIO(data), "foo.psql", database="foo")
+        with patch("dbbackup.settings.UPLOAD_CHECKPOINT_DIR", checkpoint_dir):
+            self.assertEqual(self.storage.list_interrupted_uploads("media"), [])
+            self.assertEqual(self.storage.list_interrupted_uploads(database="bar"), [])
+            # Not matched on a part of the name
+            self.assertEqual(self.storage.list_interrupted_uploads(database="fo"), [])
+            (checkpoint,) = self.storage.list_interrupted_uploads("db", "foo")
+            self.storage.resume_upload(checkpoint)
+            self.assertEqual(self.storage.list_interrupted_uploads(), [])
+        with open(os.path.join(self.location, "foo.psql"), "rb") as fd:
+            self.assertEqual(fd.read(), data)
+
+    def test_abort_upload_without_data(self):
+        checkpoint_dir = os.path.join(self.location, "checkpoints")
+        checkpoint = multipart.UploadCheckpoint("foo.psql", checkpoint_dir)
+        checkpoint.start("upload", 7)
+        with (
+            patch("dbbackup.settings.UPLOAD_CHECKPOINT_DIR", checkpoint_dir),
+            patch.object(multipart.FileSystemMultipartUploader, "abort") as abort,
+        ):
+            self.assertEqual(self.storage.list_interrupted_uploads(), [])
+        abort.assert_called_once_with("upload", "foo.psql")
+        self.assertEqual(os.listdir(checkpoint_dir), [])
+
+    @patch("dbbackup.settings.UPLOAD_RETRY_DELAY", 0)
+    def test_save_retries(self):
+        with patch.object(
+            self.storage.storage, "save", side_effect=[OSError, "foo"]
+        ) as save:
+            self.storage.write_file(BytesIO(b"foo"), "foo")
+        self.assertEqual(save.call_count, 2)
+
+
+@patch.dict(multipart.DOWNLOADER_MAPPING, FILESYSTEM_DOWNLOADER_MAPPING)
+@patch("dbbackup.settings.DOWNLOAD_RANGE_SIZE", 10)
+class StorageReadFileTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = Storage(
+            "django.core.files.storage.FileSystemStorage", location=self.location
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def write(self, data):
+        with open(os.path.join(self.location, "foo"), "wb") as fd:
+            fd.write(data)
+
+    def test_ranged(self):
+        data = os.urandom(100)
+        self.write(data)
+        with self.storage.read_file("foo") as input_file:
+            self.assertIsInstance(input_file.raw, multipart.RangedReader)
+            self.assertEqual(input_file.name, "foo")
+            self.assertEqual(input_file.read(), data)
+            self.assertEqual(input_file.raw.ranges_read, 10)
+
+    def test_ranged_lines(self):
+        data = b"foo\n" * 25
+        self.write(data)
+        with (
+            patch.object(
+                multipart.RangedReader,
+                "readinto",
+                autospec=True,
+                side_effect=multipart.RangedReader.readinto,
+            ) as readinto,
+            self.storage.read_file("foo") as input_file,
+        ):
+            self.assertEqual(b"".join(input_file), data)
+        # Read by ranges, not by byte
+        self.assertLessEqual(readinto.call_count, 11)
+
+    def test_small_file(self):
+        self.write(b"foo")
+        with self.storage.read_file("foo") as input_file:
+            self.assertNotIsInstance(
+                getattr(input_file, "raw", input_file), multipart.RangedReader
+            )
+            self.assertEqual(input_file.read(), b"foo")
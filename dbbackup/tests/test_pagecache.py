@@ -0,0 +1,56 @@
+import os
+import tempfile
+from io import BytesIO
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from dbbackup import pagecache
+
+CONTENT = os.urandom(3 * 1024 * 1024 + 42)
+
+
+@patch("dbbackup.settings.CACHE_FRIENDLY_IO", True)
+class PageCacheTest(TestCase):
+    def setUp(self):
+        pagecache.stats.reset()
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, CONTENT)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_resident_pages(self):
+        with open(self.path, "rb") as fileobj:
+            resident = pagecache.resident_pages(fileobj.fileno(), len(CONTENT))
+        pages = (len(CONTENT) + pagecache.PAGE_SIZE - 1) // pagecache.PAGE_SIZE
+        self.assertEqual(len(resident), pages)
+
+    def test_iter_file(self):
+        with open(self.path, "rb") as fileobj:
+            content = b"".join(pagecache.iter_file(fileobj, chunk_size=100000))
+        self.assertEqual(content, CONTENT)
+        stats = pagecache.stats
+        self.assertGreaterEqual(stats.kept + stats.dropped, len(CONTENT))
+
+    def test_iter_file_without_fileno(self):
+        content = b"".join(pagecache.iter_file(BytesIO(b"foo")))
+        self.assertEqual(content, b"foo")
+
+    def test_copy_to_path(self):
+        for direct_io in (False, True):
+            with (
+                self.subTest(direct_io=direct_io),
+                patch("dbbackup.settings.DIRECT_IO", direct_io),
+            ):
+                pagecache.copy_to_path(BytesIO(CONTENT), self.path)
+                with open(self.path, "rb") as fileobj:
+                    self.assertEqual(fileobj.read(), CONTENT)
+
+    @patch("dbbackup.pagecache.WRITE_BEHIND_SIZE", 1024 * 1024)
+    def test_copy_to_path_write_behind(self):
+        pagecache.copy_to_path(BytesIO(CONTENT), self.path)
+        self.assertEqual(pagecache.stats.dropped, len(CONTENT))
+        with open(self.path, "rb") as fileobj:
+            self.assertEqual(fileobj.read(), CONTENT)
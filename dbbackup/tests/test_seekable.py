@@ -0,0 +1,58 @@
+import io
+import os
+import subprocess
+from unittest import skipUnless
+
+from django.test import TestCase
+
+from dbbackup import seekable
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+@skipUnless(zstandard, "zstandard not installed")
+class SeekableTest(TestCase):
+    def setUp(self):
+        self.data = os.urandom(1000) * 10
+        compressor = zstandard.ZstdCompressor()
+        chunks = seekable.compress_chunks([self.data], compressor.compress, 3000)
+        self.compressed = b"".join(chunks)
+        decompressor = zstandard.ZstdDecompressor()
+        self.decompress = lambda frame, size: decompressor.decompress(
+            frame, max_output_size=size
+        )
+
+    def test_read_seek_table(self):
+        entries = seekable.read_seek_table(io.BytesIO(self.compressed))
+        self.assertEqual([entry[1] for entry in entries], [0, 3000, 6000, 9000])
+        self.assertEqual([entry[3] for entry in entries], [3000, 3000, 3000, 1000])
+
+    def test_no_seek_table(self):
+        compressed = zstandard.ZstdCompressor().compress(self.data)
+        fileobj = io.BytesIO(compressed)
+        self.assertIsNone(seekable.read_seek_table(fileobj))
+        # The file is left where it was for reading it from the start
+        self.assertEqual(fileobj.tell(), 0)
+
+    def test_zstd_command(self):
+        output = subprocess.run(
+            ["zstd", "-dc"], input=self.compressed, capture_output=True, check=True
+        ).stdout
+        self.assertEqual(output, self.data)
+
+    def test_reader(self):
+        fileobj = io.BytesIO(self.compressed)
+        reader = seekable.SeekableReader(
+            fileobj, seekable.read_seek_table(fileobj), self.decompress
+        )
+        reader.seek(5000)
+        self.assertEqual(reader.read(2000), self.data[5000:7000])
+        self.assertEqual(reader.frames_read, 2)
+        reader.seek(-10, io.SEEK_END)
+        self.assertEqual(reader.read(), self.data[-10:])
+        self.assertEqual(reader.frames_read, 3)
+        reader.seek(0)
+        self.assertEqual(reader.read(), self.data)
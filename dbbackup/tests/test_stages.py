@@ -0,0 +1,475 @@
+import gzip
+import hashlib
+import lzma
+import os
+import tempfile
+from io import BytesIO
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from dbbackup import stages, utils
+from dbbackup.storage import get_storage
+from dbbackup.tests.utils import (
+    HANDLED_FILES,
+    add_private_gpg,
+    add_public_gpg,
+    clean_gpg_keys,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import x25519
+except ImportError:
+    x25519 = None
+
+
+class Get_StageTest(TestCase):
+    def test_func(self):
+        stage = stages.get_stage("gzip")
+        self.assertIsInstance(stage, stages.GzipStage)
+
+    def test_unknown(self):
+        with self.assertRaises(stages.StageError):
+            stages.get_stage("foo")
+
+    def test_options(self):
+        stage = stages.get_stage("ratelimit", RATE=42)
+        self.assertEqual(stage.rate, 42)
+
+    @patch("dbbackup.settings.STAGES", {"ratelimit": {"RATE": 42}})
+    def test_settings(self):
+        stage = stages.get_stage("ratelimit")
+        self.assertEqual(stage.rate, 42)
+
+
+class Stages_From_FilenameTest(TestCase):
+    def test_func(self):
+        stage_list = stages.stages_from_filename("foo-2015-02-06-042810.psql.gz.gpg")
+        self.assertEqual(
+            [type(stage) for stage in stage_list],
+            [stages.GPGStage, stages.GzipStage],
+        )
+
+    def test_no_stage(self):
+        self.assertEqual(stages.stages_from_filename("foo.psql.bin"), [])
+        self.assertEqual(stages.stages_from_filename("gz"), [])
+
+    def test_options(self):
+        (stage,) = stages.stages_from_filename("foo.gpg", passphrase="bar")
+        self.assertEqual(stage.passphrase, "bar")
+
+
+class Apply_StagesTest(TestCase):
+    def test_func(self):
+        stage_list = [stages.GzipStage(), stages.ChecksumStage()]
+        chunks, filename = stages.apply_stages([b"foo"], "foo.psql", stage_list)
+        self.assertEqual(filename, "foo.psql.gz")
+        data = b"".join(chunks)
+        self.assertEqual(gzip.decompress(data), b"foo")
+        self.assertEqual(stage_list[1].hexdigest, hashlib.sha256(data).hexdigest())
+
+    def test_parallel_gzip(self):
+        stage = stages.GzipStage(threads=2, block_size=10)
+        chunks, filename = stage.apply([b"foo" * 10], "foo.psql")
+        compressed = b"".join(chunks)
+        self.assertEqual(gzip.decompress(compressed), b"foo" * 10)
+        chunks, _ = stage.revert([compressed], filename)
+        self.assertEqual(b"".join(chunks), b"foo" * 10)
+
+    def test_revert(self):
+        chunks, filename = stages.apply_stages(
+            [b"foo"], "foo.psql", [stages.GzipStage()]
+        )
+        chunks, filename = stages.revert_stages(
+            chunks, filename, stages.stages_from_filename(filename)
+        )
+        self.assertEqual(filename, "foo.psql")
+        self.assertEqual(b"".join(chunks), b"foo")
+
+
+class Get_Applied_FilenameTest(TestCase):
+    def test_func(self):
+        filename = stages.get_applied_filename(
+            "foo.psql", [stages.GzipStage(), stages.ChecksumStage()]
+        )
+        self.assertEqual(filename, "foo.psql.gz")
+
+
+class Is_CompressibleTest(TestCase):
+    def test_text(self):
+        self.assertTrue(stages.is_compressible("foo.txt", b"foo" * 1000))
+
+    def test_extension(self):
+        self.assertFalse(stages.is_compressible("foo.JPG", b"foo" * 1000))
+
+    def test_magic(self):
+        sample = gzip.compress(b"foo") + b"foo" * 1000
+        self.assertFalse(stages.is_compressible("foo", sample))
+
+    def test_iso_media(self):
+        self.assertFalse(stages.is_compressible("foo", b"\0\0\0\x20ftypisom"))
+
+    def test_random(self):
+        self.assertFalse(stages.is_compressible("foo", os.urandom(4096)))
+
+    def test_empty(self):
+        self.assertFalse(stages.is_compressible("foo", b""))
+
+
+@patch(
+    "dbbackup.settings.COMPRESSION_CANDIDATES",
+    [("gzip", {"LEVEL": 1}), ("xz", {"PRESET": 6})],
+)
+class Choose_Compression_StageTest(TestCase):
+    @patch("dbbackup.settings.COMPRESSION_MIN_THROUGHPUT", 0)
+    def test_smallest(self):
+        stage = stages.choose_compression_stage(b"foobar" * 10000)
+        self.assertIsInstance(stage, stages.XzStage)
+
+    @patch("dbbackup.settings.COMPRESSION_MIN_THROUGHPUT", 10**15)
+    def test_fastest_if_none_fast_enough(self):
+        stage = stages.choose_compression_stage(b"foobar" * 10000)
+        self.assertIsInstance(stage, stages.GzipStage)
+
+    @patch("dbbackup.settings.COMPRESSION_MIN_THROUGHPUT", 0)
+    @patch("dbbackup.settings.COMPRESSION_WINDOW", 10**-9)
+    def test_window(self):
+        stage = stages.choose_compression_stage(b"foobar" * 10000, 10**9)
+        self.assertIsInstance(stage, stages.GzipStage)
+
+    def test_incompressible(self):
+        self.assertIsNone(stages.choose_compression_stage(os.urandom(10000)))
+        self.assertIsNone(stages.choose_compression_stage(b""))
+
+
+class CompressionStageTestMixin:
+    stage_name = None
+
+    def test_func(self):
+        data = b"foo" * 1000
+        chunks, filename = stages.get_stage(self.stage_name).apply(
+            [data[:100], data[100:]], "foo.psql"
+        )
+        compressed = b"".join(chunks)
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(stages.stages_from_filename(filename)[0].kind, "compression")
+        chunks, filename = stages.revert_stages(
+            [compressed[:5], compressed[5:]],
+            filename,
+            stages.stages_from_filename(filename),
+        )
+        self.assertEqual(filename, "foo.psql")
+        self.assertEqual(b"".join(chunks), data)
+
+    def test_concatenated_frames(self):
+        stage = stages.get_stage(self.stage_name)
+        compressed = b"".join(stage.apply([b"foo"], "foo")[0])
+        chunks, _ = stage.revert([compressed + compressed], "foo")
+        self.assertEqual(b"".join(chunks), b"foofoo")
+
+    def test_truncated(self):
+        stage = stages.get_stage(self.stage_name)
+        compressed = b"".join(stage.apply([b"foo" * 1000], "foo")[0])
+        chunks, _ = stage.revert([compressed[:-4]], "foo")
+        with self.assertRaises(Exception):
+            b"".join(chunks)
+
+
+@skipUnless(zstandard, "zstandard not installed")
+class ZstdStageTest(CompressionStageTestMixin, TestCase):
+    stage_name = "zstd"
+
+    def test_long(self):
+        stage = stages.ZstdStage(level=19, long=True)
+        compressed = b"".join(stage.apply([b"foo"], "foo")[0])
+        decompressor = zstandard.ZstdDecompressor(max_window_size=2**27)
+        self.assertEqual(decompressor.decompressobj().decompress(compressed), b"foo")
+
+    def test_frame_size_empty(self):
+        stage = stages.ZstdStage(frame_size=10)
+        compressed = b"".join(stage.apply([], "foo")[0])
+        chunks, _ = stage.revert([compressed], "foo")
+        self.assertEqual(b"".join(chunks), b"")
+
+
+@skipUnless(lz4, "lz4 not installed")
+class Lz4StageTest(CompressionStageTestMixin, TestCase):
+    stage_name = "lz4"
+
+    def test_format(self):
+        compressed = b"".join(stages.Lz4Stage().apply([b"foo"], "foo")[0])
+        self.assertEqual(lz4.frame.decompress(compressed), b"foo")
+
+
+class XzStageTest(CompressionStageTestMixin, TestCase):
+    stage_name = "xz"
+
+    def test_format(self):
+        compressed = b"".join(stages.XzStage(preset=1).apply([b"foo"], "foo")[0])
+        self.assertEqual(lzma.decompress(compressed), b"foo")
+
+
+class StageCommandTest(TestCase):
+    def test_func(self):
+        stage = stages.get_stage("gzip", command="gzip -6", revert_command="gzip -d")
+        chunks, filename = stage.apply([b"foo" * 1000, b"bar"], "foo.psql")
+        compressed = b"".join(chunks)
+        self.assertEqual(filename, "foo.psql.gz")
+        self.assertEqual(gzip.decompress(compressed), b"foo" * 1000 + b"bar")
+        chunks, filename = stage.revert([compressed], filename)
+        self.assertEqual(b"".join(chunks), b"foo" * 1000 + b"bar")
+
+    def test_not_installed(self):
+        stage = stages.get_stage("gzip", command="dbbackup-missing-command")
+        chunks, _ = stage.apply([b"foo"], "foo")
+        self.assertEqual(gzip.decompress(b"".join(chunks)), b"foo")
+
+    def test_error(self):
+        stage = stages.get_stage("gzip", revert_command="gzip -d")
+        chunks, _ = stage.revert([b"foo"], "foo.gz")
+        with self.assertRaises(stages.StageError):
+            b"".join(chunks)
+
+
+class NativeCompressionStageTest(TestCase):
+    def test_func(self):
+        stage = stages.NativeCompressionStage(format="zstd")
+        chunks, filename = stage.apply([b"foo"], "foo.psql")
+        self.assertEqual(list(chunks), [b"foo"])
+        self.assertEqual(filename, "foo.psql.zst")
+        _, filename = stages.NativeCompressionStage().apply([b"foo"], "foo.psql")
+        self.assertEqual(filename, "foo.psql")
+
+
+@skipUnless(zstandard, "zstandard not installed")
+class DeltaStageTest(TestCase):
+    def setUp(self):
+        HANDLED_FILES.clean()
+        self.storage = get_storage()
+        self.data = os.urandom(100000)
+
+    def _backup(self, data, name, base=None, **options):
+        chunks, filename = stages.get_stage("delta", base=base, **options).apply(
+            [data], name
+        )
+        self.storage.write_file(BytesIO(b"".join(chunks)), filename)
+        return filename
+
+    def _restore(self, filename):
+        file_ = self.storage.read_file(filename)
+        stage_list = stages.stages_from_filename(filename)
+        chunks, _ = stages.revert_stages([file_.read()], filename, stage_list)
+        return b"".join(chunks), stage_list[0].depth
+
+    def test_chain(self):
+        filename = self._backup(self.data, "foo-1.psql")
+        self.assertEqual(filename, "foo-1.psql.zdelta")
+        data = self.data
+        for index in range(2, 5):
+            data = data + b"bar%d" % index
+            filename = self._backup(data, f"foo-{index}.psql", base=filename)
+        # Only the change is stored
+        self.assertLess(len(self.storage.read_file(filename).read()), 1000)
+        self.assertEqual(self._restore(filename), (data, 3))
+
+    def test_max_deltas(self):
+        filename = self._backup(self.data, "foo-1.psql")
+        filename = self._backup(self.data, "foo-2.psql", base=filename)
+        filename = self._backup(self.data, "foo-3.psql", base=filename, max_deltas=1)
+        self.assertEqual(self._restore(filename), (self.data, 0))
+        self.assertGreater(len(self.storage.read_file(filename).read()), 100000)
+
+    def test_base_not_delta(self):
+        self.storage.write_file(BytesIO(self.data), "foo-1.psql")
+        filename = self._backup(self.data, "foo-2.psql", base="foo-1.psql")
+        self.assertEqual(self._restore(filename), (self.data, 1))
+
+    def test_base_encrypted(self):
+        with patch.object(stages.DeltaStage, "_load_base") as load_base:
+            filename = self._backup(self.data, "foo-2.psql", base="foo-1.psql.gpg")
+        load_base.assert_not_called()
+        self.assertEqual(self._restore(filename), (self.data, 0))
+
+    @patch("dbbackup.stages.DELTA_MAX_BASE_SIZE", 1000)
+    def test_base_too_big(self):
+        filename = self._backup(self.data, "foo-1.psql")
+        filename = self._backup(self.data, "foo-2.psql", base=filename)
+        self.assertEqual(self._restore(filename), (self.data, 0))
+        self.assertGreater(len(self.storage.read_file(filename).read()), 100000)
+
+    def test_clean_old_backups(self):
+        with (
+            tempfile.TemporaryDirectory() as location,
+            patch(
+                "dbbackup.settings.STORAGE",
+                "django.core.files.storage.FileSystemStorage",
+            ),
+            patch("dbbackup.settings.STORAGE_OPTIONS", {"location": location}),
+        ):
+            self.storage = get_storage()
+            data = self.data
+            filename = None
+            for day in range(1, 5):
+                data = data + b"bar%d" % day
+                filename = self._backup(
+                    data, f"foo-2015-02-0{day}-042810.psql", base=filename
+                )
+            # The kept deltas need every older backup
+            self.storage.clean_old_backups(keep_number=2)
+            self.assertEqual(len(self.storage.list_backups()), 4)
+            self.assertEqual(self._restore(filename), (data, 3))
+            filename = self._backup(
+                data, "foo-2015-02-05-042810.psql", base=filename, max_deltas=3
+            )
+            filename = self._backup(data, "foo-2015-02-06-042810.psql", base=filename)
+            # The new full backup ends the chain
+            self.storage.clean_old_backups(keep_number=2)
+            self.assertEqual(len(self.storage.list_backups()), 2)
+            self.assertEqual(self._restore(filename), (data, 1))
+
+    def test_get_delta_base(self):
+        filename = self._backup(self.data, "foo-1.psql")
+        self.assertIsNone(
+            stages.get_delta_base(self.storage.read_file(filename), filename)
+        )
+        other = self._backup(self.data, "foo-2.psql", base=filename)
+        self.assertEqual(
+            stages.get_delta_base(self.storage.read_file(other), other), filename
+        )
+        self.assertIsNone(stages.get_delta_base(BytesIO(b"foo"), "foo.psql.gz"))
+
+    def test_not_delta(self):
+        chunks, _ = stages.get_stage("delta").revert([b"foo" * 10], "foo.zdelta")
+        with self.assertRaises(stages.StageError):
+            b"".join(chunks)
+
+
+class GPGStageTest(TestCase):
+    def setUp(self):
+        add_public_gpg()
+        add_private_gpg()
+
+    def tearDown(self):
+        clean_gpg_keys()
+
+    @patch("dbbackup.utils.getpass", return_value=None)
+    def test_func(self, *args):
+        chunks, filename = stages.GPGStage().apply([b"foo"], "foo.psql")
+        self.assertEqual(filename, "foo.psql.gpg")
+        chunks, filename = stages.GPGStage().revert(chunks, filename)
+        self.assertEqual(filename, "foo.psql")
+        self.assertEqual(b"".join(chunks), b"foo")
+
+    @patch("dbbackup.utils.getpass", return_value=None)
+    def test_binary(self, *args):
+        chunks, _ = stages.GPGStage(armor=False).apply([b"foo"] * 1000, "foo")
+        encrypted = b"".join(chunks)
+        self.assertFalse(encrypted.startswith(b"-----BEGIN PGP MESSAGE-----"))
+        chunks, _ = stages.GPGStage().revert([encrypted], "foo.gpg")
+        self.assertEqual(b"".join(chunks), b"foo" * 1000)
+
+    @patch("dbbackup.stages.run_command", return_value=iter([b""]))
+    def test_compress_algo(self, run_command):
+        b"".join(stages.GPGStage().apply([b"foo" * 1000], "foo")[0])
+        self.assertNotIn("--compress-algo", run_command.call_args[0][1])
+        b"".join(stages.GPGStage().apply([gzip.compress(b"foo")], "foo.gz")[0])
+        command = run_command.call_args[0][1]
+        self.assertEqual(command[command.index("--compress-algo") + 1], "none")
+
+    @patch("dbbackup.stages.run_command")
+    def test_passphrase(self, run_command):
+        def read_passphrase(chunks, command, pass_fds):
+            fd = int(command[command.index("--passphrase-fd") + 1])
+            self.assertEqual(pass_fds, (fd,))
+            self.assertNotIn("bar", command)
+            yield os.read(fd, 10)
+
+        run_command.side_effect = read_passphrase
+        chunks, _ = stages.GPGStage(passphrase="bar").revert([b"foo"], "foo.gpg")
+        self.assertEqual(b"".join(chunks), b"bar\n")
+
+    def test_errors(self):
+        stage = stages.GPGStage(binary="false", passphrase="bar")
+        with self.assertRaises(utils.EncryptionError):
+            b"".join(stage.apply([b"foo"], "foo")[0])
+        with self.assertRaises(utils.DecryptionError):
+            b"".join(stage.revert([b"foo"], "foo.gpg")[0])
+
+
+@skipUnless(x25519, "cryptography not installed")
+class AeadStageTest(TestCase):
+    def setUp(self):
+        private_key = x25519.X25519PrivateKey.generate()
+        self.recipient = (
+            private_key.public_key()
+            .public_bytes(
+                serialization.Encoding.PEM,
+                serialization.PublicFormat.SubjectPublicKeyInfo,
+            )
+            .decode()
+        )
+        self.identity = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.BestAvailableEncryption(b"bar"),
+        ).decode()
+
+    def test_func(self):
+        stage = stages.AeadStage(
+            recipients=[self.recipient], identities=[self.identity], passphrase="bar"
+        )
+        chunks, filename = stage.apply([b"foo"] * 1000, "foo.psql")
+        self.assertEqual(filename, "foo.psql.aead")
+        chunks, filename = stage.revert(chunks, filename)
+        self.assertEqual(filename, "foo.psql")
+        self.assertEqual(b"".join(chunks), b"foo" * 1000)
+
+    def test_open_seekable(self):
+        stage = stages.AeadStage(
+            recipients=[self.recipient],
+            identities=[self.identity],
+            passphrase="bar",
+            chunk_size=100,
+        )
+        chunks, _ = stage.apply([b"foo"] * 1000, "foo")
+        reader = stage.open_seekable(BytesIO(b"".join(chunks)))
+        reader.seek(1500)
+        self.assertEqual(reader.read(6), b"foofoo")
+        self.assertEqual(reader.frames_read, 1)
+
+    def test_no_identity(self):
+        with self.assertRaises(stages.StageError):
+            stages.AeadStage().revert([b""], "foo.aead")
+
+
+class ChecksumStageTest(TestCase):
+    def test_expected(self):
+        expected = hashlib.sha256(b"foo").hexdigest()
+        chunks, filename = stages.ChecksumStage(expected=expected).revert(
+            [b"foo"], "foo"
+        )
+        self.assertEqual(b"".join(chunks), b"foo")
+        self.assertEqual(filename, "foo")
+
+    def test_mismatch(self):
+        chunks, _ = stages.ChecksumStage(expected="bar").revert([b"foo"], "foo")
+        with self.assertRaises(stages.StageError):
+            b"".join(chunks)
+
+
+class RateLimitStageTest(TestCase):
+    @patch("dbbackup.stages.time.sleep")
+    def test_func(self, mock_sleep):
+        chunks, _ = stages.RateLimitStage(rate=1).apply([b"foo", b"bar"], "foo")
+        self.assertEqual(b"".join(chunks), b"foobar")
+        self.assertEqual(mock_sleep.call_count, 2)
@@ -108,12 +108,20 @@ class StorageListBackupsTest(TestCase):
             (utils.filename_generate(ext, "bardb", "barserver"), None)
             for ext in ("db", "db.gz", "db.gpg", "db.gz.gpg")
         ]
+        HANDLED_FILES["written_files"] += [
+            (utils.filename_generate(ext, "eggdb", "eggserver"), None)
+            for ext in ("db.zst", "db.lz4", "db.xz.gpg")
+        ]
         # barserver files
         HANDLED_FILES["written_files"] += [("file_without_date", None)]
+        # Envelope of an encrypted backup
+        HANDLED_FILES["written_files"] += [
+            (utils.filename_generate("db.aead.envelope", "spamdb"), None)
+        ]
 
     def test_nofilter(self):
         files = self.storage.list_backups()
-        self.assertEqual(len(HANDLED_FILES["written_files"]) - 1, len(files))
+        self.assertEqual(len(HANDLED_FILES["written_files"]) - 2, len(files))
         for file in files:
             self.assertNotEqual("file_without_date", file)
 
@@ -125,7 +133,8 @@ class StorageListBackupsTest(TestCase):
     def test_compressed(self):
         files = self.storage.list_backups(compressed=True)
         for file in files:
-            self.assertIn(".gz", file)
+            self.assertRegex(file, r"\.(gz|zst|lz4|xz)")
+        self.assertEqual(len([f for f in files if "eggdb" in f]), 3)
 
     def test_not_encrypted(self):
         files = self.storage.list_backups(encrypted=False)
@@ -135,7 +144,7 @@ class StorageListBackupsTest(TestCase):
     def test_not_compressed(self):
         files = self.storage.list_backups(compressed=False)
         for file in files:
-            self.assertNotIn(".gz", file)
+            self.assertNotRegex(file, r"\.(gz|zst|lz4|xz)")
 
     def test_content_type_db(self):
         files = self.storage.list_backups(content_type="db")
@@ -233,6 +242,11 @@ class StorageCleanOldBackupsTest(TestCase):
         self.storage.clean_old_backups(keep_number=1)
         self.assertEqual(2, len(HANDLED_FILES["deleted_files"]))
 
+    def test_sidecar(self):
+        HANDLED_FILES["written_files"].append(("2015-02-06-042810.bak.envelope", None))
+        self.storage.clean_old_backups(keep_number=1)
+        self.assertIn("2015-02-06-042810.bak.envelope", HANDLED_FILES["deleted_files"])
+
     @patch("dbbackup.settings.CLEANUP_KEEP_FILTER", keep_only_even_files)
     def test_keep_filter(self):
         self.storage.clean_old_backups(keep_number=1)
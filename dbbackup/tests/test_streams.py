@@ -0,0 +1,299 @@
+import gzip
+import os
+import subprocess
+import threading
+from io import BytesIO
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from dbbackup import streams
+from dbbackup.tests.utils import (
+    ENCRYPTED_FILE,
+    add_private_gpg,
+    add_public_gpg,
+    clean_gpg_keys,
+)
+
+
+class Iter_FileTest(TestCase):
+    def test_func(self):
+        chunks = list(streams.iter_file(BytesIO(b"foobar"), chunk_size=4))
+        self.assertEqual(chunks, [b"foob", b"ar"])
+
+    def test_empty(self):
+        self.assertEqual(list(streams.iter_file(BytesIO())), [])
+
+
+class Join_ChunksTest(TestCase):
+    def test_func(self):
+        chunks = list(streams.join_chunks([b"a", b"b", b"c", b"d", b"e"], 2))
+        self.assertEqual(chunks, [b"ab", b"cd", b"e"])
+
+    def test_empty(self):
+        self.assertEqual(list(streams.join_chunks([])), [])
+
+
+class Limit_ChunksTest(TestCase):
+    def test_func(self):
+        chunks = streams.limit_chunks([b"foo", b"bar", b"baz"], 5)
+        self.assertEqual(list(chunks), [b"foo", b"ba"])
+
+    def test_short(self):
+        with self.assertRaises(OSError):
+            list(streams.limit_chunks([b"foo"], 5))
+
+
+class Spool_ChunksTest(TestCase):
+    def test_func(self):
+        spooled_file = streams.spool_chunks([b"foo", b"bar"])
+        self.assertEqual(spooled_file.read(), b"foobar")
+
+
+class ChunkReaderTest(TestCase):
+    def test_read(self):
+        reader = streams.ChunkReader([b"foo", b"", b"bar"])
+        self.assertEqual(reader.read(2), b"fo")
+        self.assertEqual(reader.read(), b"obar")
+        self.assertEqual(reader.tell(), 6)
+
+    def test_not_seekable(self):
+        reader = streams.ChunkReader([b"foo"])
+        self.assertFalse(reader.seekable())
+        with self.assertRaises(OSError):
+            reader.seek(0)
+
+    def test_close_generator(self):
+        def gen():
+            try:
+                yield b"foo"
+                yield b"bar"
+            finally:
+                closed.append(True)
+
+        closed = []
+        reader = streams.ChunkReader(gen())
+        reader.read(1)
+        reader.close()
+        self.assertEqual(closed, [True])
+
+
+class Compress_ChunksTest(TestCase):
+    def test_func(self):
+        chunks, filename = streams.compress_chunks([b"foo", b"bar"], "foo.txt")
+        self.assertEqual(filename, "foo.txt.gz")
+        self.assertEqual(gzip.decompress(b"".join(chunks)), b"foobar")
+
+
+class Encrypt_ChunksTest(TestCase):
+    def setUp(self):
+        add_public_gpg()
+
+    def tearDown(self):
+        clean_gpg_keys()
+
+    def test_func(self):
+        chunks, filename = streams.encrypt_chunks([b"foo"], "foo.txt")
+        self.assertEqual(filename, "foo.txt.gpg")
+        self.assertTrue(b"".join(chunks))
+
+
+class Uncompress_ChunksTest(TestCase):
+    def test_func(self):
+        compressed = gzip.compress(b"foobar")
+        chunks, filename = streams.uncompress_chunks(
+            [compressed[:5], compressed[5:]], "foo.txt.gz"
+        )
+        self.assertEqual(filename, "foo.txt")
+        self.assertEqual(b"".join(chunks), b"foobar")
+
+    def test_multiple_members(self):
+        compressed = gzip.compress(b"foo") + gzip.compress(b"bar")
+        chunks, _ = streams.uncompress_chunks([compressed], "foo.txt.gz")
+        self.assertEqual(b"".join(chunks), b"foobar")
+
+    @patch("dbbackup.settings.TMP_FILE_READ_SIZE", 10)
+    def test_bounded_chunks(self):
+        compressed = gzip.compress(b"0" * 1000)
+        chunks, _ = streams.uncompress_chunks([compressed], "foo.txt.gz")
+        chunks = list(chunks)
+        self.assertTrue(all(len(chunk) <= 10 for chunk in chunks))
+        self.assertEqual(b"".join(chunks), b"0" * 1000)
+
+    def test_truncated(self):
+        compressed = gzip.compress(b"foobar")
+        chunks, _ = streams.uncompress_chunks([compressed[:-4]], "foo.txt.gz")
+        with self.assertRaises(EOFError):
+            b"".join(chunks)
+
+
+class Unencrypt_ChunksTest(TestCase):
+    def setUp(self):
+        add_private_gpg()
+
+    def tearDown(self):
+        clean_gpg_keys()
+
+    @patch("dbbackup.utils.getpass", return_value=None)
+    def test_func(self, *args):
+        with open(ENCRYPTED_FILE, "rb") as inputfile:
+            chunks, filename = streams.unencrypt_chunks(
+                streams.iter_file(inputfile), "foofile.gpg"
+            )
+            self.assertEqual(filename, "foofile")
+            self.assertEqual(b"".join(chunks), b"foo\n")
+
+
+class Open_ChunksTest(TestCase):
+    def test_func(self):
+        dump = streams.open_chunks([b"foo\nb", b"ar\n"], name="foo")
+        self.assertEqual(dump.name, "foo")
+        self.assertEqual(list(dump), [b"foo\n", b"bar\n"])
+
+
+class ChunkQueueTest(TestCase):
+    def test_func(self):
+        queue = streams.ChunkQueue("foo", 10)
+        queue.put(b"foo")
+        queue.put(b"bar")
+        queue.close()
+        self.assertEqual(list(queue), [b"foo", b"bar"])
+        stats = queue.stats()
+        self.assertEqual(stats["peak_size"], 6)
+        self.assertEqual(stats["peak_depth"], 2)
+
+    def test_bounded(self):
+        queue = streams.ChunkQueue("foo", 4)
+        queue.put(b"foo")
+        thread = threading.Thread(target=queue.put, args=(b"bar",))
+        thread.start()
+        thread.join(0.1)
+        # The producer waits until the consumer makes room
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(queue.get(), b"foo")
+        thread.join()
+        self.assertEqual(queue.get(), b"bar")
+        self.assertGreater(queue.stats()["put_stall"], 0)
+
+    def test_oversized_chunk(self):
+        queue = streams.ChunkQueue("foo", 2)
+        queue.put(b"foobar")
+        self.assertEqual(queue.get(), b"foobar")
+
+    def test_cancel(self):
+        queue = streams.ChunkQueue("foo", 10)
+        queue.cancel()
+        with self.assertRaises(streams.PipelineCancelled):
+            queue.put(b"foo")
+        with self.assertRaises(streams.PipelineCancelled):
+            queue.get()
+
+
+class Run_PipelineTest(TestCase):
+    def test_func(self):
+        def transform(chunks):
+            for chunk in chunks:
+                yield chunk.upper()
+
+        def sink(fileobj):
+            output.append(fileobj.read())
+
+        output = []
+        stats = streams.run_pipeline(
+            [b"foo", b"bar"] * 100, transform, sink, max_memory=8
+        )
+        self.assertEqual(output, [b"FOOBAR" * 100])
+        self.assertEqual([queue["name"] for queue in stats], ["source", "sink"])
+        self.assertTrue(all(queue["peak_size"] <= 4 for queue in stats))
+
+    def test_source_error(self):
+        def source():
+            yield b"foo"
+            raise ValueError("source")
+
+        with self.assertRaisesMessage(ValueError, "source"):
+            streams.run_pipeline(source(), iter, lambda fileobj: fileobj.read())
+
+    def test_transform_error(self):
+        def transform(chunks):
+            for chunk in chunks:
+                raise ValueError("transform")
+            yield b""
+
+        with self.assertRaisesMessage(ValueError, "transform"):
+            streams.run_pipeline(
+                [b"foo"] * 100, transform, lambda fileobj: fileobj.read(), 8
+            )
+
+    def test_sink_error(self):
+        def sink(fileobj):
+            fileobj.read(1)
+            raise ValueError("sink")
+
+        with self.assertRaisesMessage(ValueError, "sink"):
+            streams.run_pipeline([b"foo"] * 100, iter, sink, max_memory=8)
+
+    def test_unread_data(self):
+        with self.assertRaises(streams.PipelineCancelled):
+            streams.run_pipeline([b"foo"] * 100, iter, lambda fileobj: None)
+
+
+class Split_ChunksTest(TestCase):
+    def test_func(self):
+        chunks = list(streams.split_chunks([b"foo", b"barbaz", b"q"], 4))
+        self.assertEqual(chunks, [b"foob", b"arba", b"zq"])
+
+
+class Peek_ChunksTest(TestCase):
+    def test_func(self):
+        sample, chunks = streams.peek_chunks(iter([b"foo", b"bar", b"baz"]), 4)
+        self.assertEqual(sample, b"foob")
+        self.assertEqual(b"".join(chunks), b"foobarbaz")
+
+
+class Map_OrderedTest(TestCase):
+    def test_func(self):
+        results = list(streams.map_ordered(lambda item: item * 2, range(20), 4))
+        self.assertEqual(results, [item * 2 for item in range(20)])
+
+
+class Parallel_Gzip_ChunksTest(TestCase):
+    def setUp(self):
+        self.data = os.urandom(1000) * 50
+
+    def test_func(self):
+        chunks = streams.parallel_gzip_chunks([self.data], 4, block_size=4096)
+        compressed = b"".join(chunks)
+        # Standard multi-member gzip
+        self.assertEqual(gzip.decompress(compressed), self.data)
+
+    def test_gunzip_command(self):
+        compressed = b"".join(
+            streams.parallel_gzip_chunks([self.data], 4, block_size=4096)
+        )
+        output = subprocess.run(
+            ["gunzip", "-c"], input=compressed, capture_output=True, check=True
+        ).stdout
+        self.assertEqual(output, self.data)
+
+    def test_parallel_gunzip(self):
+        compressed = b"".join(
+            streams.parallel_gzip_chunks([self.data], 4, block_size=4096)
+        )
+        chunks = [compressed[i : i + 1000] for i in range(0, len(compressed), 1000)]
+        chunks = list(streams.parallel_gunzip_chunks(chunks, 4))
+        self.assertEqual(len(chunks), 13)
+        self.assertEqual(b"".join(chunks), self.data)
+
+    def test_parallel_gunzip_standard_gzip(self):
+        compressed = b"".join(
+            streams.parallel_gzip_chunks([self.data], 4, block_size=4096)
+        )
+        compressed += gzip.compress(b"foo")
+        chunks = streams.parallel_gunzip_chunks([compressed], 4)
+        self.assertEqual(b"".join(chunks), self.data + b"foo")
+
+    def test_parallel_gunzip_truncated(self):
+        compressed = b"".join(streams.parallel_gzip_chunks([self.data], 4, 4096))
+        with self.assertRaises(EOFError):
+            b"".join(streams.parallel_gunzip_chunks([compressed[:-4]], 4))
@@ -1,6 +1,7 @@
 import contextlib
 import os
 import subprocess
+from io import BytesIO
 
 from django.conf import settings
 from django.core.files import File
@@ -61,7 +62,7 @@ class FakeStorage(Storage):
     name = "FakeStorage"
 
     def exists(self, name):
-        return name in HANDLED_FILES["written_files"]
+        return any(f[0] == name for f in HANDLED_FILES["written_files"])
 
     def get_available_name(self, name, max_length=None):
         return name[:max_length]
@@ -78,11 +79,16 @@ class FakeStorage(Storage):
     created_time = modified_time = accessed_time
 
     def _open(self, name, mode="rb"):
-        file_ = [f[1] for f in HANDLED_FILES["written_files"] if f[0] == name][0]
+        file_ = [f[1] for f in HANDLED_FILES["written_files"] if f[0] == name][-1]
         file_.seek(0)
+        if isinstance(file_, File) and isinstance(file_.file, File):
+            # Saved content, opened as a new file like a real storage does
+            return File(BytesIO(file_.read()), name=name)
         return file_
 
     def _save(self, name, content):
+        if not content.seekable():
+            content = BytesIO(content.read())
         HANDLED_FILES["written_files"].append((name, File(content)))
         return name
 
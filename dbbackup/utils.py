@@ -7,7 +7,6 @@ import logging
 import os
 import re
 import sys
-import tempfile
 import traceback
 from datetime import datetime
 from functools import wraps
@@ -21,6 +20,7 @@ from django.http import HttpRequest
 from django.utils import timezone
 
 from . import settings
+from .buffers import SpillBuffer
 
 FAKE_HTTP_REQUEST = HttpRequest()
 FAKE_HTTP_REQUEST.META["SERVER_NAME"] = ""
@@ -142,22 +142,22 @@ def create_spooled_temporary_file(filepath=None, fileobj=None):
     :type fileobj: file
 
     :returns: Spooled temporary file
-    :rtype: :class:`tempfile.SpooledTemporaryFile`
+    :rtype: :class:`dbbackup.buffers.SpillBuffer`
     """
-    spooled_file = tempfile.SpooledTemporaryFile(
-        max_size=settings.TMP_FILE_MAX_SIZE, dir=settings.TMP_DIR
-    )
     if filepath:
         fileobj = open(filepath, "r+b")
-    if fileobj is not None:
-        fileobj.seek(0)
-        copyfileobj(fileobj, spooled_file, settings.TMP_FILE_READ_SIZE)
+    if fileobj is None:
+        return SpillBuffer()
+    # Knowing the size, space is reserved in the temporary file
+    spooled_file = SpillBuffer(expected_size=fileobj.seek(0, os.SEEK_END))
+    fileobj.seek(0)
+    copyfileobj(fileobj, spooled_file, settings.TMP_FILE_READ_SIZE)
     return spooled_file
 
 
 def encrypt_file(inputfile, filename):
     """
-    Encrypt input file using GPG and remove .gpg extension to its name.
+    Encrypt input file using GPG and add .gpg extension to its name.
 
     :param inputfile: File to encrypt
     :type inputfile: ``file`` like object
@@ -166,34 +166,15 @@ def encrypt_file(inputfile, filename):
     :type filename: ``str``
 
     :returns: Tuple with file and new file's name
-    :rtype: :class:`tempfile.SpooledTemporaryFile`, ``str``
+    :rtype: :class:`dbbackup.buffers.SpillBuffer`, ``str``
     """
-    import gnupg
+    from . import streams
 
-    tempdir = tempfile.mkdtemp(dir=settings.TMP_DIR)
-    try:
-        filename = f"{filename}.gpg"
-        filepath = os.path.join(tempdir, filename)
-        try:
-            inputfile.seek(0)
-            always_trust = settings.GPG_ALWAYS_TRUST
-            g = gnupg.GPG()
-            result = g.encrypt_file(
-                inputfile,
-                output=filepath,
-                recipients=settings.GPG_RECIPIENT,
-                always_trust=always_trust,
-            )
-            inputfile.close()
-            if not result:
-                msg = f"Encryption failed; status: {result.status}"
-                raise EncryptionError(msg)
-            return create_spooled_temporary_file(filepath), filename
-        finally:
-            if os.path.exists(filepath):
-                os.remove(filepath)
-    finally:
-        os.rmdir(tempdir)
+    inputfile.seek(0)
+    chunks, filename = streams.encrypt_chunks(streams.iter_file(inputfile), filename)
+    outputfile = streams.spool_chunks(chunks)
+    inputfile.close()
+    return outputfile, filename
 
 
 def unencrypt_file(inputfile, filename, passphrase=None):
@@ -212,34 +193,15 @@ def unencrypt_file(inputfile, filename, passphrase=None):
     :type passphrase: ``str`` or ``None``
 
     :returns: Tuple with file and new file's name
-    :rtype: :class:`tempfile.SpooledTemporaryFile`, ``str``
+    :rtype: :class:`dbbackup.buffers.SpillBuffer`, ``str``
     """
-    import gnupg
-
-    def get_passphrase(passphrase=passphrase):
-        return passphrase or getpass("Input Passphrase: ") or None
+    from . import streams
 
-    temp_dir = tempfile.mkdtemp(dir=settings.TMP_DIR)
-    try:
-        new_basename = os.path.basename(filename).replace(".gpg", "")
-        temp_filename = os.path.join(temp_dir, new_basename)
-        try:
-            inputfile.seek(0)
-            g = gnupg.GPG()
-            result = g.decrypt_file(
-                fileobj_or_path=inputfile,
-                passphrase=get_passphrase(),
-                output=temp_filename,
-            )
-            if not result:
-                raise DecryptionError("Decryption failed; status: %s" % result.status)
-            outputfile = create_spooled_temporary_file(temp_filename)
-        finally:
-            if os.path.exists(temp_filename):
-                os.remove(temp_filename)
-    finally:
-        os.rmdir(temp_dir)
-    return outputfile, new_basename
+    inputfile.seek(0)
+    chunks, filename = streams.unencrypt_chunks(
+        streams.iter_file(inputfile), filename, passphrase
+    )
+    return streams.spool_chunks(chunks), filename
 
 
 def compress_file(inputfile, filename):
@@ -253,7 +215,7 @@ def compress_file(inputfile, filename):
     :type filename: ``str``
 
     :returns: Tuple with compressed file and new file's name
-    :rtype: :class:`tempfile.SpooledTemporaryFile`, ``str``
+    :rtype: :class:`dbbackup.buffers.SpillBuffer`, ``str``
     """
     outputfile = create_spooled_temporary_file()
     new_filename = f"{filename}.gz"
@@ -277,7 +239,7 @@ def uncompress_file(inputfile, filename):
     :type filename: ``str``
 
     :returns: Tuple with file and new file's name
-    :rtype: :class:`tempfile.SpooledTemporaryFile`, ``str``
+    :rtype: :class:`dbbackup.buffers.SpillBuffer`, ``str``
     """
     zipfile = gzip.GzipFile(fileobj=inputfile, mode="rb")
     try: